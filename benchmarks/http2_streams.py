@@ -0,0 +1,128 @@
+"""
+Benchmarks many small concurrent HTTP/2 streams on a single connection.
+
+The server is started in-process, and speaks cleartext HTTP/2 with prior knowledge. A client
+sends rounds of concurrent GET requests down one connection, and the number of streams per
+second is reported, along with the number of writes the server made to its transport per round.
+
+    $ python benchmarks/http2_streams.py --streams 100 --rounds 200
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+import h2.config
+import h2.connection
+import h2.events
+from asphalt.core import Context
+
+from kyoukai import Kyoukai, KyoukaiComponent
+from kyoukai.backends.http2 import H2KyoukaiProtocol
+
+
+class WriteCounter(object):
+    """
+    Counts the number of writes made to the transports of HTTP/2 connections.
+    """
+
+    def __init__(self):
+        self.writes = 0
+        connection_made = H2KyoukaiProtocol.connection_made
+
+        def count_writes(protocol, transport):
+            write = transport.write
+
+            def counting_write(data):
+                self.writes += 1
+                return write(data)
+
+            transport.write = counting_write
+            return connection_made(protocol, transport)
+
+        H2KyoukaiProtocol.connection_made = count_writes
+
+
+async def start_server(port: int) -> KyoukaiComponent:
+    """
+    Starts the benchmark server.
+    """
+    # Logging every request would dominate the benchmark.
+    logging.getLogger("Kyoukai").setLevel(logging.WARNING)
+
+    app = Kyoukai("bench")
+
+    @app.route("/")
+    async def index(ctx):
+        return "Hello, world!"
+
+    component = KyoukaiComponent(app, "127.0.0.1", port, http2=True)
+    await component.start(Context())
+    return component
+
+
+async def run_client(port: int, streams: int, rounds: int):
+    """
+    Sends ``rounds`` rounds of ``streams`` concurrent requests down a single connection.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True))
+    conn.initiate_connection()
+    writer.write(conn.data_to_send())
+
+    headers = [(":method", "GET"), (":path", "/"), (":authority", "127.0.0.1"),
+               (":scheme", "http")]
+    for _ in range(rounds):
+        for _ in range(streams):
+            conn.send_headers(conn.get_next_available_stream_id(), headers, end_stream=True)
+        writer.write(conn.data_to_send())
+
+        finished = 0
+        while finished < streams:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.DataReceived):
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, (h2.events.StreamEnded, h2.events.StreamReset)):
+                    finished += 1
+
+            writer.write(conn.data_to_send())
+
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--port", type=int, default=4481)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    counter = WriteCounter()
+    try:
+        component = loop.run_until_complete(start_server(args.port))
+
+        start = time.perf_counter()
+        loop.run_until_complete(run_client(args.port, args.streams, args.rounds))
+        elapsed = time.perf_counter() - start
+
+        for server in component.servers:
+            server.close()
+
+        # Let the server notice that the client has gone.
+        loop.run_until_complete(asyncio.sleep(0.1))
+    finally:
+        loop.close()
+
+    print("{:>10.1f} streams/s".format(args.streams * args.rounds / elapsed))
+    print("{:>10.1f} writes per round of {} streams".format(counter.writes / args.rounds,
+                                                            args.streams))
+
+
+if __name__ == "__main__":
+    main()
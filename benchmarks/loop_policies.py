@@ -0,0 +1,133 @@
+"""
+Benchmarks the built-in HTTP server under each available event loop policy.
+
+For every policy, a server is started in a subprocess, and a number of keep-alive clients send
+GET requests to it as fast as possible. The number of requests per second is then reported.
+
+    $ python benchmarks/loop_policies.py --requests 20000 --concurrency 50
+"""
+import argparse
+import asyncio
+import importlib.util
+import logging
+import signal
+import subprocess
+import sys
+import time
+
+POLICIES = {
+    "asyncio": None,
+    "uvloop": "uvloop",
+}
+
+REQUEST = b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: keep-alive\r\n\r\n"
+
+
+def serve(policy: str, port: int):
+    """
+    Runs the benchmark server.
+    """
+    from kyoukai import Kyoukai
+
+    # Logging every request would dominate the benchmark.
+    logging.getLogger("Kyoukai").setLevel(logging.WARNING)
+
+    app = Kyoukai("bench")
+
+    @app.route("/")
+    async def index(ctx):
+        return "Hello, world!"
+
+    app.run("127.0.0.1", port, loop_policy=policy)
+
+
+async def client(port: int, count: int):
+    """
+    Sends ``count`` requests down a single keep-alive connection.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for _ in range(count):
+        writer.write(REQUEST)
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":", 1)[1])
+
+        await reader.readexactly(length)
+
+    writer.close()
+
+
+async def run_clients(port: int, concurrency: int, count: int):
+    """
+    Runs ``concurrency`` clients at once, each sending ``count`` requests.
+    """
+    await asyncio.gather(*(client(port, count) for _ in range(concurrency)))
+
+
+async def wait_for_server(port: int):
+    """
+    Waits until the server accepts connections.
+    """
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+    raise RuntimeError("Server did not start")
+
+
+def bench(policy: str, port: int, requests: int, concurrency: int) -> float:
+    """
+    Benchmarks a single policy.
+
+    :return: The number of requests per second.
+    """
+    server = subprocess.Popen([sys.executable, __file__, "--serve", policy, "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(wait_for_server(port))
+        per_client = requests // concurrency
+
+        start = time.perf_counter()
+        loop.run_until_complete(run_clients(port, concurrency, per_client))
+        elapsed = time.perf_counter() - start
+
+        return (per_client * concurrency) / elapsed
+    finally:
+        loop.close()
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=4480)
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    for policy, module in POLICIES.items():
+        if module is not None and importlib.util.find_spec(module) is None:
+            print("{:<10} not installed".format(policy))
+            continue
+
+        rps = bench(policy, args.port, args.requests, args.concurrency)
+        print("{:<10} {:>10.1f} req/s".format(policy, rps))
+
+
+if __name__ == "__main__":
+    main()
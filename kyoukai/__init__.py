@@ -10,10 +10,19 @@ Kyoukai is an async web framework for Python 3.5 and above.
     backends
     asphalt
     blueprint
+    cache
+    coalesce
+    compression
+    conditional
+    executor
+    limiter
+    listener
     route
     routegroup
     testing
+    tls
     util
+    workers
 """
 from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.formparser import FormDataParser
@@ -3,15 +3,23 @@ The core application.
 """
 
 import asyncio
+import collections.abc
 import logging
+import signal
 
 from asphalt.core import Context, run_application
-from werkzeug.exceptions import NotFound, MethodNotAllowed, HTTPException, InternalServerError
+from werkzeug.exceptions import NotFound, MethodNotAllowed, HTTPException, InternalServerError, \
+    GatewayTimeout
 from werkzeug.routing import RequestRedirect, Map
 from werkzeug.wrappers import Request, Response
 
 from kyoukai.asphalt import HTTPRequestContext
 from kyoukai.blueprint import Blueprint
+from kyoukai.compression import Compressor, create_compressor
+from kyoukai.conditional import NotModified, make_conditional
+from kyoukai.executor import Executor, create_executor
+from kyoukai.limiter import RequestShed
+from kyoukai.util import set_loop_policy
 
 __version__ = "2.1.4"
 
@@ -78,12 +86,26 @@ class Kyoukai(object):
             
         :param host: The host used for host matching, to be passed to the root Blueprint.
             By default, no host is used, so all hosts are matched on the root Blueprint.
+
+        :param limiter: Keyword-only. The :class:`~.ConcurrencyLimiter` to pass to the root \
+            Blueprint, which limits every route in the app.
+
+        :param cache: Keyword-only. The :class:`~.ResponseCache` to pass to the root Blueprint, \
+            which caches the responses of every route in the app.
+
+        :param etag: Keyword-only. If ETags should be added to the responses of every route in \
+            the app. See :mod:`kyoukai.conditional`.
+
+        :param compress: Keyword-only. If the responses of every route in the app should be \
+            compressed. This can be True, or a :class:`~.Compressor`. See \
+            :mod:`kyoukai.compression`.
             
         :param application_root: Keyword-only. The APPLICATION_ROOT to use inside the fake WSGI \ 
             environment created for ``url_for``, if applicable.
         
         :param loop: Keyword-only. The asyncio event loop to use for this app. If no loop is \ 
-            specified it, will be automatically fetched using :meth:`asyncio.get_event_loop`.
+            specified it, will be automatically fetched using :meth:`asyncio.get_event_loop` \
+            the first time it is used.
         
         :param request_class: Keyword-only. The custom request class to instantiate requests with.
         :param response_class: Keyword-only. The custom response class to instantiate responses \ 
@@ -93,14 +115,14 @@ class Kyoukai(object):
         self.server_name = server_name
 
         # Try and get the loop from the keyword arguments - don't automatically perform
-        # `get_event_loop`.
-        self.loop = kwargs.pop("loop", None)
-        if not self.loop:
-            self.loop = asyncio.get_event_loop()
+        # `get_event_loop`, as an event loop policy may be installed before the app is run.
+        self._loop = kwargs.pop("loop", None)
 
         # Create the root blueprint.
         self._root_bp = Blueprint(application_name, host=kwargs.get("host"),
-                                  host_matching=kwargs.get("host_matching", False))
+                                  host_matching=kwargs.get("host_matching", False),
+                                  limiter=kwargs.get("limiter"), cache=kwargs.get("cache"),
+                                  etag=kwargs.get("etag"), compress=kwargs.get("compress"))
 
         # The current Component that is running this app.
         self.component = None
@@ -115,6 +137,81 @@ class Kyoukai(object):
         # Any extra config.
         self.config = kwargs
 
+        self._compressor = None
+
+        #: The :class:`~.Executor` objects that synchronous routes are run in, by name.
+        #: These are created the first time they are used.
+        self.executors = {}
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        :return: The event loop for this app.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+
+        return self._loop
+
+    @loop.setter
+    def loop(self, value: asyncio.AbstractEventLoop):
+        self._loop = value
+
+    @property
+    def compressor(self) -> Compressor:
+        """
+        The default :class:`~.Compressor`, used by routes with ``compress=True``.
+
+        This is created from the ``compression_*`` config keys the first time it is used. See
+        :func:`~.compression.create_compressor`.
+
+        .. versionadded:: 2.2.0
+        """
+        if self._compressor is None:
+            self._compressor = create_compressor(self.config)
+
+        return self._compressor
+
+    def get_executor(self, name: str) -> Executor:
+        """
+        Gets an executor for synchronous routes, creating it if needed.
+
+        .. versionadded:: 2.2.0
+
+        :param name: The name of the executor, e.g. ``"thread"``.
+        :return: The :class:`~.Executor` with this name.
+        """
+        if name not in self.executors:
+            self.executors[name] = create_executor(name, self.config)
+
+        return self.executors[name]
+
+    def start_executors(self):
+        """
+        Creates the executor of every route ahead of time, so that process pools have warm
+        workers before the first request arrives.
+
+        This is called by the component once the server has started, after any worker processes
+        have been forked.
+
+        .. versionadded:: 2.2.0
+        """
+        for route in self.root.tree_routes:
+            route.get_executor(self)
+
+    def shutdown_executors(self, wait: bool = True):
+        """
+        Shuts down every executor created by :meth:`.get_executor`.
+
+        .. versionadded:: 2.2.0
+
+        :param wait: If this should wait for any running routes to finish.
+        """
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+        self.executors.clear()
+
     @property
     def root(self) -> Blueprint:
         """
@@ -239,6 +336,7 @@ class Kyoukai(object):
         # Create a new HTTPRequestContext.
         ctx = HTTPRequestContext(parent_context, request)
         ctx.app = self
+        ctx.proto = request.environ.get("kyoukai.protocol")
 
         async with ctx:
             # Call match on our Blueprint to find the request.
@@ -269,7 +367,24 @@ class Kyoukai(object):
             ctx.bp = ctx.route.bp
             ctx.route_args = params
 
+            if matched.shield:
+                # Tell the protocol not to cancel us if the client disconnects.
+                request.environ["kyoukai.shield"] = True
+
             result = None
+            etag = matched.get_etag()
+
+            cache = matched.get_cache() if request.method == "GET" else None
+            if cache is not None:
+                result = cache.get(request, self.response_class)
+                if result is not None:
+                    # Cached responses skip the route and its hooks entirely.
+                    if etag:
+                        result = await make_conditional(ctx, result)
+
+                    result = await self._compress(ctx, result)
+                    self.log_route(ctx.request, result.status_code)
+                    return result
 
             # Invoke the route.
             try:
@@ -283,22 +398,32 @@ class Kyoukai(object):
                     result.headers["Allow"] = ",".join(x for x in ctx.rule.methods if x !=
                                                        "OPTIONS")
                 else:
-                    result = await matched.invoke(ctx, params=params)
+                    result = await self._invoke_route(ctx, params)
+            except NotModified as e:
+                # The route found out that the client already has the resource.
+                result = e.get_response(request.environ)
+                cache = etag = None
             except HTTPException as e:
                 logger.info(
                     "Hit HTTPException ({}) inside function, delegating.".format(str(e))
                 )
                 result = await self.handle_httpexception(ctx, e, request.environ)
+                cache = etag = None
+            except asyncio.CancelledError:
+                # The client disconnected, or the server is shutting down.
+                logger.debug("Route function was cancelled.")
+                raise
             except Exception as e:
                 logger.exception("Unhandled exception in route function")
                 new_e = InternalServerError()
                 new_e.__cause__ = e
                 result = await self.handle_httpexception(ctx, new_e, request.environ)
+                cache = etag = None
             else:
                 ctx.route_completed.dispatch(ctx=ctx, result=result)
             finally:
                 # result = wrap_response(result, self.response_class)
-                if result:
+                if result and not etag:
                     # edge cases
                     self.log_route(ctx.request, result.status_code)
 
@@ -306,13 +431,92 @@ class Kyoukai(object):
             result.headers["Server"] = "Kyoukai/{}".format(__version__)
 
             # list means wsgi response probably
-            if not isinstance(result.response, (bytes, str, list)):
+            # other iterables (including async ones) are streamed by the backend.
+            if not isinstance(result.response, collections.abc.Iterable) and \
+                    not hasattr(result.response, "__aiter__"):
                 result.set_data(str(result.response))
 
             result.headers["X-Powered-By"] = "Kyoukai/{}".format(__version__)
 
+            response = result
+            if etag:
+                # This adds the ETag to the full response, which is cached below.
+                response = await make_conditional(ctx, result)
+                self.log_route(ctx.request, response.status_code)
+
+            if cache is not None:
+                cache.put(request, result)
+
+            # Compress last, after the uncompressed response has been cached.
+            response = await self._compress(ctx, response)
+
             # Return the new Response.
-            return result
+            return response
+
+    async def _compress(self, ctx: HTTPRequestContext, response: Response) -> Response:
+        """
+        Compresses a response, if compression is enabled for the route.
+        """
+        compressor = ctx.route.get_compressor(self)
+        if compressor is None:
+            return response
+
+        return await compressor.compress(ctx, response)
+
+    async def _invoke_route(self, ctx: HTTPRequestContext, params: dict) -> Response:
+        """
+        Invokes the route of a request, cancelling it if it takes longer than its timeout.
+
+        :raises GatewayTimeout: If the route timed out.
+        """
+        timeout = ctx.route.timeout
+        if timeout is None:
+            timeout = self.config.get("request_timeout")
+
+        if timeout is None:
+            return await self._invoke_coalesced(ctx, params)
+
+        ctx.timeout_at = self.loop.time() + timeout
+        try:
+            return await asyncio.wait_for(self._invoke_coalesced(ctx, params), timeout)
+        except asyncio.TimeoutError:
+            # Only our own timeout is a 504; a timeout inside the route is an error in the route.
+            if self.loop.time() < ctx.timeout_at:
+                raise
+
+            logger.warning("Route {} timed out after {} seconds."
+                           .format(ctx.route.get_endpoint_name(), timeout))
+            raise GatewayTimeout()
+
+    async def _invoke_coalesced(self, ctx: HTTPRequestContext, params: dict) -> Response:
+        """
+        Invokes the route of a request, or waits for an identical request to finish, if the route
+        is coalesced.
+        """
+        coalescer = ctx.route.coalescer
+        if coalescer is None:
+            return await self._invoke_limited(ctx, params)
+
+        return await coalescer.run(ctx, lambda: self._invoke_limited(ctx, params))
+
+    async def _invoke_limited(self, ctx: HTTPRequestContext, params: dict) -> Response:
+        """
+        Invokes the route of a request once it has been admitted by the Blueprint limiter, if any.
+
+        :raises RequestShed: If the request was shed by the limiter.
+        """
+        limiter = ctx.bp.limiter if ctx.bp is not None else None
+        if limiter is None:
+            return await ctx.route.invoke(ctx, params=params)
+
+        if not (limiter.try_acquire() or await limiter.acquire()):
+            raise RequestShed(limiter.retry_after)
+
+        start = self.loop.time()
+        try:
+            return await ctx.route.invoke(ctx, params=params)
+        finally:
+            limiter.release(self.loop.time() - start)
 
     async def start(self, ip: str = "127.0.0.1", port: int = 4444, *,
                     component=None, base_context: Context = None):
@@ -338,19 +542,74 @@ class Kyoukai(object):
         else:
             self.component = component
 
+        if self.component.cfg.get("loop_policy"):
+            logger.warning("The loop_policy option has no effect when using Kyoukai.start, as the "
+                           "event loop is already running.")
+
         # Start the app.
         await self.component.start(base_context)
 
     def run(self, ip: str = "127.0.0.1", port: int = 4444, *,
-            component=None):
+            component=None, workers: int = None, loop_policy: str = None):
         """
         Runs the Kyoukai server from within your code.
 
         This is not normally invoked - instead Asphalt should invoke the Kyoukai component.
         However, this is here for convenience.
+
+        .. versionchanged:: 2.2
+
+            Added the ``workers`` and ``loop_policy`` parameters. The server is now drained on \
+            ``SIGTERM``, and the TLS certificates are reloaded on ``SIGHUP``.
+
+        :param ip: The IP of the built-in server.
+        :param port: The port of the built-in server.
+        :param component: The component to start the app with. This should be an instance of \
+            :class:`kyoukai.asphalt.KyoukaiComponent`.
+
+        :param workers: The number of worker processes to run the server in.
+            If this is 0, one worker is spawned per CPU core. If this is not provided, the \
+            ``workers`` key of the component config is used, falling back to a single process.
+            
+            If the ``preload`` key of the component config is True, the app is finalized and the \
+            listening socket is bound before forking the workers.
+
+        :param loop_policy: The event loop policy to install before creating the event loop.
+            See :func:`~.util.set_loop_policy` for the accepted values. If this is not provided, \
+            the ``loop_policy`` key of the component config is used.
         """
         if not component:
             from kyoukai.asphalt import KyoukaiComponent
             component = KyoukaiComponent(self, ip, port)
 
-        run_application(component)
+        if workers is not None:
+            component.cfg["workers"] = workers
+
+        if loop_policy is not None:
+            component.cfg["loop_policy"] = loop_policy
+
+        workers = component.cfg.get("workers", 1)
+        if workers != 1:
+            from kyoukai.workers import WorkerSupervisor
+            logging.basicConfig(level=logging.INFO)
+            supervisor = WorkerSupervisor(component, workers,
+                                          preload=component.cfg.get("preload", False))
+            supervisor.run()
+        else:
+            if component.cfg.get("loop_policy"):
+                policy = set_loop_policy(component.cfg["loop_policy"])
+                # Replace any loop created by the previous policy.
+                self.loop = policy.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+
+            # Finish any in-flight requests before exiting.
+            try:
+                self.loop.add_signal_handler(signal.SIGTERM,
+                                             lambda: self.loop.create_task(component.shutdown()))
+                # Reload the TLS certificates, without closing the listening sockets.
+                self.loop.add_signal_handler(signal.SIGHUP, component.reload_tls)
+            except NotImplementedError:
+                # Signal handlers aren't supported on Windows.
+                pass
+
+            run_application(component)
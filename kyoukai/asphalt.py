@@ -2,19 +2,24 @@
 Asphalt wrappers for Kyoukai.
 """
 import abc
+import asyncio
 import importlib
 import socket
-import ssl as py_ssl
+import typing
 from functools import partial
 import logging
 
 from asphalt.core import resolve_reference, Context
 from asphalt.core.event import Signal, Event
 from asphalt.core.component import Component
+from werkzeug.http import http_date, quote_etag
 from werkzeug.routing import Rule
 from werkzeug.wrappers import Request, Response
 
 from kyoukai.blueprint import Blueprint
+from kyoukai.conditional import NotModified, is_modified
+from kyoukai.limiter import AdaptiveLimiter, ConcurrencyLimiter
+from kyoukai.listener import Listener
 from kyoukai.route import Route
 
 
@@ -89,7 +94,14 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
 
     def __init__(self, app, ip: str = "127.0.0.1", port: int = 4444, **cfg):
         from kyoukai.app import Kyoukai
+
+        #: The reference the application object was resolved from, if any.
+        #: This is used to reload the application inside a :class:`~.WorkerSupervisor`.
+        self.app_reference = None
+
         if not isinstance(app, Kyoukai):
+            if isinstance(app, str):
+                self.app_reference = app
             app = resolve_reference(app)
 
         #: The application object for a this component.
@@ -107,12 +119,32 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
         #: The :class:`asyncio.Server` instance that is serving us today.
         self.server = None
 
+        #: Every :class:`asyncio.Server` instance, if this component runs several listeners.
+        self.servers = []
+
         #: The base context for this server.
         self.base_context = None  # type: Context
 
+        #: The set of protocols for every open connection to the server.
+        self.connections = set()
+
+        #: The :class:`~.TLSManager` of every TLS listener, once the server has started.
+        self.tls = []
+
+        #: If the server is draining, i.e. finishing in-flight requests before shutting down.
+        self.draining = False
+
         #: The backend to use for the HTTP server.
         self.backend = self.cfg.get("backend", "kyoukai.backends.httptools_")
 
+        #: The index of the worker process running this component, or None if this component is
+        #: not running inside a :class:`~.WorkerSupervisor`.
+        self.worker_index = None
+
+        #: The :class:`~.ConcurrencyLimiter` that admits requests to this server, or None if the
+        #: number of concurrent requests is not limited.
+        self.limiter = self.create_limiter()
+
         self.logger = logging.getLogger("Kyoukai")
 
         self._server_name = app.server_name or socket.getfqdn()
@@ -129,6 +161,173 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
         """
         return self.app.server_name or self._server_name
 
+    def create_limiter(self) -> ConcurrencyLimiter:
+        """
+        Creates the limiter for this server from the ``max_in_flight``, ``max_queue``,
+        ``queue_timeout`` and ``retry_after`` config keys.
+
+        If the ``adaptive_limit`` config key is set, an :class:`~.AdaptiveLimiter` is created
+        instead, with ``max_in_flight`` as the highest limit. ``adaptive_limit`` can be True, or a
+        dict of additional arguments to the limiter.
+
+        .. versionadded:: 2.2.0
+
+        :return: A new limiter, or None if the number of concurrent requests is not limited.
+        """
+        options = {
+            "max_queue": self.cfg.get("max_queue", 0),
+            "queue_timeout": self.cfg.get("queue_timeout"),
+            "retry_after": self.cfg.get("retry_after", 1)
+        }
+
+        adaptive = self.cfg.get("adaptive_limit")
+        if adaptive:
+            if isinstance(adaptive, dict):
+                options.update(adaptive)
+
+            if self.cfg.get("max_in_flight"):
+                options.setdefault("max_limit", self.cfg["max_in_flight"])
+
+            return AdaptiveLimiter(**options)
+
+        if not self.cfg.get("max_in_flight"):
+            return None
+
+        return ConcurrencyLimiter(self.cfg["max_in_flight"], **options)
+
+    def reload_tls(self) -> bool:
+        """
+        Reloads the TLS certificates of every listener, without closing any sockets.
+
+        Connections that are already open keep using the old certificates. If a certificate
+        fails to load, the old certificates are kept.
+
+        This is installed as the ``SIGHUP`` handler by :meth:`.Kyoukai.run`.
+
+        .. versionadded:: 2.2.0
+
+        :return: True if every listener was reloaded.
+        """
+        return all([manager.reload() for manager in self.tls])
+
+    def tls_stats(self) -> dict:
+        """
+        Gets the TLS statistics of every listener, added together.
+
+        .. versionadded:: 2.2.0
+
+        :return: A dict with the total number of ``handshakes``, the ``handshake_rate`` per \
+            second, and the OpenSSL session cache statistics, such as the number of resumed \
+            sessions (``hits``). See :meth:`.TLSManager.stats`.
+        """
+        totals = {}
+        for manager in self.tls:
+            for key, value in manager.stats().items():
+                totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+    @property
+    def remaining(self) -> int:
+        """
+        :return: The number of requests that are currently being processed by this server.
+        """
+        return sum(proto.in_flight for proto in self.connections)
+
+    async def drain(self, timeout: float = None) -> int:
+        """
+        Gracefully stops the server.
+
+        This stops accepting new connections, and asks every open connection to finish the
+        requests that are in-flight. HTTP/1.1 connections will respond with ``Connection: close``,
+        and HTTP/2 connections will send a GOAWAY frame. Idle connections are closed immediately.
+
+        Any requests that are still running after the timeout are cancelled, and every connection
+        is closed.
+
+        .. versionadded:: 2.2.0
+
+        :param timeout: The maximum amount of time, in seconds, to wait for in-flight requests.
+            If this is not provided, the ``drain_timeout`` config key is used, which defaults to \
+            30 seconds.
+
+        :return: The number of requests that were cancelled.
+        """
+        if timeout is None:
+            timeout = self.cfg.get("drain_timeout", 30)
+
+        self.draining = True
+        servers = list(self.servers)
+        if self.server is not None and self.server not in servers:
+            servers.append(self.server)
+
+        for server in servers:
+            server.close()
+
+        for manager in self.tls:
+            manager.stop()
+
+        self.logger.info("Draining {} connection(s) with {} request(s) in-flight."
+                         .format(len(self.connections), self.remaining))
+
+        for proto in list(self.connections):
+            proto.drain()
+
+        loop = self.app.loop
+        deadline = loop.time() + timeout
+        while self.remaining and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        cancelled = self.remaining
+        if cancelled:
+            self.logger.warning("Cancelling {} request(s) that did not finish in time."
+                                .format(cancelled))
+
+        for proto in list(self.connections):
+            proto.cancel_requests()
+
+        # Let the cancelled requests unwind before closing their connections.
+        await asyncio.sleep(0)
+        for proto in list(self.connections):
+            proto.close()
+
+        for server in servers:
+            await server.wait_closed()
+
+        # Routes that are still running in an executor cannot be cancelled, so don't wait for them.
+        self.app.shutdown_executors(wait=False)
+
+        return cancelled
+
+    async def shutdown(self, timeout: float = None):
+        """
+        Drains the server using :meth:`.drain`, then stops the event loop.
+
+        This is installed as the ``SIGTERM`` handler by :meth:`.Kyoukai.run`.
+
+        .. versionadded:: 2.2.0
+        """
+        try:
+            await self.drain(timeout)
+        finally:
+            self.app.loop.stop()
+
+    async def teardown(self, event):
+        """
+        Drains the server when the context it was started in is finished, if it has not been
+        drained already.
+
+        This is connected to the ``finished`` signal of the context by :meth:`.start`, so that
+        the server is drained however the component is stopped, including by the Asphalt runner
+        or the app embedding it with :meth:`.Kyoukai.start`.
+
+        .. versionadded:: 2.2.0
+
+        :param event: The event dispatched by the ``finished`` signal.
+        """
+        if not self.draining:
+            await self.drain()
+
     def get_protocol(self, ctx: Context, serv_info: tuple):
         """
         Gets the protocol to use for this webserver.
@@ -151,6 +350,22 @@ class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
     .. versionchanged:: 2.2
     
         Passing ``run_server`` as False will not run the inbuilt web server.
+
+    .. versionchanged:: 2.2
+
+        Passing ``workers`` will run the server inside multiple worker processes, when started with
+        :meth:`.Kyoukai.run`, and passing ``preload`` will preload the app before forking them.
+
+    .. versionchanged:: 2.2
+
+        Socket options, Unix domain sockets and inherited file descriptors can be configured, and
+        several listeners can be run at once with ``listeners``. See :class:`~.Listener`.
+
+    .. versionchanged:: 2.2
+
+        Passing ``max_in_flight`` limits the number of requests processed at once, and sheds any
+        excess requests with a ``503``. Passing ``adaptive_limit`` adjusts the limit based on the
+        latency of requests. See :class:`~.ConcurrencyLimiter` and :class:`~.AdaptiveLimiter`.
     """
     connection_made = Signal(ConnectionMadeEvent)
     connection_lost = Signal(ConnectionLostEvent)
@@ -175,6 +390,27 @@ class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
         for key, value in cfg.items():
             setattr(self, key, value)
 
+        # The top-level config is the default for every listener.
+        defaults = dict(self.cfg, ip=ip, port=port)
+
+        #: The list of :class:`~.Listener` objects that this component serves on.
+        self.listeners = [Listener.from_config(listener, defaults)
+                          for listener in self.cfg.get("listeners", [{}])]
+
+    def bind(self, shared_only: bool = False):
+        """
+        Creates the listening sockets for this component, if they have not been created already.
+
+        This is called by a :class:`~.WorkerSupervisor` to create sockets that are inherited by
+        every worker.
+
+        :param shared_only: If only the sockets that cannot be bound by each worker with \
+            ``SO_REUSEPORT`` should be created.
+        """
+        for listener in self.listeners:
+            if listener.sock is None and (listener.shared or not shared_only):
+                listener.create_socket()
+
     def get_server_name(self):
         """
         :return: The server name of this app.
@@ -188,40 +424,35 @@ class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
         :param ctx: The base context.
         """
         self.base_context = ctx
-
-        ssl_context = None
-
-        if self.cfg.get("ssl", {}):
-            ssl = self.cfg["ssl"]
-            if ssl.get("enabled") is True:
-                ssl_context = py_ssl.create_default_context(py_ssl.Purpose.CLIENT_AUTH)
-                # override the ciphers
-                ssl_context.set_ciphers(
-                    "ECDH+CHACHA20:ECDH+CHACHA20:"         # CHACHA20 for newer openssl
-                    "ECDH+AES128:RSA+AES128:"              # Standard AES
-                    "ECDH+AES256:RSA+AES256:"              # Slower AES
-                    "ECDH+3DES:RSA+3DES:"                  # 3DES for older systems
-                    "!aNULL:!eNULL:!MD5:!DSS:!RC4")        # Disable insecure ciphers
-                ssl_context.load_cert_chain(certfile=ssl["ssl_certfile"],
-                                            keyfile=ssl["ssl_keyfile"])
-
-                if self.cfg.get("http2", False) is True:
-                    ssl_context.set_alpn_protocols(["h2"])
-
-                    try:
-                        ssl_context.set_npn_protocols(["h2"])
-                    except NotImplementedError:
-                        # NPN protocol doesn't work here, so don't bother setting it
-                        pass
-
-                self.logger.info("Using HTTP over TLS.")
+        ctx.finished.connect(self.teardown)
 
         if self.cfg.get("run_server", True) is True:
-            protocol = partial(self.get_protocol, ctx, (self._server_name, self.port))
             self.app.finalize()
-            self.server = await self.app.loop.create_server(protocol, self.ip, self.port,
-                                                            ssl=ssl_context)
-            self.logger.info("Kyoukai serving on {}:{}.".format(self.ip, self.port))
+
+            # Multiple workers each bind their own socket to the same port, and let the kernel
+            # balance connections between them.
+            reuse_port = self.cfg.get("workers", 1) != 1
+
+            for listener in self.listeners:
+                # The socket may have been created for us, for example by a preloading supervisor.
+                if listener.sock is None:
+                    listener.create_socket(reuse_port=reuse_port)
+
+                ssl_context = listener.create_ssl_context(self.cfg.get("http2", False))
+                if ssl_context is not None:
+                    self.logger.info("Using HTTP over TLS.")
+                    listener.tls.watch(self.app.loop)
+                    self.tls.append(listener.tls)
+
+                protocol = partial(self.get_protocol, ctx, (self._server_name, listener.port))
+                server = await self.app.loop.create_server(protocol, sock=listener.sock,
+                                                           ssl=ssl_context,
+                                                           backlog=listener.backlog)
+                self.servers.append(server)
+                self.logger.info("Kyoukai serving on {}.".format(listener))
+
+            self.server = self.servers[0]
+            self.app.start_executors()
 
 
 class HTTPRequestContext(Context):
@@ -256,6 +487,102 @@ class HTTPRequestContext(Context):
         #: The :class:`asyncio.Protocol` protocol handling this connection.
         self.proto = None
 
+        #: The event loop time at which this request times out, or None if it has no timeout.
+        self.timeout_at = None  # type: float
+
+        #: The ETag passed to :meth:`.check_etag`, which is added to the response.
+        self.etag = None  # type: str
+
+    @property
+    def deadline(self) -> float:
+        """
+        :return: The number of seconds left before this request times out, or None if it has no \
+            timeout. This can be passed on to any downstream calls that the route makes.
+
+        .. versionadded:: 2.2.0
+        """
+        if self.timeout_at is None:
+            return None
+
+        return max(0.0, self.timeout_at - self.app.loop.time())
+
+    async def disconnected(self):
+        """
+        Waits until the client that sent this request disconnects.
+
+        For HTTP/2, this also returns when the client resets the stream of this request. This is
+        useful for long-polling and streaming routes, which can stop doing work once nobody is
+        waiting for the response.
+
+        .. versionadded:: 2.2.0
+        """
+        if self.proto is None or not hasattr(self.proto, "wait_disconnected"):
+            # We're not being served by the built-in server, so we can't tell.
+            await self.app.loop.create_future()
+
+        # Shield the future, so that a cancelled waiter doesn't cancel it for everyone else.
+        await asyncio.shield(self.proto.wait_disconnected(self.environ))
+
+    def push(self, path: str, headers: typing.Iterable[typing.Tuple[str, str]] = None) -> bool:
+        """
+        Pushes a resource to the client, before the client asks for it.
+
+        This only works for requests made over HTTP/2, and only if the client allows pushes. The
+        pushed request is processed by the app like any other request, without going over the
+        network.
+
+        .. code-block:: python
+
+            @app.route("/")
+            async def index(ctx: HTTPRequestContext):
+                ctx.push("/static/style.css")
+                return await render("index.html")
+
+        :param path: The path of the resource to push, including the query string if needed.
+        :param headers: Any extra headers for the pushed request.
+        :return: True if the resource is being pushed, False otherwise.
+
+        .. versionadded:: 2.2.0
+        """
+        if self.proto is None or not hasattr(self.proto, "push"):
+            # Pushes need HTTP/2.
+            return False
+
+        return self.proto.push(self.environ, path, headers or ())
+
+    def check_etag(self, etag: str, *, weak: bool = False, last_modified=None):
+        """
+        Checks if the client already has the current version of the resource, before building the
+        response.
+
+        If the client sent a matching ``If-None-Match`` (or, without one, an ``If-Modified-Since``
+        that is not older than ``last_modified``), this raises :class:`~.NotModified`, which is
+        turned into an empty ``304 Not Modified`` response. Otherwise, the ETag is added to the
+        response once it is returned, if ETags are enabled for the route.
+
+        .. code-block:: python
+
+            @app.route("/articles/<int:article_id>", etag=True)
+            async def article(ctx: HTTPRequestContext, article_id: int):
+                version = await db.get_article_version(article_id)
+                ctx.check_etag("{}-{}".format(article_id, version))
+                return await render_article(article_id)
+
+        :param etag: A value that changes whenever the resource changes, such as a version number.
+        :param weak: If the ETag is weak, i.e the resource may change in insignificant ways.
+        :param last_modified: The :class:`datetime.datetime` the resource was last modified.
+        :raises NotModified: If the client already has this version of the resource.
+
+        .. versionadded:: 2.2.0
+        """
+        self.etag = quote_etag(etag, weak)
+        if not is_modified(self.environ, self.etag, last_modified):
+            headers = [("ETag", self.etag)]
+            if last_modified is not None:
+                headers.append(("Last-Modified", http_date(last_modified)))
+
+            raise NotModified(headers)
+
     def url_for(self, endpoint: str, *, method: str = None, **kwargs):
         """
         A context-local version of ``url_for``.
@@ -6,7 +6,6 @@ to the authors of this page.
 
 This server has some notable pitfalls:
 
-    - It ignores any priority data that is sent by the client.
     - It is not paticularly fast (unbenchmarked, but it can be assumed to be slower than the httptools backend.)
     - It does not fully implement all events.
 
@@ -14,9 +13,10 @@ Additionally, this server is **untested** - it can and probably will fail horrib
 """
 import asyncio
 import collections
+import functools
 import logging
+import socket
 import typing
-import ssl
 import sys
 import warnings
 
@@ -30,15 +30,35 @@ from werkzeug.wrappers import Request, Response
 from werkzeug.datastructures import MultiDict
 
 from kyoukai.asphalt import KyoukaiBaseComponent
+from kyoukai.backends.scheduler import PriorityScheduler
+from kyoukai.tls import TLSManager
 
 from h2.connection import H2Connection
 from h2.events import (
-    DataReceived, RequestReceived, WindowUpdated, StreamEnded, StreamReset
+    DataReceived, RequestReceived, WindowUpdated, StreamEnded, StreamReset, PriorityUpdated,
+    RemoteSettingsChanged
 )
 from h2.errors import ErrorCodes
+from h2.settings import SettingCodes, Settings
+from hyperframe.frame import GoAwayFrame
 
-# Sentinel value for the request being complete.
-REQUEST_FINISHED = object()
+# The number of bytes of DATA frames the writer sends before yielding to the event loop.
+WRITE_BATCH_SIZE = 256 * 1024
+
+# The size of the flow control window of a new connection, before it is changed with a
+# WINDOW_UPDATE frame.
+DEFAULT_WINDOW_SIZE = 65535
+
+
+@functools.lru_cache()
+def get_shed_headers(retry_after: int) -> list:
+    """
+    Gets the response headers that are sent to streams shed by the limiter.
+
+    :param retry_after: The value of the ``Retry-After`` header.
+    """
+    return [(":status", "503"), ("server", "Kyoukai"), ("retry-after", str(retry_after)),
+            ("content-length", "0")]
 
 
 def get_header(headers: typing.List[typing.Tuple[str, str]], name: str) -> str:
@@ -91,7 +111,10 @@ def create_wsgi_environment(r: 'H2State') -> MultiDict:
         "SERVER_NAME": server_name,
         "SERVER_PORT": port,
         "REMOTE_ADDR": r._protocol.ip,
-        "REMOTE_PORT": r._protocol.client_port
+        "REMOTE_PORT": r._protocol.client_port,
+        # Kyoukai things
+        "kyoukai.protocol": r._protocol,
+        "kyoukai.stream_id": r.stream_id
     })
 
     # Add the headers.
@@ -104,10 +127,16 @@ def create_wsgi_environment(r: 'H2State') -> MultiDict:
 
 class H2State:
     """
-    A temporary class that is used to store request data for a HTTP/2 connection.
+    The state of a single stream on a HTTP/2 connection.
+
+    This owns everything the protocol keeps for the stream, and is released by the protocol once
+    the stream is complete, so that a connection only holds state for its active streams.
 
     This is also passed to the Werkzeug request to emit data.
     """
+    __slots__ = ("stream_id", "_protocol", "headers", "environ", "body", "size", "_waiter",
+                 "unacknowledged", "ended", "buffer", "task", "response", "disconnected",
+                 "_emit_headers", "_emit_status")
 
     def __init__(self, headers: list, stream_id, protocol: 'H2KyoukaiProtocol'):
         self.stream_id = stream_id
@@ -115,19 +144,142 @@ class H2State:
 
         self.headers = headers
 
-        # The queue of data.
-        # This is a deque as reading from here is implicitly async.
-        self.body = asyncio.Queue()
+        # The WSGI environment for this stream, once it has been created.
+        self.environ = None
+
+        # If the client has finished sending the request.
+        self.ended = False
+
+        # The response data that hasn't been sent yet.
+        self.buffer = None  # type: SendBuffer
+
+        # The task that is running the app for this stream.
+        self.task = None  # type: asyncio.Task
+
+        # The future that completes once the response has been sent, or is cancelled if the
+        # stream is reset first.
+        self.response = None  # type: asyncio.Future
+
+        # The future that is completed when the stream is reset, or the client disconnects.
+        # This is only created if a route waits for it.
+        self.disconnected = None  # type: asyncio.Future
+
+        # The chunks of request data that haven't been read yet, and how many bytes they hold.
+        self.body = collections.deque()
+        self.size = 0
+
+        # The future that is completed when more data arrives, if a reader is waiting.
+        self._waiter = None  # type: asyncio.Future
+
+        # The number of bytes received but not yet read, and so not yet acknowledged to the client.
+        self.unacknowledged = 0
 
         # The data to emit.
         self._emit_headers = None
         self._emit_status = None
 
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self):
+        """
+        Waits until more data arrives, or the request ends.
+        """
+        self._waiter = self._protocol.component.app.loop.create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
     def insert_data(self, data: bytes):
         """
         Writes data from the stream into the body.
         """
-        self.body.put_nowait(data)
+        if data:
+            self.body.append(memoryview(data))
+            self.size += len(data)
+            self.unacknowledged += len(data)
+            self._wakeup()
+
+    def finish(self):
+        """
+        Marks the body as complete.
+        """
+        self.ended = True
+        self._wakeup()
+
+    def acknowledge(self, size: int):
+        """
+        Tells the client that data has been read from the body, so that it can send more.
+
+        The client can only send as much data as fits into the flow control window, so a handler
+        that doesn't read the body stops the client from sending any more of it.
+
+        :param size: The number of bytes that were read.
+        """
+        size = min(size, self.unacknowledged)
+        if size:
+            self.unacknowledged -= size
+            self._protocol.acknowledge_data(self.stream_id, size)
+
+    def discard(self):
+        """
+        Throws away any data that will never be read, acknowledging it so that it doesn't use up
+        the window of the connection.
+        """
+        self.body.clear()
+        self.size = 0
+        self.acknowledge(self.unacknowledged)
+
+    def _take(self, size: int) -> typing.List[memoryview]:
+        """
+        Takes up to ``size`` bytes of chunks from the start of the body.
+        """
+        pieces = []
+        taken = 0
+        while self.body and taken < size:
+            chunk = self.body[0]
+            if len(chunk) <= size - taken:
+                pieces.append(self.body.popleft())
+            else:
+                # Slicing a memoryview doesn't copy the rest of the chunk.
+                pieces.append(chunk[:size - taken])
+                self.body[0] = chunk[size - taken:]
+
+            taken += len(pieces[-1])
+
+        self.size -= taken
+        self.acknowledge(taken)
+        return pieces
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads the data that has been received so far, without waiting for more.
+
+        :param size: The maximum amount of data to receive. If this is negative, all of the \
+            data received so far is read.
+        """
+        if size < 0:
+            size = self.size
+
+        return b"".join(self._take(size))
+
+    def readinto(self, buffer) -> int:
+        """
+        Reads the data that has been received so far into a writable buffer, without waiting for
+        more.
+
+        :param buffer: The buffer to read into, such as a :class:`bytearray`.
+        :return: The number of bytes read.
+        """
+        view = memoryview(buffer).cast("B")
+        offset = 0
+        for piece in self._take(len(view)):
+            view[offset:offset + len(piece)] = piece
+            offset += len(piece)
+
+        return offset
 
     async def read_async(self, to_end=True):
         """
@@ -139,58 +291,55 @@ class H2State:
         :param to_end: If ``to_end`` is specified, then read until the end of the request.
             Otherwise, it will read one data chunk.
         """
-        data = b""
-        if to_end:
-            while True:
-                d = await self.body.get()
-                if d == REQUEST_FINISHED:
-                    break
-                data += d
-        else:
-            d = await self.body.get()
-            if not d == REQUEST_FINISHED:
-                data += d
+        if not to_end:
+            while not self.body and not self.ended:
+                await self._wait()
 
-        return data
+            return self.get_chunk()
 
-    def read(self, size: int = -1) -> bytes:
+        pieces = []
+        while True:
+            # Take each chunk as it arrives, so that the client can send the rest.
+            pieces.extend(self._take(self.size))
+            if self.ended:
+                break
+
+            await self._wait()
+
+        return b"".join(pieces)
+
+    async def readexactly(self, size: int) -> bytes:
         """
-        Reads data from the request until it's all done.
+        Reads exactly ``size`` bytes, waiting for them to arrive.
 
-        :param size: The maximum amount of data to receive.
+        :param size: The number of bytes to read.
+        :raises asyncio.IncompleteReadError: If the request ended before ``size`` bytes were \
+            received.
         """
-        # Thanks h2 docs page for the chunking inspiration
-        # However, we're lazy and just shove it back on the front of the queue when we're done
-        curr_data = b""
-        while size < 0 or len(curr_data) < size:
-            # size < 0 means read until we can't
-            # b''.join is probably faster.
-            try:
-                curr_data += self.body.get_nowait()
-            except asyncio.QueueEmpty:
-                # no more data left to pop
-                break
+        pieces = []
+        remaining = size
+        while True:
+            # Take the data as it arrives, so that the client can send more than a window's worth.
+            for piece in self._take(remaining):
+                pieces.append(piece)
+                remaining -= len(piece)
 
-        # Get rid of any excess data.
-        d = curr_data[:size]
-        if len(curr_data) != len(d):
-            # we have data left to read, so place it back on the left of the deque.
-            self.body._queue.appendleft(curr_data[size:])
+            if not remaining:
+                return b"".join(pieces)
 
-        return d
+            if self.ended:
+                raise asyncio.IncompleteReadError(b"".join(pieces), size)
+
+            await self._wait()
 
     def get_chunk(self) -> bytes:
         """
-        Gets a chunk of data from the queue.
+        Gets a chunk of data from the body, or an empty bytes if there is none yet.
         """
-        try:
-            d = self.body.get_nowait()
-            if d == REQUEST_FINISHED:
-                return b""
-        except asyncio.QueueEmpty:
+        if not self.body:
             return b""
 
-        return d
+        return b"".join(self._take(len(self.body[0])))
 
     def start_response(self, status: str, headers: typing.List[typing.Tuple[str, str]],
                        exc_info=None):
@@ -219,7 +368,119 @@ class H2State:
         return self
 
     def __next__(self):
-        return self.get_chunk()
+        chunk = self.get_chunk()
+        if not chunk:
+            raise StopIteration
+
+        return chunk
+
+
+class SendBuffer(object):
+    """
+    Buffers the response data of a single stream until it can be sent.
+
+    Response bodies are pulled lazily. Synchronous iterators are advanced by the writer loop only
+    when the buffer runs low, and asynchronous iterators are consumed by a producer task that
+    waits whenever the buffer is full.
+    """
+    __slots__ = ("chunks", "size", "max_size", "iterator", "producer", "finished", "_space")
+
+    def __init__(self, max_size: int = 65536):
+        #: The chunks of data waiting to be sent.
+        self.chunks = collections.deque()
+
+        #: The number of bytes waiting to be sent.
+        self.size = 0
+
+        #: The number of bytes to buffer before waiting for the data to be sent.
+        self.max_size = max_size
+
+        #: The synchronous iterator that data is pulled from, if any.
+        self.iterator = None
+
+        #: The task consuming an asynchronous iterator, if any.
+        self.producer = None  # type: asyncio.Task
+
+        #: If the whole response has been added to this buffer.
+        self.finished = False
+
+        self._space = asyncio.Event()
+        self._space.set()
+
+    @property
+    def ready(self) -> bool:
+        """
+        :return: If there is anything for the writer to do, i.e. data to send or pull, or the end \
+            of the stream to send.
+        """
+        return bool(self.chunks) or self.iterator is not None or self.finished
+
+    def write(self, data: bytes):
+        """
+        Adds data to the end of the buffer.
+        """
+        if data:
+            self.chunks.append(memoryview(data))
+            self.size += len(data)
+
+        if self.size >= self.max_size:
+            self._space.clear()
+
+    def fill(self):
+        """
+        Pulls data from the synchronous iterator until the buffer is full, or the iterator is
+        exhausted.
+        """
+        while self.iterator is not None and self.size < self.max_size:
+            try:
+                chunk = next(self.iterator)
+            except StopIteration:
+                self.close()
+                self.finished = True
+            else:
+                self.write(chunk)
+
+    def read(self, size: int) -> bytes:
+        """
+        Takes up to ``size`` bytes from the start of the buffer.
+        """
+        # Chunks are stored as memoryviews, so taking part of a chunk doesn't copy the rest of it.
+        pieces = []
+        while size and self.chunks:
+            data = self.chunks[0]
+            if len(data) <= size:
+                pieces.append(self.chunks.popleft())
+            else:
+                pieces.append(data[:size])
+                self.chunks[0] = data[size:]
+
+            size -= len(pieces[-1])
+
+        data = b"".join(pieces)
+        self.size -= len(data)
+        if self.size < self.max_size:
+            self._space.set()
+
+        return data
+
+    async def wait_for_space(self):
+        """
+        Waits until the buffer is no longer full.
+        """
+        await self._space.wait()
+
+    def close(self):
+        """
+        Closes the source of the data in this buffer.
+        """
+        if self.iterator is not None:
+            if hasattr(self.iterator, "close"):
+                self.iterator.close()
+            self.iterator = None
+
+        if self.producer is not None:
+            self.producer.cancel()
+            self.producer = None
 
 
 class H2KyoukaiComponent(KyoukaiBaseComponent):
@@ -227,14 +488,22 @@ class H2KyoukaiComponent(KyoukaiBaseComponent):
     A component subclass that creates H2KyoukaiProtocol instances.
     """
     def __init__(self, app, ssl_keyfile: str, ssl_certfile: str,
-                 *, ip: str="127.0.0.1", port: int=4444):
+                 *, ip: str="127.0.0.1", port: int=4444, **cfg):
         """
         Creates a new HTTP/2 SSL-based context.
 
         This will use the HTTP/2 protocol, disabling HTTP/1.1 support for this port. It is possible to run two
         servers side-by-side, one HTTP/2 and one HTTP/1.1, if you run them on different ports.
+
+        .. versionchanged:: 2.2
+
+            Added ``cfg``, for the same config keys as :class:`.KyoukaiComponent`. Extra TLS \
+            options, such as SNI certificates, can be passed in the ``ssl_options`` key. See \
+            :ref:`tls`.
         """
-        super().__init__(app, ip, port)
+        super().__init__(app, ip, port, **cfg)
+
+        self.app.config.update(self.cfg)
 
         self.ssl_keyfile = ssl_keyfile
         self.ssl_certfile = ssl_certfile
@@ -247,19 +516,22 @@ class H2KyoukaiComponent(KyoukaiBaseComponent):
         return H2KyoukaiProtocol(self, ctx)
 
     async def start(self, ctx: Context):
-        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        ssl_context.load_cert_chain(certfile=self.ssl_certfile, keyfile=self.ssl_keyfile)
-        ssl_context.set_alpn_protocols(["h2"])
+        self.base_context = ctx
+        ctx.finished.connect(self.teardown)
 
-        try:
-            ssl_context.set_npn_protocols(["h2"])
-        except NotImplementedError:
-            # NPN protocol doesn't work here, so don't bother setting it
-            pass
+        # Extra TLS options, such as SNI certificates, can be passed with ``ssl_options``.
+        config = dict(self.cfg.get("ssl_options", {}), ssl_certfile=self.ssl_certfile,
+                      ssl_keyfile=self.ssl_keyfile)
+        manager = TLSManager(config, http2=True)
+        manager.watch(self.app.loop)
+        self.tls.append(manager)
+        ssl_context = manager.context
 
         protocol = partial(self.get_protocol, ctx, (self._server_name, self.port))
         self.app.finalize()
         self.server = await self.app.loop.create_server(protocol, self.ip, self.port, ssl=ssl_context)
+        self.servers.append(self.server)
+        self.app.start_executors()
         self.logger.info("Kyoukai H2 serving on {}:{}".format(self.ip, self.port))
 
 
@@ -283,14 +555,31 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         # The current transport for this connection.
         self.transport = None  # type: asyncio.WriteTransport
 
-        # The current streams for this request.
-        # This is a dictionary of stream_id -> data.
-        self.streams = {}  # type: typing.Dict[H2State]
+        # The active streams on this connection.
+        # This is a dictionary of stream_id -> H2State. Streams are removed once they are
+        # complete, so this only grows with the number of streams open at once.
+        self.streams = {}  # type: typing.Dict[int, H2State]
+
+        # The maximum number of bytes of response data to buffer for each stream.
+        self.buffer_size = component.cfg.get("http2_buffer_size", 65536)
 
-        # The current stream data queue.
-        # This is a Queue of two-item tuples: (stream_data, stream_id).
-        # These are plucked off of a Werkzeug request as they come in from Kyoukai.
-        self.stream_data = collections.defaultdict(lambda *args: asyncio.Queue())
+        # The scheduler that decides which stream sends the next DATA frame.
+        self.scheduler = PriorityScheduler()
+
+        # The streams that have window of their own, but are waiting for the connection window
+        # to open.
+        self._window_waiters = set()
+
+        # The streams that have been given a priority before being opened, oldest first.
+        self._idle_streams = collections.deque()
+
+        # The task that sends DATA frames for every stream, and the event that wakes it up.
+        self.writer = None  # type: asyncio.Task
+        self._writable = asyncio.Event()
+
+        # Set while the transport can accept more data.
+        self._can_write = asyncio.Event()
+        self._can_write.set()
 
         # The current logger.
         self.logger = logging.getLogger("Kyoukai.HTTP2")
@@ -298,11 +587,16 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         # Client data.
         self.ip, self.client_port = None, None
 
-        # If we're waiting to send data due to the window being exceeded.
-        self._locked = collections.defaultdict(lambda *args: asyncio.Event())
+        # The number of resources that have been pushed on this connection, and the limit.
+        self.pushes = 0
+        self.max_pushes = component.cfg.get("http2_max_pushes", 100)
+
+        # If this connection is draining, i.e. refusing new streams and finishing the current ones.
+        self.draining = False
+        self._closed = False
 
-        # The dictionary of stream tasks.
-        self.stream_tasks = {}
+        # The scheduled call to flush, if any.
+        self._flush_handle = None  # type: asyncio.Handle
 
     def raw_write(self, data: bytes):
         """
@@ -315,8 +609,156 @@ class H2KyoukaiProtocol(asyncio.Protocol):
             # This probably means the client has disconnected.
             return None
 
+    def flush(self):
+        """
+        Writes everything the HTTP/2 state machine has to send to the transport, at once.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        data = self.conn.data_to_send()
+        if data:
+            self.raw_write(data)
+
+    def flush_soon(self):
+        """
+        Schedules a flush for the end of this iteration of the event loop.
+
+        Everything sent by the state machine until then is gathered into a single write, so that
+        a burst of small streams doesn't turn into a write for every frame.
+        """
+        if self._flush_handle is None and not self._closed:
+            self._flush_handle = self.component.app.loop.call_soon(self.flush)
+
     def connection_lost(self, exc):
         self.logger.debug("Connection lost from {}:{}".format(self.ip, self.client_port))
+        self._closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.component.connections.discard(self)
+
+        # Nobody is left to receive the responses, so stop processing every stream.
+        for stream_id in list(self.streams):
+            self.cancel_stream(stream_id)
+
+        if self.writer is not None:
+            self.writer.cancel()
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+    def cancel_stream(self, stream_id: int):
+        """
+        Cancels the processing of a stream, because the client reset it or disconnected.
+
+        The route is not cancelled if it asked to carry on running.
+
+        :param stream_id: The ID of the stream to cancel.
+        """
+        state = self.streams.get(stream_id)  # type: H2State
+        if state is None:
+            return
+
+        # The client won't send any more of the request.
+        state.discard()
+        state.finish()
+        if not (state.environ or {}).get("kyoukai.shield"):
+            state.task.cancel()
+
+        # There's nobody to send the response to either way.
+        state.response.cancel()
+        self.stop_sending(state)
+
+        if state.disconnected is not None and not state.disconnected.done():
+            state.disconnected.set_result(None)
+
+        self.release_stream(state)
+
+    def stop_sending(self, state: H2State):
+        """
+        Removes a stream from the writer, and closes its send buffer.
+        """
+        if state.buffer is not None:
+            state.buffer.close()
+            state.buffer = None
+
+        self.scheduler.remove(state.stream_id)
+        self._window_waiters.discard(state.stream_id)
+
+    def release_stream(self, state: H2State):
+        """
+        Frees the state of a stream, if it is complete.
+
+        A stream is complete once its response has been sent (or cancelled), and the route
+        processing it has finished.
+        """
+        if not state.task.done() or not state.response.done():
+            return
+
+        if self.streams.get(state.stream_id) is state:
+            del self.streams[state.stream_id]
+
+        state.discard()
+        self.stop_sending(state)
+
+    def wait_disconnected(self, environ: dict) -> asyncio.Future:
+        """
+        :param environ: The WSGI environment of the request.
+        :return: A future that is completed when the stream of the request is reset, or the \
+            client disconnects.
+        """
+        state = self.streams.get(environ["kyoukai.stream_id"])  # type: H2State
+        if state is None or self._closed or state.response.cancelled():
+            fut = self.component.app.loop.create_future()
+            fut.set_result(None)
+            return fut
+
+        if state.disconnected is None:
+            state.disconnected = self.component.app.loop.create_future()
+
+        return state.disconnected
+
+    @property
+    def in_flight(self) -> int:
+        """
+        :return: The number of streams on this connection that are still being processed.
+        """
+        return sum(1 for state in self.streams.values()
+                   if not state.task.done() or not state.response.done())
+
+    def drain(self):
+        """
+        Called by the component when the server is draining.
+
+        This sends a GOAWAY frame with the last stream ID that will be processed, so that the
+        client stops opening new streams. The connection is closed once every in-flight stream
+        has finished.
+        """
+        self.draining = True
+
+        # h2 considers the connection closed as soon as it sends a GOAWAY frame, which would stop
+        # the in-flight streams from being sent. Instead, we serialize the frame ourselves, after
+        # anything h2 has already buffered.
+        frame = GoAwayFrame(stream_id=0, last_stream_id=self.conn.highest_inbound_stream_id,
+                            error_code=ErrorCodes.NO_ERROR)
+        self.flush()
+        self.raw_write(frame.serialize())
+
+        if not self.in_flight:
+            self.close()
+
+    def cancel_requests(self):
+        """
+        Cancels every stream that is currently being processed on this connection.
+        """
+        for state in list(self.streams.values()):
+            state.task.cancel()
+            state.response.cancel()
 
     def connection_made(self, transport: asyncio.WriteTransport):
         """
@@ -326,15 +768,23 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         """
         # Set our own attributes, and update the HTTP/2 state machine.
         self.transport = transport
-        try:
-            self.ip, self.client_port = self.transport.get_extra_info("peername")
-            self.logger.debug("Connection received from {}:{}".format(self.ip, self.client_port))
-        except ValueError:
-            # Sometimes socket.socket.getpeername() isn't available, so it tried to unpack a None.
-            # Or, it returns None (wtf?)
-            # So just provide some fake values.
-            warnings.warn("getpeername() returned None, cannot provide transport information.")
-            self.ip, self.client_port = None, None
+        self.component.connections.add(self)
+        sock = self.transport.get_extra_info("socket")
+        if sock is not None and sock.family == getattr(socket, "AF_UNIX", None):
+            # Unix domain sockets don't have a peer address.
+            self.ip, self.client_port = "", None
+        else:
+            try:
+                # IPv6 addresses have two extra fields, which we don't need.
+                self.ip, self.client_port = self.transport.get_extra_info("peername")[:2]
+                self.logger.debug("Connection received from {}:{}".format(self.ip,
+                                                                          self.client_port))
+            except (ValueError, TypeError):
+                # Sometimes socket.socket.getpeername() isn't available, so it tried to unpack a
+                # None. Or, it returns None (wtf?)
+                # So just provide some fake values.
+                warnings.warn("getpeername() returned None, cannot provide transport information.")
+                self.ip, self.client_port = None, None
 
         # Ensure that we are talking to a HTTP/2 client.
         # If we're not, they're gonna get really confused when we send
@@ -362,8 +812,66 @@ class H2KyoukaiProtocol(asyncio.Protocol):
 
         # Send the HTTP2 preamble.
         self.logger.debug("Started the HTTP/2 connection.")
+        self.apply_settings()
         self.conn.initiate_connection()
-        self.raw_write(self.conn.data_to_send())
+        self.open_connection_window()
+        self.flush()
+
+        self.writer = self.component.app.loop.create_task(self.writer_loop())
+
+    def apply_settings(self):
+        """
+        Applies the HTTP/2 settings from the config of the component to the connection.
+
+        This must be called before the connection is initiated, so that the settings are sent in
+        the first SETTINGS frame. They are applied straight away, rather than once the client
+        acknowledges them, as clients often send frames that rely on them in the same packet as
+        the acknowledgement.
+        """
+        cfg = self.component.cfg
+        settings = {
+            SettingCodes.INITIAL_WINDOW_SIZE: cfg.get("http2_initial_window_size"),
+            SettingCodes.MAX_FRAME_SIZE: cfg.get("http2_max_frame_size"),
+            SettingCodes.MAX_CONCURRENT_STREAMS: cfg.get("http2_max_concurrent_streams"),
+            SettingCodes.MAX_HEADER_LIST_SIZE: cfg.get("http2_max_header_list_size"),
+            SettingCodes.HEADER_TABLE_SIZE: cfg.get("http2_header_table_size"),
+        }
+        settings = {code: value for (code, value) in settings.items() if value is not None}
+        if not settings:
+            return
+
+        initial = dict(self.conn.local_settings.items())
+        initial.update(settings)
+        self.conn.local_settings = Settings(client=False, initial_values=initial)
+
+        # Normally, h2 only updates these once the settings are acknowledged.
+        self.conn.max_inbound_frame_size = self.conn.local_settings.max_frame_size
+        self.conn.decoder.max_header_list_size = self.conn.local_settings.max_header_list_size
+        self.conn.decoder.max_allowed_table_size = self.conn.local_settings.header_table_size
+
+    def open_connection_window(self):
+        """
+        Opens the window of the connection up to the initial window size of the streams.
+
+        The connection window isn't changed by the initial window size setting, so without this a
+        single stream could never use its whole window.
+        """
+        window = self.conn.local_settings.initial_window_size
+        if window > DEFAULT_WINDOW_SIZE:
+            self.conn.increment_flow_control_window(window - DEFAULT_WINDOW_SIZE)
+
+    def acknowledge_data(self, stream_id: int, size: int):
+        """
+        Hands the space used by data that has been read back to the client.
+
+        :param stream_id: The ID of the stream the data was received on.
+        :param size: The number of bytes to acknowledge.
+        """
+        if self._closed:
+            return
+
+        self.conn.acknowledge_received_data(size, stream_id)
+        self.flush_soon()
 
     def data_received(self, data: bytes):
         """
@@ -375,8 +883,9 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         except ProtocolError:
             self.close(0x1)
             return
-        # Find any data we need to send to the client first.
-        self.transport.write(self.conn.data_to_send())
+        # Anything we need to send in reply, such as SETTINGS or PING acknowledgements, is sent
+        # along with any other frames produced in this iteration of the loop.
+        self.flush_soon()
 
         # Then, switch upon the events we've received from the HTTP/2 client.
         for event in events:
@@ -396,121 +905,439 @@ class H2KyoukaiProtocol(asyncio.Protocol):
             # This will unlock the event sender and continue sending data.
             elif isinstance(event, WindowUpdated):
                 self.window_opened(event)
-
-    def _processing_done(self, environ: dict, stream_id):
+            # The client has changed the priority of a stream.
+            elif isinstance(event, PriorityUpdated):
+                self.priority_updated(event)
+            # The client has given up on a stream.
+            elif isinstance(event, StreamReset):
+                self.stream_reset(event)
+            # The client has changed its settings, which can change the window of every stream.
+            elif isinstance(event, RemoteSettingsChanged):
+                self.settings_changed(event)
+
+    def _processing_done(self, state: H2State):
         """
         Callback for when processing is done on a request.
         """
 
         def _inner(fut: asyncio.Future):
-            result = fut.result()  # type: Response
+            if fut.cancelled() or state.response.done():
+                # The stream was cancelled or reset, or was shed, so there's nothing to send.
+                self.release_stream(state)
+                return
 
-            # Get the H2State for this request.
-            state = self.streams[stream_id]  # type: H2State
+            if fut.exception() is not None:
+                # Don't leave the client waiting for a response that will never come.
+                self.logger.error("Error processing HTTP/2 stream!", exc_info=fut.exception())
+                self.reset_stream(state.stream_id)
+                self.flush_soon()
+                return
 
-            # Get the app iterator.
-            it = result(environ, state.start_response)
-            headers = state.get_response_headers()
+            environ, result = fut.result()  # type: dict, Response
+            self.send_response(state, environ, result)
 
-            # Send the headers.
-            self.conn.send_headers(stream_id, headers, end_stream=False)
+        return _inner
 
-            # Place all the data from the app iterator on the queue.
-            for i in it:
-                self.stream_data[stream_id].put_nowait(i)
+    def send_response(self, state: H2State, environ: dict, result: Response):
+        """
+        Sends the headers of a response, and sets up its body to be sent by the writer loop.
 
-            # Add the sentinel value.
-            self.stream_data[stream_id].put_nowait(REQUEST_FINISHED)
+        :param state: The stream to respond on.
+        :param environ: The WSGI environment of the request.
+        :param result: The response to send.
+        """
+        stream_id = state.stream_id
 
-            # This will all be done with the sending task.
+        # Get the app iterator.
+        it = result(environ, state.start_response)
+        headers = state.get_response_headers()
 
-        return _inner
+        # Send the headers.
+        self.conn.send_headers(stream_id, headers, end_stream=False)
+
+        buffer = SendBuffer(self.buffer_size)
+        state.buffer = buffer
+
+        body = result.response
+        if hasattr(body, "__aiter__") and environ["REQUEST_METHOD"] != "HEAD":
+            # Async bodies are consumed by their own task.
+            loop = self.component.app.loop
+            buffer.producer = loop.create_task(self.produce(stream_id, buffer, body,
+                                                            result.charset))
+        else:
+            # The writer loop will pull from the iterator as the data is sent.
+            buffer.iterator = iter(it)
+            self.scheduler.unblock(stream_id)
+
+        self._writable.set()
+
+    async def produce(self, stream_id: int, buffer: SendBuffer, body, charset: str):
+        """
+        Consumes an asynchronous response body into the send buffer of a stream.
 
-    async def sending_loop(self, stream_id):
+        This waits whenever the buffer is full, so that a slow client doesn't cause the whole
+        body to be buffered in memory.
         """
-        This loop continues sending data to the client as it comes off of the queue.
+        try:
+            async for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+
+                buffer.write(chunk)
+                self.scheduler.unblock(stream_id)
+                self._writable.set()
+                await buffer.wait_for_space()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception("Error in HTTP/2 response body!")
+            buffer.producer = None
+            self.reset_stream(stream_id)
+            self._writable.set()
+            return
+
+        buffer.producer = None
+        buffer.finished = True
+        self.scheduler.unblock(stream_id)
+        self._writable.set()
+
+    def reset_stream(self, stream_id: int, error_code: int = ErrorCodes.INTERNAL_ERROR):
+        """
+        Resets a stream that cannot be completed, and cancels its processing.
+        """
+        self.conn.reset_stream(stream_id, error_code)
+        self.cancel_stream(stream_id)
+
+    async def writer_loop(self):
+        """
+        Sends the response data of every stream on this connection.
+
+        A single loop sends every DATA frame, so that streams are interleaved according to their
+        priority, rather than competing with each other to write.
         """
         while True:
-            self._locked[stream_id].clear()
-            data = await self.stream_data[stream_id].get()
+            # Cleared before the scheduler is checked, so that a stream woken while this waits
+            # for the transport is not missed.
+            self._writable.clear()
+
+            # Send a batch of frames, then give the event loop a chance to receive any window
+            # updates or resets before sending more. The whole batch is written at once.
+            sent = 0
+            stream_id = None
+            while sent < WRITE_BATCH_SIZE:
+                stream_id = self.scheduler.next()
+                if stream_id is None:
+                    break
+
+                sent += self.send_frame(stream_id)
+
+            self.flush()
+            await self._can_write.wait()
 
-            if data == REQUEST_FINISHED:
-                # The request is finished - terminate the stream.
+            if stream_id is None:
+                # Nothing can be sent, so wait for more data or window.
+                await self._writable.wait()
+            else:
+                await asyncio.sleep(0)
+
+    def send_frame(self, stream_id: int) -> int:
+        """
+        Sends the next DATA frame for a stream, or ends the stream if its response is complete.
+
+        The stream is blocked in the scheduler once it runs out of data or flow control window.
+
+        :param stream_id: The ID of the stream to send a frame for.
+        :return: The number of bytes of data sent.
+        """
+        buffer = self.streams[stream_id].buffer  # type: SendBuffer
+        frame_size = self.conn.max_outbound_frame_size
+        if buffer.iterator is not None and buffer.size < frame_size:
+            # Top the buffer up, so that full frames are sent.
+            try:
+                buffer.fill()
+            except Exception:
+                self.logger.exception("Error in HTTP/2 response body!")
+                self.reset_stream(stream_id)
+                return 0
+
+        if not buffer.chunks:
+            if buffer.finished:
+                # The response is finished - terminate the stream.
                 self.conn.end_stream(stream_id)
-                self.raw_write(self.conn.data_to_send())
-                # This stream is dead, now.
-                return
+                self.finish_stream(stream_id)
+            else:
+                # Wait for the producer to add more data.
+                self.scheduler.block(stream_id)
+            return 0
+
+        # This is the smaller of the stream and connection windows.
+        window = self.conn.local_flow_control_window(stream_id)
+        if window <= 0:
+            # Wait for a WINDOW_UPDATE. If the stream has window of its own, only an update to
+            # the connection window can unblock it.
+            self.scheduler.block(stream_id)
+            if self.conn.outbound_flow_control_window <= 0:
+                self._window_waiters.add(stream_id)
+            return 0
+
+        data = buffer.read(min(window, frame_size))
+        if buffer.finished and not buffer.chunks:
+            # This is the last of the response, so end the stream with this frame rather than an
+            # empty one.
+            self.conn.send_data(stream_id, data, end_stream=True)
+            self.finish_stream(stream_id)
+        else:
+            self.conn.send_data(stream_id, data)
 
-            # Buffer data - don't exceed the control flow window size.
-            window_size = self.conn.local_flow_control_window(stream_id)
-            chunk_size = min(window_size, len(data))
-            data_to_send = data[:chunk_size]
-            data_to_buffer = data[chunk_size:]
-
-            if data_to_send:
-                # Split it into chunks and send it out.
-                max_size = self.conn.max_outbound_frame_size
-                chunks = (
-                    data_to_send[x:x + max_size]
-                    for x in range(0, len(data_to_send), max_size)
-                )
-                for chunk in chunks:
-                    self.conn.send_data(stream_id, chunk)
-                self.raw_write(self.conn.data_to_send())
-
-            if data_to_buffer:
-                # Don't exceed flow window, set this data to be sent later.
-                # Put it back on the left of the deque, then wait for our event to be set.
-                self.stream_data[stream_id]._queue.appendleft(data)
-                await self._locked[stream_id].wait()
-                self._locked[stream_id].clear()
-                continue
+        return len(data)
+
+    def finish_stream(self, stream_id: int):
+        """
+        Called once the response for a stream has been completely sent.
+        """
+        state = self.streams[stream_id]  # type: H2State
+        if not state.ended:
+            # The response doesn't need the rest of the request, so tell the client to stop
+            # sending it. See RFC 7540, Section 8.1.
+            self.conn.reset_stream(stream_id, ErrorCodes.NO_ERROR)
+
+        state.response.set_result(None)
+        self.release_stream(state)
+
+    async def process_stream(self, state: 'H2State'):
+        """
+        Admits a stream through the limiter of the component, and then runs the app for it.
+
+        Streams that are shed are responded to with a ``503`` before any request processing is
+        done.
+
+        :return: A tuple of (environ, response), or None if the stream was shed.
+        """
+        stream_id = state.stream_id
+        app = self.component.app  # type: Kyoukai
+        loop = app.loop
+
+        limiter = self.component.limiter
+        if limiter is not None and not (limiter.try_acquire() or await limiter.acquire()):
+            self.conn.send_headers(stream_id, get_shed_headers(limiter.retry_after),
+                                   end_stream=True)
+            self.flush_soon()
+            state.response.set_result(None)
+            return None
+
+        start = loop.time()
+        try:
+            # Create the fake WSGI environment.
+            env = create_wsgi_environment(state)
+            state.environ = env
+            request = Request(environ=env)
+
+            result = await app.process_request(request, self.parent_context)
+        finally:
+            if limiter is not None:
+                limiter.release(loop.time() - start)
+
+        return env, result
 
     # H2 callbacks
     def request_received(self, event: RequestReceived):
         """
         Called when a request has been received.
         """
+        if self.draining:
+            # We've already told the client which streams will be processed, so refuse this one.
+            self.conn.reset_stream(event.stream_id, ErrorCodes.REFUSED_STREAM)
+            self.flush_soon()
+            return
+
+        if len(self.streams) >= self.conn.local_settings.max_concurrent_streams:
+            # h2 only counts the streams that are open, but routes can carry on running after
+            # their stream has been reset.
+            self.conn.reset_stream(event.stream_id, ErrorCodes.REFUSED_STREAM)
+            self.flush_soon()
+            return
+
+        # Streams have the default priority until we receive a PriorityUpdated event for them.
+        if event.stream_id not in self.scheduler:
+            self.scheduler.insert(event.stream_id)
+
+        self.open_stream(event.stream_id, event.headers)
+
+    def open_stream(self, stream_id: int, headers: list) -> H2State:
+        """
+        Creates the state for a new stream, and starts running the app for it.
+
+        :param stream_id: The ID of the stream.
+        :param headers: The request headers of the stream.
+        """
         # Create the RequestData that stores this event.
-        r = H2State(event.headers, event.stream_id, self)
-        self.streams[event.stream_id] = r
+        state = H2State(headers, stream_id, self)
+        self.streams[stream_id] = state
+
+        loop = self.component.app.loop
+        state.response = loop.create_future()
+        state.response.add_done_callback(self._stream_done)
 
         # Create the task that runs the app.
-        app = self.component.app  # type: Kyoukai
-        # Create the fake WSGI environment.
-        env = create_wsgi_environment(r)
-        request = Request(environ=env)
+        state.task = loop.create_task(self.process_stream(state))
+        state.task.add_done_callback(self._processing_done(state))
+        state.task.add_done_callback(self._stream_done)
+        return state
 
-        loop = app.loop
-        t = loop.create_task(app.process_request(request, self.parent_context))  # type: asyncio.Task
-        self.stream_tasks[event.stream_id] = loop.create_task(self.sending_loop(event.stream_id))
+    def push(self, environ: dict, path: str,
+             headers: typing.Iterable[typing.Tuple[str, str]] = ()) -> bool:
+        """
+        Pushes a resource to the client, as if the client had requested it with a GET request.
+
+        This sends a PUSH_PROMISE frame on the stream of the original request, then processes the
+        pushed request through the app on a new stream.
+
+        :param environ: The WSGI environment of the original request.
+        :param path: The path of the resource to push.
+        :param headers: Any extra headers for the pushed request.
+        :return: True if the resource is being pushed, or False if the client doesn't allow \
+            pushes, or too many resources have already been pushed on this connection.
+        """
+        parent = self.streams.get(environ["kyoukai.stream_id"])  # type: H2State
+        if parent is None or parent.response.done():
+            # Pushes can only be promised on a stream that is still open.
+            return False
+
+        if self._closed or self.draining or not self.conn.remote_settings.enable_push:
+            return False
+
+        if self.pushes >= self.max_pushes:
+            return False
+
+        authority = get_header(parent.headers, ":authority") or get_header(parent.headers, "host")
+        if authority is None:
+            return False
+
+        request_headers = [(":method", "GET"), (":scheme", get_header(parent.headers, ":scheme")),
+                           (":authority", authority), (":path", path)]
+        request_headers.extend((name.lower(), value) for (name, value) in headers)
+
+        stream_id = self.conn.get_next_available_stream_id()
+        try:
+            self.conn.push_stream(parent.stream_id, stream_id, request_headers)
+        except ProtocolError:
+            self.logger.debug("Couldn't push {} on stream {}".format(path, parent.stream_id))
+            return False
+
+        self.pushes += 1
+        self.flush_soon()
 
-        t.add_done_callback(self._processing_done(env, event.stream_id))
+        # Pushed streams depend on the stream they were promised on. See RFC 7540, Section 5.3.5.
+        self.scheduler.insert(stream_id, depends_on=parent.stream_id)
+
+        # Pushed requests don't have a body.
+        state = self.open_stream(stream_id, request_headers)
+        state.finish()
+        return True
+
+    def _stream_done(self, fut: asyncio.Future):
+        """
+        Callback for when a stream has been completely sent, or was cancelled.
+        """
+        if self.draining and not self.in_flight:
+            self.close()
+
+    def stream_reset(self, event: StreamReset):
+        """
+        Called when the client resets a stream.
+
+        This cancels the processing of the stream.
+        """
+        self.logger.debug("Stream {} was reset by the client.".format(event.stream_id))
+        self.cancel_stream(event.stream_id)
 
     def window_opened(self, event: WindowUpdated):
         """
         Called when a control flow window has opened again.
+
+        Only the streams that can now send data are woken up.
         """
         if event.stream_id:
-            # Set the lock on the event, which will cause the sending_loop to wake up.
-            self._locked[event.stream_id].set()
+            stream_ids = [event.stream_id]
         else:
-            # Unlock all events.
-            for ev in self._locked.keys():
-                ev.set()
+            # Only the streams that were waiting for the connection window can be unblocked.
+            stream_ids = list(self._window_waiters)
+            self._window_waiters.clear()
+
+        self.wake_streams(stream_ids)
+
+    def settings_changed(self, event: RemoteSettingsChanged):
+        """
+        Called when the client changes its settings.
+        """
+        if SettingCodes.INITIAL_WINDOW_SIZE in event.changed_settings:
+            # This changes the window of every open stream, by the same amount.
+            self.wake_streams(list(self.streams))
+
+    def wake_streams(self, stream_ids: typing.Iterable[int]):
+        """
+        Unblocks the streams that have data to send, and window to send it in.
+
+        :param stream_ids: The IDs of the streams to check.
+        """
+        woken = False
+        for stream_id in stream_ids:
+            state = self.streams.get(stream_id)
+            buffer = state.buffer if state is not None else None
+            if buffer is None or not buffer.ready:
+                continue
+
+            if self.conn.local_flow_control_window(stream_id) > 0:
+                self._window_waiters.discard(stream_id)
+                self.scheduler.unblock(stream_id)
+                woken = True
+            elif self.conn.outbound_flow_control_window <= 0:
+                self._window_waiters.add(stream_id)
+
+        if woken:
+            self._writable.set()
+
+    def priority_updated(self, event: PriorityUpdated):
+        """
+        Called when the client changes the priority of a stream.
+        """
+        stream_id = event.stream_id
+        if stream_id not in self.scheduler:
+            if stream_id <= self.conn.highest_inbound_stream_id:
+                # The stream has already been closed.
+                return
+
+            # Clients can prioritize streams that they never open, so only keep a limited number
+            # of them in the tree.
+            self._idle_streams.append(stream_id)
+            if len(self._idle_streams) > self.conn.local_settings.max_concurrent_streams:
+                idle = self._idle_streams.popleft()
+                if idle not in self.streams:
+                    self.scheduler.remove(idle)
+
+        self.scheduler.reprioritize(stream_id, event.depends_on, event.weight, event.exclusive)
 
     def receive_data(self, event: DataReceived):
         """
         Called when a request has data that has been received.
         """
+        state = self.streams.get(event.stream_id)  # type: H2State
+        if state is None:
+            # The stream has already been released, so nobody will read this data.
+            self.acknowledge_data(event.stream_id, event.flow_controlled_length)
+            return
+
         # Write into the RequestData for this event.
-        try:
-            req = self.streams[event.stream_id]
-        except KeyError:
-            # Reset the stream, because the client is stupid.
-            self.conn.reset_stream(event.stream_id, ErrorCodes.PROTOCOL_ERROR)
-        else:
-            req.insert_data(event.data)
+        state.insert_data(event.data)
+
+        # Padding is never read, so it is acknowledged straight away.
+        padding = event.flow_controlled_length - len(event.data)
+        if padding:
+            self.acknowledge_data(event.stream_id, padding)
+
+        if state.response.done():
+            # The response has already been sent, so nobody will read this data.
+            state.discard()
 
     def stream_complete(self, event: StreamEnded):
         """
@@ -518,14 +1345,9 @@ class H2KyoukaiProtocol(asyncio.Protocol):
 
         This will invoke Kyoukai, which will handle the request.
         """
-        try:
-            req = self.streams[event.stream_id]
-        except KeyError:
-            # shoo
-            self.conn.reset_stream(event.stream_id, ErrorCodes.PROTOCOL_ERROR)
-            return
-        else:
-            req.insert_data(REQUEST_FINISHED)
+        state = self.streams.get(event.stream_id)  # type: H2State
+        if state is not None:
+            state.finish()
 
     def close(self, error_code: int=0):
         """
@@ -535,6 +1357,6 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         """
         # Send a GOAWAY frame.
         self.conn.close_connection(error_code)
-        self.raw_write(self.conn.data_to_send())
+        self.flush()
 
         self.transport.close()
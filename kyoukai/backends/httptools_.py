@@ -4,8 +4,11 @@ A high-performance HTTP/1.1 backend for the Kyoukai webserver using `httptools
 """
 import asyncio
 import base64
+import functools
 import logging
+import socket
 import traceback
+import typing
 import warnings
 from io import BytesIO
 
@@ -40,8 +43,31 @@ Content-Length: 0
 
 """.replace("\n", "\r\n")
 
+SERVICE_UNAVAILABLE_TEXT = """HTTP/1.1 503 SERVICE UNAVAILABLE
+Server: Kyoukai
+X-Powered-By: Kyoukai
+Retry-After: {retry_after}
+Content-Type: text/plain; charset=utf-8
+Content-Length: 19
+
+Service Unavailable""".replace("\n", "\r\n")
+
 PROTOCOL_CLASS = "KyoukaiProtocol"
 
+# The first bytes sent by a HTTP/2 client that connects with prior knowledge.
+# See RFC 7540, Section 3.5.
+HTTP2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+
+@functools.lru_cache()
+def get_shed_response(retry_after: int) -> bytes:
+    """
+    Gets the pre-serialized response that is sent to requests shed by the limiter.
+
+    :param retry_after: The value of the ``Retry-After`` header.
+    """
+    return SERVICE_UNAVAILABLE_TEXT.format(retry_after=retry_after).encode()
+
 
 class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
     """
@@ -76,13 +102,25 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         # This is created per connection, and uses our own class.
         self.parser = httptools.HttpRequestParser(self)
 
-        # A waiter that 'waits' on the event to clear.
-        # Once the wait is over, it then delegates the request to the app.
-        self.waiter = None  # type: asyncio.Task
+        # The tasks processing the requests received on this connection, and the WSGI environment
+        # of each request. Pipelined requests each have their own task, which waits on the lock.
+        self.waiters = {}  # type: typing.Dict[asyncio.Task, dict]
+
+        # The number of requests received on this connection that haven't been responded to yet.
+        self._in_flight = 0
+
+        # The future that is completed when the client disconnects.
+        # This is only created if a route waits for it.
+        self._disconnected = None  # type: asyncio.Future
+        self._closed = False
 
         # The IP and port of the client.
         self.ip, self.client_port = None, None
 
+        # The data received at the start of the connection, while checking if the client is
+        # talking HTTP/2 with prior knowledge. This is None once we know that it isn't.
+        self._preface = b"" if component.cfg.get("http2", False) else None
+
         # Intermediary data storage.
         # This is a list because headers are appended as (Name, Value) pairs.
         # In HTTP/1.1, there can be multiple headers with the same name but different values.
@@ -99,13 +137,13 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         """
         # Copy the properties we need.
         component = self.component
-        app = component.app
+        parent_context = self.parent_context
         # Goodbye, ourselves!
         self.__class__ = other
 
         # Hello, not ourselves!
         # Call the new __init__.
-        other.__init__(self, component, app, *args, **kwargs)
+        other.__init__(self, component, parent_context, *args, **kwargs)
 
         return self
 
@@ -151,8 +189,44 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         Called when a message is complete.
         This creates the worker task which will begin processing the request.
         """
-        task = self.loop.create_task(self._wait_wrapper())
-        self.waiter = task
+        self._in_flight += 1
+        # Build the environment now, as the parser moves on to any pipelined request before this
+        # request is processed.
+        environ = self.create_environ()
+        keep_alive = self.parser.should_keep_alive()
+        task = self.loop.create_task(self._wait_wrapper(environ, keep_alive))
+        task.add_done_callback(self._forget_waiter)
+        self.waiters[task] = environ
+
+    def _forget_waiter(self, task: asyncio.Task):
+        self.waiters.pop(task, None)
+
+    def create_environ(self) -> dict:
+        """
+        Creates the WSGI environment for the message that has just been received.
+        """
+        # Check if the body has data in it by asking it to tell us what position it's seeked to.
+        # If it's > 0, it has data, so we can use it. Otherwise, it doesn't, so it's useless.
+        told = self.body.tell()
+        if told:
+            self.logger.debug("Read {} bytes of data from the connection".format(told))
+            self.body.seek(0)
+            body = self.body
+        else:
+            body = None
+
+        version = self.parser.get_http_version()
+        method = self.parser.get_method().decode()
+
+        environ = to_wsgi_environment(headers=self.headers, method=method, path=self.full_url,
+                                      http_version=version, body=body)
+
+        environ["kyoukai.protocol"] = self
+        environ["SERVER_NAME"] = self.component.get_server_name()
+        environ["SERVER_PORT"] = str(self.server_port)
+        environ["REMOTE_ADDR"] = self.ip
+        environ["REMOTE_PORT"] = self.client_port
+        return environ
 
     # asyncio procs
     def connection_made(self, transport: asyncio.WriteTransport):
@@ -161,17 +235,25 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
 
         :param transport: The transport this is using.
         """
-        try:
-            self.ip, self.client_port = transport.get_extra_info("peername")
-            self.logger.debug("Connection received from {}:{}".format(self.ip, self.client_port))
-        except ValueError:
-            # Sometimes socket.socket.getpeername() isn't available, so it tried to unpack a None.
-            # Or, it returns None (wtf?)
-            # So just provide some fake values.
-            warnings.warn("getpeername() returned None, cannot provide transport information.")
-            self.ip, self.client_port = None, None
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family == getattr(socket, "AF_UNIX", None):
+            # Unix domain sockets don't have a peer address.
+            self.ip, self.client_port = "", None
+        else:
+            try:
+                # IPv6 addresses have two extra fields, which we don't need.
+                self.ip, self.client_port = transport.get_extra_info("peername")[:2]
+                self.logger.debug("Connection received from {}:{}".format(self.ip,
+                                                                          self.client_port))
+            except (ValueError, TypeError):
+                # Sometimes socket.socket.getpeername() isn't available, so it tried to unpack a
+                # None. Or, it returns None (wtf?)
+                # So just provide some fake values.
+                warnings.warn("getpeername() returned None, cannot provide transport information.")
+                self.ip, self.client_port = None, None
 
         self.transport = transport
+        self.component.connections.add(self)
 
         ssl_sock = self.transport.get_extra_info("ssl_object")
         if ssl_sock is not None:
@@ -193,12 +275,79 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
 
     def connection_lost(self, exc):
         self.logger.debug("Connection lost from {}:{}".format(self.ip, self.client_port))
+        self._closed = True
+        self.component.connections.discard(self)
+
+        # Nobody is left to receive the responses, so stop processing every request on this
+        # connection, unless the route asked to carry on.
+        for task, environ in list(self.waiters.items()):
+            if not environ.get("kyoukai.shield"):
+                task.cancel()
+
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(None)
+
         self.component.connection_lost.dispatch(protocol=self)
 
+    def wait_disconnected(self, environ: dict) -> asyncio.Future:
+        """
+        :param environ: The WSGI environment of the request.
+        :return: A future that is completed when the client disconnects.
+        """
+        if self._disconnected is None:
+            self._disconnected = self.loop.create_future()
+            if self._closed:
+                self._disconnected.set_result(None)
+
+        return self._disconnected
+
+    @property
+    def in_flight(self) -> int:
+        """
+        :return: The number of requests on this connection that are still being processed.
+        """
+        return self._in_flight
+
+    def drain(self):
+        """
+        Called by the component when the server is draining.
+
+        Idle connections are closed immediately. Otherwise, the response to the current request
+        is sent with ``Connection: close``, and the connection is closed afterwards.
+        """
+        if not self._in_flight:
+            self.close()
+
+    def cancel_requests(self):
+        """
+        Cancels every request that is being processed on this connection.
+        """
+        for task in list(self.waiters):
+            task.cancel()
+
     def data_received(self, data: bytes):
         """
         Called when data is received into the connection.
         """
+        if self._preface is not None:
+            # Check if the client is talking HTTP/2 with prior knowledge, which starts with a
+            # preface that httptools would reject.
+            data = self._preface + data
+            if len(data) < len(HTTP2_PREFACE) and HTTP2_PREFACE.startswith(data):
+                # Not enough data to tell yet.
+                self._preface = data
+                return
+
+            self._preface = None
+            if data.startswith(HTTP2_PREFACE):
+                self.logger.debug("Switching to HTTP/2 with prior knowledge.")
+                transport = self.transport
+                new_self = self.replace(H2KyoukaiProtocol)  # type: H2KyoukaiProtocol
+                type(new_self).connection_made(new_self, transport)
+                # The preface (and anything after it) is handled by the HTTP/2 state machine.
+                type(new_self).data_received(new_self, data)
+                return
+
         # Feed it into the parser, and handle any errors that might happen.
         try:
             self.parser.feed_data(data)
@@ -300,76 +449,95 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         self.parser = httptools.HttpRequestParser(self)
         self.close()
 
-    async def _wait_wrapper(self):
+    async def _wait_wrapper(self, environ: dict, keep_alive: bool):
         try:
             if hasattr(self, "_wait"):
-                await self._wait()
+                await self._wait(environ, keep_alive)
             else:
                 return
+        except asyncio.CancelledError:
+            # The client disconnected, or the server is shutting down.
+            self.logger.debug("Request from {}:{} was cancelled.".format(self.ip, self.client_port))
         except:
             self.logger.critical("Error in Kyoukai's HTTP handling!")
             traceback.print_exc()
             self._raw_write(CRITICAL_ERROR_TEXT.encode())
             self.close()
         finally:
-            # we might have change protocol by now.
-            # if so, don't try and cancel the non-existant thing.
-            if hasattr(self, "waiter"):
-                self.waiter.cancel()
-                self.waiter = None
-                self.parser = httptools.HttpRequestParser(self)
+            self._in_flight -= 1
 
-    async def _wait(self):
+    async def _wait(self, environ: dict, keep_alive: bool):
         """
-        The main core of the protocol.
+        Admits the request through the limiter of the component, if there is one.
 
-        This constructs a new Werkzeug request from the headers.
+        Requests that are shed are responded to with a ``503`` before any request processing is
+        done. The lock is taken before the request is admitted, so that the responses to
+        pipelined requests, including shed ones, are written in the order the requests arrived.
         """
-        # Event is set, construct the new fake WSGI environment
+        async with self.lock:
+            limiter = self.component.limiter
+            if limiter is None:
+                return await self._handle_request(environ, keep_alive)
 
-        # Check if the body has data in it by asking it to tell us what position it's seeked to.
-        # If it's > 0, it has data, so we can use it. Otherwise, it doesn't, so it's useless.
-        told = self.body.tell()
-        if told:
-            self.logger.debug("Read {} bytes of data from the connection".format(told))
-            self.body.seek(0)
-            body = self.body
-        else:
-            body = None
+            if not (limiter.try_acquire() or await limiter.acquire()):
+                self.raw_write(get_shed_response(limiter.retry_after))
+                if not keep_alive or self.component.draining:
+                    self.close()
+                return
 
-        version = self.parser.get_http_version()
-        method = self.parser.get_method().decode()
+            start = self.loop.time()
+            try:
+                await self._handle_request(environ, keep_alive)
+            finally:
+                limiter.release(self.loop.time() - start)
 
-        new_environ = to_wsgi_environment(headers=self.headers, method=method, path=self.full_url,
-                                          http_version=version, body=body)
+    async def _handle_request(self, environ: dict, keep_alive: bool):
+        """
+        The main core of the protocol.
 
-        new_environ["kyoukai.protocol"] = self
-        new_environ["SERVER_NAME"] = self.component.get_server_name()
-        new_environ["SERVER_PORT"] = str(self.server_port)
-        new_environ["REMOTE_ADDR"] = self.ip
-        new_environ["REMOTE_PORT"] = self.client_port
+        This constructs a new Werkzeug request from the WSGI environment, and passes it to the
+        app. This is called with the lock held.
 
+        :param environ: The WSGI environment of the request.
+        :param keep_alive: If the connection should be kept open after the response.
+        """
         # Construct a Request object.
-        new_r = self.app.request_class(new_environ, False)
+        new_r = self.app.request_class(environ, False)
 
         # Invoke the app.
-        async with self.lock:
-            try:
-                result = await self.app.process_request(new_r, self.parent_context)
-            except Exception:
-                # not good!
-                # write the scary exception text
-                self.logger.exception("Error in Kyoukai request handling!")
-                self._raw_write(CRITICAL_ERROR_TEXT.encode("utf-8"))
-                return
-            else:
-                # Write the response.
-                self.write_response(result, new_environ)
-            finally:
-                if not self.parser.should_keep_alive():
-                    self.close()
-                # unlock the event and remove the waiter
-                self.parser = httptools.HttpRequestParser(self)
+        try:
+            result = await self.app.process_request(new_r, self.parent_context)
+
+            if result.is_streamed:
+                # HTTP/1.1 responses are written in one go, with a Content-Length, so read the
+                # whole body first.
+                chunks = []
+                if hasattr(result.response, "__aiter__"):
+                    async for chunk in result.response:
+                        chunks.append(chunk)
+                else:
+                    chunks.extend(result.response)
+
+                result.set_data(b"".join(chunk.encode(result.charset) if isinstance(chunk, str)
+                                         else chunk for chunk in chunks))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # not good!
+            # write the scary exception text
+            self.logger.exception("Error in Kyoukai request handling!")
+            self._raw_write(CRITICAL_ERROR_TEXT.encode("utf-8"))
+            return
+        else:
+            # Tell the client not to send any more requests if we're shutting down.
+            if self.component.draining:
+                result.headers["Connection"] = "close"
+
+            # Write the response.
+            self.write_response(result, environ)
+        finally:
+            if not keep_alive or self.component.draining:
+                self.close()
 
     # transport methods
     def close(self):
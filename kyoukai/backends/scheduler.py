@@ -0,0 +1,226 @@
+"""
+A HTTP/2 stream scheduler, which decides which stream on a connection sends the next DATA frame.
+
+This implements the stream dependency tree from `RFC 7540, Section 5.3
+<https://tools.ietf.org/html/rfc7540#section-5.3>`_. A stream only sends data when none of its
+ancestors in the tree can; siblings share the connection in proportion to their weights, using
+stride scheduling.
+"""
+import typing
+
+#: The default weight of a stream.
+DEFAULT_WEIGHT = 16
+
+# The virtual time that a stream of weight 1 advances by every time it is picked.
+STRIDE = 256 * 256
+
+
+class _Node(object):
+    """
+    A node in the stream dependency tree.
+    """
+    __slots__ = ("stream_id", "parent", "children", "weight", "ready", "ready_descendants",
+                 "vtime", "vclock")
+
+    def __init__(self, stream_id: int, weight: int = DEFAULT_WEIGHT):
+        self.stream_id = stream_id
+        self.parent = None  # type: _Node
+        self.children = []  # type: typing.List[_Node]
+        self.weight = weight
+
+        # If this stream has data to send, and window to send it in.
+        self.ready = False
+
+        # The number of streams below this one that are ready.
+        self.ready_descendants = 0
+
+        # The virtual time of this stream, relative to its siblings.
+        self.vtime = 0
+
+        # The virtual time of the last child that was picked.
+        self.vclock = 0
+
+    @property
+    def active(self) -> bool:
+        return self.ready or self.ready_descendants > 0
+
+
+class PriorityScheduler(object):
+    """
+    Schedules the streams of a HTTP/2 connection according to their priority.
+
+    Every stream starts out *blocked*. Streams are unblocked when they have data to send, and
+    blocked again when they run out of data or flow control window.
+    """
+
+    def __init__(self):
+        self._root = _Node(0, weight=1)
+        self._nodes = {0: self._root}
+
+    def __contains__(self, stream_id: int) -> bool:
+        return stream_id in self._nodes
+
+    def __len__(self) -> int:
+        # Don't count the root.
+        return len(self._nodes) - 1
+
+    def _update_ready(self, node: _Node, delta: int):
+        parent = node.parent
+        while parent is not None:
+            parent.ready_descendants += delta
+            parent = parent.parent
+
+    def _ready_count(self, node: _Node) -> int:
+        return node.ready_descendants + (1 if node.ready else 0)
+
+    def _attach(self, node: _Node, parent: _Node, exclusive: bool):
+        if exclusive:
+            # The new node adopts every existing child of the parent.
+            for child in parent.children:
+                child.parent = node
+                node.children.append(child)
+                node.ready_descendants += self._ready_count(child)
+
+            parent.children = []
+
+        node.parent = parent
+        # Don't let a newly active stream catch up on the time it spent idle.
+        node.vtime = max(node.vtime, parent.vclock)
+        parent.children.append(node)
+        self._update_ready(node, self._ready_count(node))
+
+    def _detach(self, node: _Node):
+        self._update_ready(node, -self._ready_count(node))
+        node.parent.children.remove(node)
+        node.parent = None
+
+    def insert(self, stream_id: int, depends_on: int = 0, weight: int = DEFAULT_WEIGHT,
+               exclusive: bool = False):
+        """
+        Adds a new stream to the tree.
+
+        If the stream is already in the tree (for example, because a PRIORITY frame was received
+        for it before it was opened), it is reprioritized instead.
+
+        :param stream_id: The ID of the stream to add.
+        :param depends_on: The ID of the stream that this stream depends on.
+        :param weight: The weight of this stream, between 1 and 256.
+        :param exclusive: If this stream is an exclusive dependency of its parent.
+        """
+        if stream_id in self._nodes:
+            self.reprioritize(stream_id, depends_on, weight, exclusive)
+            return
+
+        # A dependency on a stream we don't know about gets the default priority.
+        parent = self._nodes.get(depends_on)
+        if parent is None:
+            parent, weight, exclusive = self._root, DEFAULT_WEIGHT, False
+
+        node = _Node(stream_id, weight)
+        self._nodes[stream_id] = node
+        self._attach(node, parent, exclusive)
+
+    def reprioritize(self, stream_id: int, depends_on: int = 0, weight: int = DEFAULT_WEIGHT,
+                     exclusive: bool = False):
+        """
+        Changes the priority of a stream.
+
+        :param stream_id: The ID of the stream to reprioritize.
+        :param depends_on: The ID of the stream that this stream now depends on.
+        :param weight: The new weight of this stream.
+        :param exclusive: If this stream is an exclusive dependency of its new parent.
+        """
+        node = self._nodes.get(stream_id)
+        if node is None:
+            self.insert(stream_id, depends_on, weight, exclusive)
+            return
+
+        parent = self._nodes.get(depends_on)
+        if parent is None or parent is node:
+            parent, weight, exclusive = self._root, DEFAULT_WEIGHT, False
+
+        # If the new parent depends on this stream, it is moved up to take our place first.
+        # See RFC 7540, Section 5.3.3.
+        ancestor = parent.parent
+        while ancestor is not None and ancestor is not node:
+            ancestor = ancestor.parent
+
+        if ancestor is node:
+            old_parent = node.parent
+            self._detach(parent)
+            self._attach(parent, old_parent, False)
+
+        self._detach(node)
+        node.weight = weight
+        self._attach(node, parent, exclusive)
+
+    def remove(self, stream_id: int):
+        """
+        Removes a stream from the tree. The children of the stream are moved to its parent.
+
+        :param stream_id: The ID of the stream to remove.
+        """
+        node = self._nodes.pop(stream_id, None)
+        if node is None:
+            return
+
+        parent = node.parent
+        self._detach(node)
+        for child in list(node.children):
+            node.ready_descendants -= self._ready_count(child)
+            child.parent = None
+            self._attach(child, parent, False)
+
+        node.children = []
+
+    def block(self, stream_id: int):
+        """
+        Marks a stream as not being able to send data.
+        """
+        node = self._nodes.get(stream_id)
+        if node is not None and node.ready:
+            node.ready = False
+            self._update_ready(node, -1)
+
+    def unblock(self, stream_id: int):
+        """
+        Marks a stream as being able to send data.
+        """
+        node = self._nodes.get(stream_id)
+        if node is None or node.ready:
+            return
+
+        # Don't let a stream (or any of its ancestors) that was idle until now catch up on the
+        # time it spent idle.
+        current = node
+        while current.parent is not None and not current.active:
+            current.vtime = max(current.vtime, current.parent.vclock)
+            current = current.parent
+
+        node.ready = True
+        self._update_ready(node, 1)
+
+    def next(self) -> int:
+        """
+        Picks the next stream that should send a frame.
+
+        :return: The ID of the stream, or None if no stream is ready.
+        """
+        node = self._root
+        while True:
+            if node is not self._root and node.ready:
+                return node.stream_id
+
+            best = None
+            for child in node.children:
+                if child.active and (best is None or child.vtime < best.vtime):
+                    best = child
+
+            if best is None:
+                return None
+
+            # Advance the picked child by its stride, so that siblings are picked in proportion
+            # to their weights.
+            node.vclock = best.vtime
+            best.vtime += STRIDE // best.weight
+            node = best
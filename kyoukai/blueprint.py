@@ -27,7 +27,8 @@ class Blueprint(object):
 
     def __init__(self, name: str, parent: 'Blueprint' = None,
                  prefix: str = "", *,
-                 host_matching: bool = False, host: str = None):
+                 host_matching: bool = False, host: str = None, limiter=None,
+                 executor: str = None, cache=None, etag: bool = None, compress=None):
         """
         :param name: The name of this Blueprint.
             This is used when generating endpoints in the finalize stage.
@@ -45,6 +46,22 @@ class Blueprint(object):
             
         :param host: The host of the Blueprint. Used for custom subdomain routing.
             If this is None, then this Blueprint will be used for all hosts.
+
+        :param limiter: The :class:`~.ConcurrencyLimiter` for the routes in this Blueprint.
+            This is inherited from parents, and is checked after routing.
+
+        :param executor: The executor to run the synchronous routes in this Blueprint in, such \
+            as ``"thread"``. This is inherited from parents. See :mod:`kyoukai.executor`.
+
+        :param cache: The :class:`~.ResponseCache` for the routes in this Blueprint.
+            This is inherited from parents. See :mod:`kyoukai.cache`.
+
+        :param etag: If ETags should be added to the responses of the routes in this Blueprint.
+            This is inherited from parents. See :mod:`kyoukai.conditional`.
+
+        :param compress: If the responses of the routes in this Blueprint should be compressed. \
+            This can be True, or a :class:`~.Compressor`. This is inherited from parents. See \
+            :mod:`kyoukai.compression`.
         """
         #: The name of this Blueprint.
         self.name = name
@@ -80,6 +97,21 @@ class Blueprint(object):
         self._host = host
         self._host_matching = host_matching or self._host is not None
 
+        #: The limiter for this Blueprint.
+        self._limiter = limiter
+
+        #: The executor for this Blueprint.
+        self._executor = executor
+
+        #: The response cache for this Blueprint.
+        self._cache = cache
+
+        #: If ETags are enabled for this Blueprint, or None to inherit it.
+        self._etag = etag
+
+        #: The compression setting for this Blueprint, or None to inherit it.
+        self._compress = compress
+
     @property
     def parent(self) -> "Blueprint":
         """
@@ -135,6 +167,72 @@ class Blueprint(object):
 
         return self._host
 
+    @property
+    def limiter(self):
+        """
+        :return: The :class:`~.ConcurrencyLimiter` for this Blueprint, or the limiter of any \
+            parent Blueprint.
+
+        .. versionadded:: 2.2.0
+        """
+        if self._parent:
+            return self._limiter or self.parent.limiter
+
+        return self._limiter
+
+    @property
+    def executor(self) -> str:
+        """
+        :return: The name of the executor for the routes in this Blueprint, or the executor of \
+            any parent Blueprint.
+
+        .. versionadded:: 2.2.0
+        """
+        if self._parent:
+            return self._executor or self.parent.executor
+
+        return self._executor
+
+    @property
+    def cache(self):
+        """
+        :return: The :class:`~.ResponseCache` for the routes in this Blueprint, or the cache of \
+            any parent Blueprint.
+
+        .. versionadded:: 2.2.0
+        """
+        if self._parent:
+            # An empty cache is falsey, so this can't use ``or``.
+            return self._cache if self._cache is not None else self.parent.cache
+
+        return self._cache
+
+    @property
+    def etag(self) -> bool:
+        """
+        :return: If ETags are enabled for the routes in this Blueprint, or for any parent \
+            Blueprint.
+
+        .. versionadded:: 2.2.0
+        """
+        if self._etag is None and self._parent:
+            return self.parent.etag
+
+        return self._etag
+
+    @property
+    def compress(self):
+        """
+        :return: True or the :class:`~.Compressor` if the routes in this Blueprint are \
+            compressed, or the setting of any parent Blueprint.
+
+        .. versionadded:: 2.2.0
+        """
+        if self._compress is None and self._parent:
+            return self.parent.compress
+
+        return self._compress
+
     def get_submount(self) -> Submount:
         """
         Gets the :class:`werkzeug.routing.Submount` for this Blueprint.
@@ -0,0 +1,249 @@
+"""
+An in-process cache of complete responses.
+
+A :class:`ResponseCache` can be attached to a :class:`~.Route` or a :class:`~.Blueprint`. Once a
+route has responded to a ``GET`` request, its response is stored, and identical requests are
+answered from the cache, without running the route or its hooks, until the response expires.
+
+.. currentmodule:: kyoukai.cache
+"""
+import collections
+import time
+import typing
+
+from werkzeug.datastructures import Headers
+from werkzeug.wrappers import Request, Response
+
+#: The status codes of responses that can be cached.
+CACHEABLE_STATUS = frozenset((200, 203, 204, 300, 301, 404, 405, 410, 414, 501))
+
+#: The request headers that mark a request as belonging to a single user.
+CREDENTIAL_HEADERS = ("Authorization", "Cookie")
+
+
+class CachedResponse(object):
+    """
+    A response stored in a :class:`.ResponseCache`.
+    """
+    __slots__ = ("data", "status", "headers", "created", "expires", "shared", "size")
+
+    def __init__(self, data: bytes, status: str, headers: list, created: float, expires: float,
+                 shared: bool = False):
+        self.data = data
+        self.status = status
+        self.headers = headers
+        self.created = created
+        self.expires = expires
+
+        #: If this response can be used for requests with credentials.
+        self.shared = shared
+
+        #: The number of bytes this response takes up in the cache.
+        self.size = len(data) + sum(len(name) + len(value) for name, value in headers)
+
+    def to_response(self, response_class, now: float) -> Response:
+        """
+        Creates a new response from this cached response.
+        """
+        headers = Headers(self.headers)
+        headers["Age"] = str(int(now - self.created))
+        return response_class(self.data, status=self.status, headers=headers)
+
+
+class ResponseCache(object):
+    """
+    Caches complete responses, keyed on the host, path and query string of the request, and the
+    request headers named in the ``Vary`` header of the response.
+
+    How long a response is cached for is set by the ``Cache-Control`` header of the response:
+    ``s-maxage`` or ``max-age`` set the lifetime, and ``no-store``, ``no-cache`` or ``private``
+    stop the response from being cached. Responses without a lifetime use ``default_ttl``.
+
+    As the cache is shared between every user, responses that set a cookie are never cached.
+    Requests with an ``Authorization`` or ``Cookie`` header are only cached, or answered from the
+    cache, if the response is explicitly marked ``public`` or has an ``s-maxage``.
+
+    The cache is bounded by the total size of the responses held in it. When it is full, the least
+    recently used responses are removed.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, *, default_ttl: float = None,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        """
+        :param max_bytes: The maximum total size of the responses held in the cache.
+        :param default_ttl: The number of seconds to cache responses without a ``max-age`` for. \
+            If this is None, these responses are not cached.
+
+        :param clock: The clock to read the time from.
+        """
+        #: The maximum total size of the responses held in the cache.
+        self.max_bytes = max_bytes
+
+        #: The number of seconds to cache responses that do not set their own lifetime for.
+        self.default_ttl = default_ttl
+
+        self.clock = clock
+
+        #: The number of requests answered from the cache.
+        self.hits = 0
+
+        #: The number of requests that could not be answered from the cache.
+        self.misses = 0
+
+        #: The total size of the responses held in the cache.
+        self.bytes = 0
+
+        # The names of the Vary headers of the last response stored for each URL, and the number
+        # of responses stored for that URL.
+        self._urls = {}  # type: typing.Dict[tuple, list]
+        self._entries = collections.OrderedDict()  # type: typing.Dict[tuple, CachedResponse]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        """
+        :return: The fraction of lookups that were answered from the cache.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def get_url_key(request: Request) -> tuple:
+        """
+        :return: The part of the key of a request that does not depend on ``Vary``.
+        """
+        return request.host, request.path, request.environ.get("QUERY_STRING", "")
+
+    def _get_key(self, request: Request, url_key: tuple, vary: tuple) -> tuple:
+        return url_key, tuple(request.headers.get(name) for name in vary)
+
+    @staticmethod
+    def has_credentials(request: Request) -> bool:
+        """
+        :return: If the request carries the credentials of a user.
+        """
+        return any(name in request.headers for name in CREDENTIAL_HEADERS)
+
+    @staticmethod
+    def is_shared(response: Response) -> bool:
+        """
+        :return: If the response can be cached for requests with credentials.
+        """
+        cache_control = response.cache_control
+        return bool(cache_control.public) or cache_control.s_maxage is not None
+
+    def get(self, request: Request, response_class=Response) -> typing.Union[Response, None]:
+        """
+        Gets the cached response for a request.
+
+        :param request: The request to look up.
+        :param response_class: The class of response to create.
+        :return: A new response, or None if the request is not cached.
+        """
+        url_key = self.get_url_key(request)
+        url = self._urls.get(url_key)
+        entry = None
+        if url is not None:
+            key = self._get_key(request, url_key, url[0])
+            entry = self._entries.get(key)
+
+        now = self.clock()
+        if entry is not None and entry.expires <= now:
+            self._remove(key)
+            entry = None
+
+        if entry is not None and not entry.shared and self.has_credentials(request):
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry.to_response(response_class, now)
+
+    def get_ttl(self, response: Response) -> typing.Union[float, None]:
+        """
+        Gets the number of seconds to cache a response for.
+
+        :return: The lifetime of the response, or None if it must not be cached.
+        """
+        if response.status_code not in CACHEABLE_STATUS or response.is_streamed:
+            return None
+
+        if "Set-Cookie" in response.headers:
+            return None
+
+        cache_control = response.cache_control
+        if cache_control.no_store or cache_control.no_cache or cache_control.private:
+            return None
+
+        if cache_control.s_maxage is not None:
+            return int(cache_control.s_maxage)
+
+        if cache_control.max_age is not None:
+            return cache_control.max_age
+
+        return self.default_ttl
+
+    def put(self, request: Request, response: Response) -> bool:
+        """
+        Stores the response to a request, if it can be cached.
+
+        :return: True if the response was stored.
+        """
+        ttl = self.get_ttl(response)
+        if not ttl or ttl <= 0:
+            return False
+
+        shared = self.is_shared(response)
+        if not shared and self.has_credentials(request):
+            return False
+
+        vary = tuple(sorted(name.strip().lower() for name in response.vary))
+        if "*" in vary:
+            return False
+
+        now = self.clock()
+        headers = [(name, value) for name, value in response.headers if name.lower() != "age"]
+        entry = CachedResponse(response.get_data(), response.status, headers, now, now + ttl,
+                               shared)
+        if entry.size > self.max_bytes:
+            return False
+
+        url_key = self.get_url_key(request)
+        key = self._get_key(request, url_key, vary)
+        self._remove(key)
+
+        url = self._urls.setdefault(url_key, [vary, 0])
+        url[0] = vary
+        url[1] += 1
+        self._entries[key] = entry
+        self.bytes += entry.size
+
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+        return True
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        self.bytes -= entry.size
+        url = self._urls[key[0]]
+        url[1] -= 1
+        if not url[1]:
+            del self._urls[key[0]]
+
+    def clear(self):
+        """
+        Removes every response from the cache.
+        """
+        self._entries.clear()
+        self._urls.clear()
+        self.bytes = 0
@@ -0,0 +1,144 @@
+"""
+Coalescing runs a route once for a burst of identical concurrent requests.
+
+When a route is coalesced, the first request for a key (the *leader*) runs the route as normal.
+Any identical requests that arrive while the leader is still running (the *followers*) wait for
+the leader to finish, and each get a copy of its response, instead of running the route again.
+
+.. currentmodule:: kyoukai.coalesce
+"""
+import asyncio
+import typing
+
+from werkzeug.wrappers import Response
+
+from kyoukai.conditional import NotModified
+
+#: The request headers that are part of the key by default, as responses commonly depend on them.
+DEFAULT_HEADERS = ("Accept", "Accept-Encoding", "Authorization", "Cookie")
+
+
+class _Uncoalesced(Exception):
+    """
+    Tells the followers of a request that they must run the route themselves.
+    """
+
+
+class _Flight(object):
+    __slots__ = ("future", "followers")
+
+    def __init__(self, loop):
+        self.future = loop.create_future()
+        self.followers = 0
+
+
+class Coalescer(object):
+    """
+    Coalesces identical concurrent requests to a route.
+
+    Only requests with the same key are coalesced. By default, the key is made from the method,
+    host, path and query string of the request, and the values of ``headers``.
+
+    Followers get the same error as the leader, if the leader fails. If the leader is cancelled,
+    raises :class:`~.NotModified` (which depends on the leader's own ``If-None-Match``), or returns
+    a streamed response that cannot be copied, the followers run the route themselves.
+    """
+
+    def __init__(self, headers: typing.Iterable[str] = DEFAULT_HEADERS, *,
+                 key: typing.Callable = None, max_followers: int = None):
+        """
+        :param headers: The request headers to add to the key.
+        :param key: A function that takes a :class:`~.HTTPRequestContext`, and returns a \
+            hashable key for the request. This replaces the default key.
+
+        :param max_followers: The maximum number of requests that can wait for a single leader. \
+            Any more run the route themselves. If this is None, there is no limit.
+        """
+        #: The request headers that are part of the key.
+        self.headers = tuple(headers)
+
+        #: The function used to get the key of a request, or None to use :meth:`.get_key`.
+        self.key = key
+
+        #: The maximum number of followers per leader.
+        self.max_followers = max_followers
+
+        #: The number of requests that got the response of another request.
+        self.coalesced = 0
+
+        self._flights = {}  # type: typing.Dict[typing.Hashable, _Flight]
+
+    def get_key(self, ctx) -> typing.Hashable:
+        """
+        Gets the key of a request.
+
+        :param ctx: The :class:`~.HTTPRequestContext` of the request.
+        :return: A hashable key. Requests with equal keys are coalesced.
+        """
+        if self.key is not None:
+            return self.key(ctx)
+
+        request = ctx.request
+        return (request.method, request.host, request.path,
+                request.environ.get("QUERY_STRING", ""),
+                tuple(request.headers.get(name) for name in self.headers))
+
+    async def run(self, ctx, invoke: typing.Callable[[], typing.Awaitable[Response]]) -> Response:
+        """
+        Runs a route, or waits for an identical request that is already running it.
+
+        :param ctx: The :class:`~.HTTPRequestContext` of the request.
+        :param invoke: A function that runs the route, and returns a coroutine.
+        :return: The response of the route.
+        """
+        key = self.get_key(ctx)
+        flight = self._flights.get(key)
+        if flight is not None:
+            if self.max_followers is None or flight.followers < self.max_followers:
+                return await self._follow(ctx, flight, invoke)
+
+            return await invoke()
+
+        flight = _Flight(asyncio.get_event_loop())
+        self._flights[key] = flight
+        try:
+            response = await invoke()
+        except (asyncio.CancelledError, NotModified):
+            flight.future.set_exception(_Uncoalesced())
+            raise
+        except Exception as e:
+            flight.future.set_exception(e)
+            raise
+        else:
+            if response.is_streamed:
+                flight.future.set_exception(_Uncoalesced())
+            else:
+                # Copy the response now, as the leader's response may be changed once returned.
+                flight.future.set_result((response.get_data(), response.status,
+                                          list(response.headers)))
+
+            return response
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+            # Don't warn about an exception that nobody waited for.
+            if flight.future.done() and not flight.future.cancelled():
+                flight.future.exception()
+
+    async def _follow(self, ctx, flight: _Flight, invoke) -> Response:
+        flight.followers += 1
+        try:
+            data, status, headers = await asyncio.shield(flight.future)
+        except _Uncoalesced:
+            return await invoke()
+
+        self.coalesced += 1
+        return ctx.app.response_class(data, status=status, headers=headers)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        :return: The number of keys that have a leader running.
+        """
+        return len(self._flights)
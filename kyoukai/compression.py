@@ -0,0 +1,302 @@
+"""
+Response compression.
+
+A :class:`Compressor` compresses the responses of a route, :class:`~.Blueprint` or app with
+``gzip`` or ``deflate``, if the client accepts it. Streamed bodies are compressed chunk by chunk as
+they are sent, and large bodies are compressed in the thread executor, so the event loop is not
+blocked.
+
+.. currentmodule:: kyoukai.compression
+"""
+import zlib
+
+from werkzeug.wrappers import Response
+
+#: The ``wbits`` to pass to :func:`zlib.compressobj` for each content coding.
+ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+#: Content types that are already compressed, and are not worth compressing again.
+COMPRESSED_TYPES = frozenset((
+    "application/gzip", "application/x-gzip", "application/zip", "application/x-bzip2",
+    "application/x-7z-compressed", "application/x-rar-compressed", "application/x-xz",
+    "application/zstd", "application/pdf", "application/octet-stream", "application/wasm",
+    "font/woff", "font/woff2",
+))
+
+#: Content type prefixes that are already compressed. ``image/svg+xml`` is still compressed.
+COMPRESSED_PREFIXES = ("image/", "audio/", "video/")
+
+
+class _CompressedBody(object):
+    # Compresses an async iterable body chunk by chunk. This is a class rather than an async
+    # generator, which needs Python 3.6.
+    def __init__(self, body, compressor, charset: str):
+        self.body = body.__aiter__()
+        self.compressor = compressor
+        self.charset = charset
+        self.finished = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.finished:
+            raise StopAsyncIteration
+
+        try:
+            chunk = await self.body.__anext__()
+        except StopAsyncIteration:
+            self.finished = True
+            return self.compressor.flush()
+
+        if isinstance(chunk, str):
+            chunk = chunk.encode(self.charset)
+
+        # Flush every chunk, so that streamed data reaches the client as soon as it is sent.
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class LagMonitor(object):
+    """
+    Measures how late the event loop runs callbacks, which rises when the loop is overloaded.
+    """
+
+    def __init__(self, loop, interval: float = 0.1, smoothing: float = 0.2):
+        """
+        :param loop: The event loop to measure.
+        :param interval: The number of seconds between each measurement.
+        :param smoothing: The weight of each new measurement in the moving average.
+        """
+        self.loop = loop
+        self.interval = interval
+        self.smoothing = smoothing
+
+        #: The moving average of the lag, in seconds.
+        self.lag = 0.0
+
+        #: Called with the new lag after every measurement.
+        self.callback = None
+
+        self._handle = None
+        self._expected = None
+
+    def start(self):
+        """
+        Starts measuring the lag.
+        """
+        if self._handle is None:
+            self._schedule()
+
+    def stop(self):
+        """
+        Stops measuring the lag.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_later(self.interval, self._measure)
+
+    def _measure(self):
+        lag = max(0.0, self.loop.time() - self._expected)
+        self.lag += (lag - self.lag) * self.smoothing
+        if self.callback is not None:
+            self.callback(self.lag)
+
+        self._schedule()
+
+
+class Compressor(object):
+    """
+    Compresses responses, negotiating the content coding with the ``Accept-Encoding`` header.
+
+    Responses are not compressed if they are smaller than ``min_size``, already have a
+    ``Content-Encoding``, have ``Cache-Control: no-transform``, or have a content type that is
+    already compressed, such as images.
+
+    The compression level can be changed at any time with :attr:`.level`. With ``adaptive``, the
+    level is lowered while the event loop is lagging behind by more than ``max_lag`` seconds, and
+    raised back up to ``level`` once it has caught up.
+    """
+
+    def __init__(self, level: int = 6, *, min_size: int = 1024,
+                 thread_threshold: int = 256 * 1024, encodings=("gzip", "deflate"),
+                 adaptive: bool = False, max_lag: float = 0.05):
+        """
+        :param level: The zlib compression level, from 1 (fastest) to 9 (smallest).
+        :param min_size: The smallest body to compress, in bytes.
+        :param thread_threshold: Bodies larger than this many bytes are compressed in the \
+            thread executor.
+
+        :param encodings: The content codings to offer, in order of preference.
+        :param adaptive: If the level should be lowered while the event loop is lagging.
+        :param max_lag: The loop lag, in seconds, above which the level is lowered.
+        """
+        #: The highest compression level to use.
+        self.level = level
+
+        #: The smallest body to compress, in bytes.
+        self.min_size = min_size
+
+        #: Bodies larger than this many bytes are compressed in the thread executor.
+        self.thread_threshold = thread_threshold
+
+        #: The content codings to offer, in order of preference.
+        self.encodings = [encoding for encoding in encodings if encoding in ENCODINGS]
+
+        #: If the level is lowered while the event loop is lagging.
+        self.adaptive = adaptive
+
+        #: The loop lag, in seconds, above which the level is lowered.
+        self.max_lag = max_lag
+
+        #: The :class:`.LagMonitor` used when the level is adaptive.
+        self.monitor = None  # type: LagMonitor
+
+        #: The number of bytes before and after compression, for bodies that are not streamed.
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self._current_level = level
+
+    @property
+    def current_level(self) -> int:
+        """
+        :return: The compression level in use. This is only lower than :attr:`.level` when the \
+            level is adaptive.
+        """
+        return min(self._current_level, self.level) if self.adaptive else self.level
+
+    @property
+    def ratio(self) -> float:
+        """
+        :return: The size of the compressed bodies, as a fraction of their original size.
+        """
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def _lag_changed(self, lag: float):
+        if lag > self.max_lag:
+            self._current_level = max(1, self.current_level - 1)
+        elif lag < self.max_lag / 4:
+            self._current_level = min(self.level, self._current_level + 1)
+
+    def negotiate(self, request) -> str:
+        """
+        :return: The content coding to use for a request, or None if the client does not accept \
+            any of :attr:`.encodings`.
+        """
+        return request.accept_encodings.best_match(self.encodings)
+
+    def is_compressible(self, response: Response) -> bool:
+        """
+        :return: If a response may be compressed, regardless of what the client accepts.
+        """
+        if response.status_code < 200 or response.status_code in (204, 304):
+            return False
+
+        if "Content-Encoding" in response.headers or response.cache_control.no_transform:
+            return False
+
+        mimetype = response.mimetype or ""
+        if mimetype in COMPRESSED_TYPES or \
+                (mimetype.startswith(COMPRESSED_PREFIXES) and mimetype != "image/svg+xml"):
+            return False
+
+        return response.is_streamed or response.content_length is None or \
+            response.content_length >= self.min_size
+
+    def compressobj(self, encoding: str):
+        """
+        :return: A new :func:`zlib.compressobj` for a content coding, at the current level.
+        """
+        return zlib.compressobj(self.current_level, zlib.DEFLATED, ENCODINGS[encoding])
+
+    def _compress_data(self, data: bytes, encoding: str) -> bytes:
+        compressor = self.compressobj(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    def _compress_iter(self, body, encoding: str, charset: str):
+        compressor = self.compressobj(encoding)
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+
+            # Flush every chunk, so that streamed data reaches the client as soon as it is sent.
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        yield compressor.flush()
+
+    async def compress(self, ctx, response: Response) -> Response:
+        """
+        Compresses a response, if the client accepts it.
+
+        :param ctx: The :class:`~.HTTPRequestContext` of the request.
+        :param response: The response to compress. This is changed in place.
+        :return: The response.
+        """
+        if not self.is_compressible(response):
+            return response
+
+        # The response depends on Accept-Encoding, even if this client doesn't get it compressed.
+        response.vary.add("Accept-Encoding")
+
+        encoding = self.negotiate(ctx.request)
+        if encoding is None:
+            return response
+
+        if self.adaptive and self.monitor is None:
+            self.monitor = LagMonitor(ctx.app.loop)
+            self.monitor.callback = self._lag_changed
+            self.monitor.start()
+
+        if response.is_streamed:
+            body = response.response
+            if hasattr(body, "__aiter__"):
+                response.response = _CompressedBody(body, self.compressobj(encoding),
+                                                    response.charset)
+            else:
+                response.response = self._compress_iter(body, encoding, response.charset)
+
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+
+            if len(data) > self.thread_threshold:
+                compressed = await ctx.app.get_executor("thread").call(self._compress_data, data,
+                                                                       encoding)
+            else:
+                compressed = self._compress_data(data, encoding)
+
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+            response.set_data(compressed)
+
+        response.headers["Content-Encoding"] = encoding
+
+        # The compressed body is a different representation, so it can't share a strong ETag.
+        etag = response.headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            response.headers["ETag"] = "W/" + etag
+
+        return response
+
+
+def create_compressor(config: dict) -> Compressor:
+    """
+    Creates the default compressor of an app from the ``compression_level``,
+    ``compression_min_size``, ``compression_thread_threshold`` and ``compression_adaptive`` app
+    config keys.
+    """
+    options = {}
+    for key in ("level", "min_size", "thread_threshold", "adaptive"):
+        if "compression_" + key in config:
+            options[key] = config["compression_" + key]
+
+    return Compressor(**options)
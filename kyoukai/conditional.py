@@ -0,0 +1,128 @@
+"""
+Conditional requests let clients revalidate a resource they already have, and get an empty
+``304 Not Modified`` instead of the full body if it has not changed.
+
+When ETags are enabled for a route, with the ``etag`` argument of a :class:`~.Route` or
+:class:`~.Blueprint`, a strong ETag is generated by hashing the body of every response that does
+not already have one. Routes that can tell if a resource has changed without building it can call
+:meth:`.HTTPRequestContext.check_etag` first, so that the body is never built for a ``304``.
+
+.. currentmodule:: kyoukai.conditional
+"""
+import hashlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+from werkzeug.wrappers import Response
+
+try:
+    from hashlib import blake2b
+except ImportError:  # pragma: no cover
+    # BLAKE2 is only available on Python 3.6 and above.
+    blake2b = None
+
+#: The headers that are kept in a ``304`` response (RFC 7232, section 4.1).
+NOT_MODIFIED_HEADERS = frozenset(("cache-control", "content-location", "date", "etag", "expires",
+                                  "vary", "last-modified", "server", "x-powered-by"))
+
+#: Bodies larger than this many bytes are hashed in a thread, if the ``etag_thread_threshold`` app
+#: config key is not set.
+THREAD_THRESHOLD = 256 * 1024
+
+
+class NotModified(HTTPException):
+    """
+    Raised by :meth:`.HTTPRequestContext.check_etag` when the client already has the resource.
+
+    This is turned straight into a ``304 Not Modified`` response, without calling error handlers.
+    """
+    code = 304
+    description = "Not Modified"
+
+    def __init__(self, headers: list = None):
+        super().__init__()
+
+        #: The validator headers to send with the response.
+        self.headers = headers or []
+
+    def get_response(self, environ=None):
+        return Response(status=self.code, headers=self.headers)
+
+
+def compute_etag(data: bytes) -> str:
+    """
+    Computes a strong ETag for a body.
+
+    :param data: The body to hash.
+    :return: The quoted ETag.
+    """
+    if blake2b is not None:
+        digest = blake2b(data, digest_size=16).hexdigest()
+    else:  # pragma: no cover
+        digest = hashlib.sha256(data).hexdigest()[:32]
+
+    return quote_etag(digest)
+
+
+def is_modified(environ: dict, etag: str = None, last_modified=None) -> bool:
+    """
+    Checks the ``If-None-Match`` and ``If-Modified-Since`` headers of a request.
+
+    :param environ: The WSGI environment of the request.
+    :param etag: The quoted ETag of the current resource.
+    :param last_modified: The time the resource was last modified.
+    :return: False if the client already has the current resource.
+    """
+    if environ.get("REQUEST_METHOD") not in ("GET", "HEAD"):
+        return True
+
+    return is_resource_modified(environ, etag=etag, last_modified=last_modified)
+
+
+def not_modified(response: Response, response_class=Response) -> Response:
+    """
+    Creates a ``304 Not Modified`` response from a full response, keeping only its validators and
+    caching headers.
+    """
+    headers = Headers([(name, value) for name, value in response.headers
+                       if name.lower() in NOT_MODIFIED_HEADERS])
+    headers.setdefault("Date", http_date())
+    return response_class(status=304, headers=headers)
+
+
+async def make_conditional(ctx, response: Response) -> Response:
+    """
+    Adds an ETag to a response, and turns it into a ``304 Not Modified`` if the client already has
+    the same response.
+
+    The ETag is, in order, the one already set on the response, the one passed to
+    :meth:`.HTTPRequestContext.check_etag`, or a hash of the body. Bodies larger than the
+    ``etag_thread_threshold`` app config key are hashed in the thread executor, so that the event
+    loop is not blocked. Streamed bodies are never hashed.
+
+    :param ctx: The :class:`~.HTTPRequestContext` of the request.
+    :param response: The response of the route.
+    :return: The response, or a new ``304`` response.
+    """
+    if ctx.request.method not in ("GET", "HEAD") or response.status_code != 200:
+        return response
+
+    etag = response.headers.get("ETag")
+    if etag is None and ctx.etag is not None:
+        etag = response.headers["ETag"] = ctx.etag
+
+    if etag is None and not response.is_streamed:
+        data = response.get_data()
+        threshold = ctx.app.config.get("etag_thread_threshold", THREAD_THRESHOLD)
+        if len(data) > threshold:
+            etag = await ctx.app.get_executor("thread").call(compute_etag, data)
+        else:
+            etag = compute_etag(data)
+
+        response.headers["ETag"] = etag
+
+    if is_modified(ctx.environ, etag, response.last_modified):
+        return response
+
+    return not_modified(response, ctx.app.response_class)
@@ -0,0 +1,421 @@
+"""
+Executors run synchronous route functions outside of the event loop, so that a route doing
+blocking I/O, or CPU-bound work, does not stall every other connection.
+
+Routes choose an executor with the ``executor`` argument, which is inherited from their
+:class:`~.Blueprint`. The ``sync_executor`` app config key sets the executor for any other
+synchronous route. Coroutine functions always run on the event loop.
+
+.. currentmodule:: kyoukai.executor
+"""
+import abc
+import asyncio
+import functools
+import importlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import GatewayTimeout
+
+from kyoukai.limiter import RequestShed
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # Context variables are only available on Python 3.7 and above.
+    contextvars = None
+
+#: The name of the executor that runs routes directly on the event loop.
+INLINE = "inline"
+
+logger = logging.getLogger("Kyoukai")
+
+
+class Executor(object, metaclass=abc.ABCMeta):
+    """
+    The base class for executors.
+    """
+
+    @abc.abstractmethod
+    async def run(self, func, ctx, *args, **kwargs):
+        """
+        Runs a route function.
+
+        :param func: The route function to run.
+        :param ctx: The :class:`~.HTTPRequestContext` of the request.
+        :return: The result of the function.
+        """
+
+    def shutdown(self, wait: bool = True):
+        """
+        Shuts down this executor.
+
+        :param wait: If this should wait for any running functions to finish.
+        """
+
+
+class ThreadExecutor(Executor):
+    """
+    Runs route functions in a bounded pool of threads.
+
+    At most ``max_workers`` functions are submitted to the pool at once. Any others wait on the
+    event loop, so that a request that is cancelled (for example, by a timeout) before it has
+    started is never run. A function that has already started cannot be cancelled, and runs
+    until it returns.
+
+    Context variables are copied into the thread, and the pre- and post-request hooks still run
+    on the event loop.
+    """
+
+    def __init__(self, max_workers: int = None):
+        """
+        :param max_workers: The number of threads in the pool. Defaults to the number of CPUs \
+            plus four, up to 32.
+        """
+        #: The number of threads in the pool.
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+
+        #: The :class:`concurrent.futures.ThreadPoolExecutor` that functions are run in.
+        try:
+            self.pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="kyoukai-route")
+        except TypeError:  # pragma: no cover
+            # Threads can only be named on Python 3.6 and above.
+            self.pool = ThreadPoolExecutor(self.max_workers)
+
+        #: The number of functions that are running, or waiting to run.
+        self.pending = 0
+
+        self._semaphore = None  # type: asyncio.Semaphore
+
+    async def run(self, func, ctx, *args, **kwargs):
+        return await self.call(func, ctx, *args, **kwargs)
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Calls any function in the pool.
+
+        .. versionadded:: 2.2.0
+
+        :param func: The function to call.
+        :return: The result of the function.
+        """
+        if self._semaphore is None:
+            # Created lazily, so that it belongs to the running event loop.
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+        call = functools.partial(func, *args, **kwargs)
+        if contextvars is not None:
+            call = functools.partial(contextvars.copy_context().run, call)
+
+        self.pending += 1
+        try:
+            async with self._semaphore:
+                return await asyncio.get_event_loop().run_in_executor(self.pool, call)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait=wait)
+
+
+class RequestSnapshot(object):
+    """
+    A picklable copy of a request, which is passed to routes that run in another process instead
+    of the :class:`~.HTTPRequestContext`.
+    """
+
+    def __init__(self, method: str, path: str, args: MultiDict, headers: Headers, body: bytes):
+        #: The HTTP method of the request.
+        self.method = method
+
+        #: The path of the request.
+        self.path = path
+
+        #: The query string arguments of the request.
+        self.args = args
+
+        #: The headers of the request.
+        self.headers = headers
+
+        #: The body of the request.
+        self.body = body
+
+    @classmethod
+    async def from_context(cls, ctx) -> 'RequestSnapshot':
+        """
+        Creates a snapshot of the request of a context, waiting for the whole body to arrive.
+
+        :param ctx: The :class:`~.HTTPRequestContext` of the request.
+        """
+        request = ctx.request
+        stream = request.environ.get("wsgi.input")
+        if hasattr(stream, "read_async"):
+            # HTTP/2 bodies may still be arriving.
+            body = await stream.read_async()
+        else:
+            body = request.get_data()
+
+        return cls(request.method, request.path, MultiDict(request.args),
+                   Headers(list(request.headers)), body)
+
+    def __repr__(self):
+        return "<RequestSnapshot {} {}>".format(self.method, self.path)
+
+
+def _resolve_function(module: str, name: str):
+    # Routes are decorated in place, so the name may refer to the Route rather than the function.
+    obb = importlib.import_module(module)
+    for part in name.split("."):
+        obb = getattr(obb, part)
+
+    return getattr(obb, "_callable", obb)
+
+
+def _call_in_process(module: str, name: str, request: RequestSnapshot, args, kwargs) -> tuple:
+    # Runs inside a worker process, and returns the response in a picklable form.
+    from kyoukai.util import wrap_response
+
+    result = _resolve_function(module, name)(request, *args, **kwargs)
+    response = wrap_response(result)
+    return response.get_data(), response.status_code, response.headers.to_wsgi_list()
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _get_processes(pool: ProcessPoolExecutor) -> list:
+    return list((getattr(pool, "_processes", None) or {}).values())
+
+
+def _wait_exited(processes: list, timeout: float) -> list:
+    # Waits for every process to exit, and returns the processes that are still running.
+    deadline = time.monotonic() + timeout
+    running = {process.sentinel: process for process in processes}
+    while running:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        for sentinel in multiprocessing.connection.wait(list(running), remaining):
+            del running[sentinel]
+
+    return list(running.values())
+
+
+def _terminate_after(processes: list, timeout: float):
+    # Waits for worker processes to exit, and terminates any that are still running afterwards.
+    stuck = _wait_exited(processes, timeout)
+    for process in stuck:
+        process.terminate()
+
+    _wait_exited(stuck, 5)
+
+
+class ProcessExecutor(Executor):
+    """
+    Runs CPU-bound route functions in a pool of worker processes.
+
+    The route function is called with a :class:`.RequestSnapshot` instead of the
+    :class:`~.HTTPRequestContext`, and must be a module-level function, so that the workers can
+    import it. It can return anything a normal route can, as long as the body is not streamed.
+
+    Requests that arrive while ``max_queue`` requests are already waiting for a worker are shed
+    with a ``503``. A function that runs for longer than ``timeout`` seconds fails with a ``504``,
+    and the pool it ran in is replaced, terminating the stuck worker once the other functions in
+    that pool have finished. The pool is also replaced after ``max_tasks`` functions have run, to
+    release any memory that the workers have built up.
+
+    On shutdown, workers that are still running a function after ``shutdown_timeout`` seconds are
+    terminated, so that a stuck worker never stops the server from exiting.
+    """
+
+    def __init__(self, max_workers: int = None, *, max_queue: int = None, timeout: float = None,
+                 max_tasks: int = None, start_method: str = None, shutdown_timeout: float = 10):
+        """
+        :param max_workers: The number of worker processes. Defaults to the number of CPUs.
+        :param max_queue: The maximum number of functions that can wait for a free worker. \
+            If this is None, the queue is unbounded.
+
+        :param timeout: The maximum number of seconds a function can run for.
+        :param max_tasks: The number of functions to run before replacing the workers.
+        :param start_method: The :mod:`multiprocessing` start method to create workers with. \
+            This needs Python 3.7 or above, and is ignored with a warning otherwise.
+
+        :param shutdown_timeout: The number of seconds to wait for running functions when \
+            shutting down, before terminating the workers.
+        """
+        #: The number of worker processes.
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+        #: The maximum number of functions that can wait for a free worker.
+        self.max_queue = max_queue
+
+        #: The maximum number of seconds a function can run for.
+        self.timeout = timeout
+
+        #: The number of functions to run before replacing the workers.
+        self.max_tasks = max_tasks
+
+        #: The number of seconds to wait for running functions when shutting down.
+        self.shutdown_timeout = shutdown_timeout
+
+        #: The number of functions that are running, or waiting to run.
+        self.pending = 0
+
+        #: The :class:`concurrent.futures.ProcessPoolExecutor` that functions are run in.
+        self.pool = None  # type: ProcessPoolExecutor
+
+        self._context = multiprocessing.get_context(start_method) if start_method else None
+        self._tasks = 0
+        self._running = {}  # type: typing.Dict[ProcessPoolExecutor, set]
+        self._stuck = set()
+        self._new_pool()
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        if self._context is None:
+            return ProcessPoolExecutor(self.max_workers)
+
+        try:
+            return ProcessPoolExecutor(self.max_workers, mp_context=self._context)
+        except TypeError:  # pragma: no cover
+            # The start method can only be chosen on Python 3.7 and above.
+            logger.warning("process_start_method needs Python 3.7 or above, and is ignored.")
+            self._context = None
+            return ProcessPoolExecutor(self.max_workers)
+
+    def _new_pool(self):
+        old = self.pool
+        self.pool = self._create_pool()
+        self._running[self.pool] = set()
+        self._tasks = 0
+
+        # Start the workers now, instead of on the first request.
+        for _ in range(self.max_workers):
+            self.pool.submit(_warm_up)
+
+        if old is not None:
+            self._retire(old)
+
+    def _retire(self, pool: ProcessPoolExecutor):
+        # Stops an old pool once the functions that are still running in it have finished.
+        running = self._running.get(pool)
+        if running is None:
+            # The executor was shut down while the function was running.
+            return
+
+        if pool is self.pool or running:
+            return
+
+        del self._running[pool]
+        if pool in self._stuck:
+            # The stuck function would otherwise keep its worker busy forever.
+            self._stuck.discard(pool)
+            for process in _get_processes(pool):
+                process.terminate()
+
+        pool.shutdown(wait=False)
+
+    async def run(self, func, ctx, *args, **kwargs):
+        if self.max_queue is not None and self.pending >= self.max_workers + self.max_queue:
+            raise RequestShed()
+
+        module, name = func.__module__, func.__qualname__
+        if "<locals>" in name:
+            raise TypeError("Functions run in a process must be defined at the module level")
+
+        snapshot = await RequestSnapshot.from_context(ctx)
+
+        if self.max_tasks is not None and self._tasks >= self.max_tasks:
+            self._new_pool()
+
+        pool = self.pool
+        running = self._running[pool]
+        self._tasks += 1
+        self.pending += 1
+        future = pool.submit(_call_in_process, module, name, snapshot, args, kwargs)
+        running.add(future)
+
+        try:
+            data, status, headers = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                           self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("{}.{} did not finish in {} seconds, replacing the process pool."
+                           .format(module, name, self.timeout))
+            self._stuck.add(pool)
+            if pool is self.pool:
+                self._new_pool()
+
+            raise GatewayTimeout()
+        finally:
+            self.pending -= 1
+            running.discard(future)
+            self._retire(pool)
+
+        return ctx.app.response_class(data, status=status, headers=headers)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Shuts down every pool.
+
+        Workers stuck on a function that timed out are terminated straight away. Any other workers
+        are terminated if they are still running after :attr:`.shutdown_timeout` seconds.
+
+        :param wait: If this should wait for the workers to exit. Otherwise, they are terminated \
+            from a background thread.
+        """
+        processes = []
+        pools = list(self._running)
+        for pool in pools:
+            if pool in self._stuck:
+                for process in _get_processes(pool):
+                    process.terminate()
+            else:
+                processes.extend(_get_processes(pool))
+
+            pool.shutdown(wait=False)
+
+        self._running.clear()
+        self._stuck.clear()
+
+        if not wait:
+            threading.Thread(target=_terminate_after, args=(processes, self.shutdown_timeout),
+                             daemon=True).start()
+            return
+
+        _terminate_after(processes, self.shutdown_timeout)
+        for pool in pools:
+            pool.shutdown(wait=True)
+
+
+def create_executor(name: str, config: dict) -> Executor:
+    """
+    Creates a new executor from the app config.
+
+    :param name: The name of the executor, ``"thread"`` or ``"process"``.
+    :param config: The app config. ``thread_pool_size`` sets the number of threads, and \
+        ``process_pool_size``, ``process_max_queue``, ``process_timeout``, \
+        ``process_max_tasks``, ``process_start_method`` and ``process_shutdown_timeout`` \
+        configure the process pool.
+
+    :return: A new :class:`.Executor`.
+    """
+    if name == "thread":
+        return ThreadExecutor(config.get("thread_pool_size"))
+
+    if name == "process":
+        return ProcessExecutor(config.get("process_pool_size"),
+                               max_queue=config.get("process_max_queue"),
+                               timeout=config.get("process_timeout"),
+                               max_tasks=config.get("process_max_tasks"),
+                               start_method=config.get("process_start_method"),
+                               shutdown_timeout=config.get("process_shutdown_timeout", 10))
+
+    raise ValueError("Unknown executor: {}".format(name))
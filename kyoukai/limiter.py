@@ -0,0 +1,280 @@
+"""
+Limiters control how many requests are processed at once.
+
+When a limiter is configured, requests that arrive while the server is at capacity wait in a
+bounded queue. Requests that cannot be queued, or that wait for too long, are *shed*: they are
+immediately responded to with a ``503 Service Unavailable``, before any routing happens.
+
+Limiters can also be attached to a :class:`~.Blueprint`, in which case they only limit the routes
+inside that Blueprint (and its children), and are checked after routing.
+
+.. currentmodule:: kyoukai.limiter
+"""
+import asyncio
+import collections
+
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class RequestShed(ServiceUnavailable):
+    """
+    Raised when a request is shed by the limiter of a :class:`~.Blueprint`.
+
+    This is a normal ``503`` HTTP exception, so it can be handled by an error handler, but it also
+    adds the ``Retry-After`` header to the default response.
+    """
+
+    def __init__(self, retry_after: int = 1, description: str = None):
+        super().__init__(description)
+
+        #: The value of the ``Retry-After`` header.
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None):
+        headers = super().get_headers(environ)
+        headers.append(("Retry-After", str(self.retry_after)))
+        return headers
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limits the number of requests that are processed at once to a fixed number.
+    """
+
+    def __init__(self, max_in_flight: int, *, max_queue: int = 0, queue_timeout: float = None,
+                 retry_after: int = 1, loop: asyncio.AbstractEventLoop = None):
+        """
+        :param max_in_flight: The maximum number of requests to process at once.
+        :param max_queue: The maximum number of requests that can wait for a free slot. \
+            Requests that arrive while the queue is full are shed immediately.
+
+        :param queue_timeout: The maximum amount of time, in seconds, that a request can wait in \
+            the queue before being shed. If this is None, requests can wait forever.
+
+        :param retry_after: The value of the ``Retry-After`` header sent with shed requests.
+        :param loop: The event loop to use. Defaults to the current event loop.
+        """
+        #: The maximum number of requests to process at once.
+        self.max_in_flight = max_in_flight
+
+        #: The maximum number of requests that can wait in the queue.
+        self.max_queue = max_queue
+
+        #: The maximum amount of time a request can wait in the queue.
+        self.queue_timeout = queue_timeout
+
+        #: The value of the ``Retry-After`` header sent with shed requests.
+        self.retry_after = retry_after
+
+        #: The number of requests currently being processed.
+        self.in_flight = 0
+
+        #: The total number of requests that have been shed.
+        self.shed = 0
+
+        self._loop = loop
+
+        # The queue of futures for waiting requests.
+        # These are resolved to True when a slot is handed over, or False when they expire.
+        self._waiters = collections.deque()
+
+    @property
+    def limit(self) -> int:
+        """
+        :return: The current concurrency limit.
+        """
+        return self.max_in_flight
+
+    @property
+    def queued(self) -> int:
+        """
+        :return: The number of requests currently waiting in the queue.
+        """
+        return len(self._waiters)
+
+    def try_acquire(self) -> bool:
+        """
+        Tries to acquire a slot without waiting.
+
+        :return: True if a slot was acquired, False otherwise.
+        """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return True
+
+        return False
+
+    async def acquire(self) -> bool:
+        """
+        Acquires a slot, waiting in the queue if required.
+
+        :return: True if a slot was acquired, or False if the request was shed.
+        """
+        if self.try_acquire():
+            return True
+
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            return False
+
+        loop = self._loop or asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._waiters.append(fut)
+
+        handle = None
+        if self.queue_timeout is not None:
+            handle = loop.call_later(self.queue_timeout, self._expire, fut)
+
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.result() is True:
+                # We were handed a slot just as we were cancelled, so hand it on.
+                self.release()
+            elif fut in self._waiters:
+                self._waiters.remove(fut)
+            raise
+        finally:
+            if handle is not None:
+                handle.cancel()
+
+    def _expire(self, fut: asyncio.Future):
+        """
+        Sheds a request that has been waiting in the queue for too long.
+        """
+        if fut.done():
+            return
+
+        self._waiters.remove(fut)
+        self.shed += 1
+        fut.set_result(False)
+
+    def release(self, latency: float = None):
+        """
+        Releases a slot, handing it over to the next request in the queue if there is one.
+
+        :param latency: The time, in seconds, that the request took to process.
+        """
+        while self._waiters and self.in_flight <= self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                # The slot is handed over directly, so in_flight stays the same.
+                fut.set_result(True)
+                return
+
+        self.in_flight -= 1
+
+
+class AdaptiveLimiter(ConcurrencyLimiter):
+    """
+    Limits the number of requests that are processed at once, adjusting the limit based on the
+    observed latency of requests.
+
+    This uses an AIMD (additive increase, multiplicative decrease) algorithm. Request latencies
+    are collected into windows; at the end of each window a latency percentile is compared to the
+    *baseline* latency, which is the lowest percentile observed since the last probe:
+
+        - If the percentile is more than ``tolerance`` times the baseline, requests are queueing up
+          somewhere, so the limit is multiplied by ``backoff``.
+        - Otherwise, if at least half of the limit was used during the window, the limit is
+          increased by one.
+
+    Every ``probe_interval`` windows, the limit is halved and the baseline is measured again, so
+    that the limiter follows changes in the latency of the backend.
+    """
+
+    def __init__(self, initial_limit: int = 20, *, min_limit: int = 1, max_limit: int = 1000,
+                 window: int = 100, percentile: float = 0.9, tolerance: float = 2.0,
+                 backoff: float = 0.9, probe_interval: int = 100, **kwargs):
+        """
+        :param initial_limit: The limit to start with.
+        :param min_limit: The lowest that the limit can go.
+        :param max_limit: The highest that the limit can go.
+        :param window: The number of latency samples in each window.
+        :param percentile: The latency percentile to compare, between 0 and 1.
+        :param tolerance: How much slower than the baseline requests can get before the limit is \
+            decreased.
+
+        :param backoff: The factor to multiply the limit by when it is decreased.
+        :param probe_interval: The number of windows between measurements of the baseline.
+        :param kwargs: Any other arguments to :class:`.ConcurrencyLimiter`.
+        """
+        super().__init__(max_limit, **kwargs)
+
+        #: The lowest that the limit can go.
+        self.min_limit = min_limit
+
+        #: The number of latency samples in each window.
+        self.window = window
+
+        #: The latency percentile to compare.
+        self.percentile = percentile
+
+        #: How much slower than the baseline requests can get before the limit is decreased.
+        self.tolerance = tolerance
+
+        #: The factor to multiply the limit by when it is decreased.
+        self.backoff = backoff
+
+        #: The number of windows between measurements of the baseline.
+        self.probe_interval = probe_interval
+
+        #: The baseline latency, or None if it is being measured.
+        self.min_latency = None  # type: float
+
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._samples = []
+        self._peak = 0
+        self._windows = 0
+
+    @property
+    def limit(self) -> int:
+        """
+        :return: The current concurrency limit.
+        """
+        return int(self._limit)
+
+    def try_acquire(self) -> bool:
+        acquired = super().try_acquire()
+        if acquired and self.in_flight > self._peak:
+            self._peak = self.in_flight
+
+        return acquired
+
+    def release(self, latency: float = None):
+        """
+        Releases a slot, and records the latency of the request.
+
+        :param latency: The time, in seconds, that the request took to process.
+        """
+        if latency is not None:
+            # Requests handed a slot from the queue don't go through try_acquire.
+            self._peak = max(self._peak, self.in_flight)
+            self._samples.append(latency)
+            if len(self._samples) >= self.window:
+                self.update()
+
+        super().release(latency)
+
+    def update(self):
+        """
+        Updates the limit from the current window of latency samples, and starts a new window.
+        """
+        samples = sorted(self._samples)
+        latency = samples[min(len(samples) - 1, int(len(samples) * self.percentile))]
+        peak = self._peak
+
+        self._samples = []
+        self._peak = self.in_flight
+        self._windows += 1
+
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        elif latency > self.min_latency * self.tolerance:
+            self._limit = max(self.min_limit, self._limit * self.backoff)
+        elif peak * 2 >= self._limit:
+            self._limit = min(self.max_in_flight, self._limit + 1)
+
+        if self.probe_interval and self._windows % self.probe_interval == 0:
+            self._limit = max(self.min_limit, self._limit / 2)
+            self.min_latency = None
@@ -0,0 +1,248 @@
+"""
+Listeners are the sockets that the built-in HTTP server accepts connections on.
+
+A :class:`~.KyoukaiComponent` can run several listeners at once, all serving the same app. Each
+listener is either a TCP socket, a Unix domain socket, or an inherited file descriptor (for
+example, one passed in by systemd socket activation).
+
+.. currentmodule:: kyoukai.listener
+"""
+import os
+import socket
+import ssl as py_ssl
+import stat
+import warnings
+
+from kyoukai.tls import TLSManager
+
+#: The first file descriptor passed by systemd socket activation.
+SD_LISTEN_FDS_START = 3
+
+
+def get_systemd_fds() -> list:
+    """
+    Gets the file descriptors passed to this process by systemd socket activation.
+
+    :return: A list of file descriptors, which is empty if this process was not socket-activated.
+    """
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return []
+
+    count = int(os.environ.get("LISTEN_FDS", 0))
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+
+
+class Listener(object):
+    """
+    Represents a single listening socket, and the options that it is created with.
+    """
+
+    #: The config keys that are used to create a listener.
+    #: Socket options provided at the top level of the component config act as the defaults for
+    #: every listener.
+    OPTIONS = ("ip", "port", "unix", "unix_mode", "fd", "ssl", "backlog", "reuse_port",
+               "tcp_nodelay", "tcp_defer_accept", "tcp_fastopen", "keepalive", "sndbuf", "rcvbuf")
+
+    def __init__(self, ip: str = "127.0.0.1", port: int = 4444, *,
+                 unix: str = None, unix_mode: int = None, fd=None, ssl: dict = None,
+                 backlog: int = 100, reuse_port: bool = None, tcp_nodelay: bool = True,
+                 tcp_defer_accept: int = None, tcp_fastopen: int = None, keepalive=None,
+                 sndbuf: int = None, rcvbuf: int = None):
+        """
+        :param ip: The IP to bind to, for TCP listeners.
+        :param port: The port to bind to, for TCP listeners.
+        :param unix: The path of a Unix domain socket to bind to, instead of an IP and port.
+        :param unix_mode: The permissions to set on the Unix domain socket file, e.g ``0o660``.
+        :param fd: An inherited file descriptor to listen on, instead of binding a new socket.
+            This can also be ``"systemd"`` or ``"systemd:N"``, to use the first (or Nth) socket \
+            passed by systemd socket activation.
+
+        :param ssl: The TLS config for this listener. This is a dict with the keys ``enabled``, \
+            ``ssl_certfile`` and ``ssl_keyfile``.
+            It can also have the keys ``certificates``, a list of extra certificates chosen by \
+            SNI, ``session_tickets``, ``num_tickets`` and ``reload_interval``. See :ref:`tls`.
+
+        :param backlog: The maximum number of queued connections.
+        :param reuse_port: If ``SO_REUSEPORT`` should be set. By default, this is set when \
+            running multiple workers.
+
+        :param tcp_nodelay: If ``TCP_NODELAY`` should be set, disabling Nagle's algorithm.
+        :param tcp_defer_accept: The number of seconds to wait for data before accepting a \
+            connection (``TCP_DEFER_ACCEPT``). Linux only.
+
+        :param tcp_fastopen: The queue length for TCP Fast Open connections (``TCP_FASTOPEN``).
+        :param keepalive: Enables ``SO_KEEPALIVE``. This can be True, or a dict with the \
+            ``idle``, ``interval`` and ``count`` keys to tune the keepalive probes.
+
+        :param sndbuf: The size of the send buffer of each connection (``SO_SNDBUF``).
+        :param rcvbuf: The size of the receive buffer of each connection (``SO_RCVBUF``).
+        """
+        self.ip = ip
+        self.port = port
+        self.unix = unix
+        self.unix_mode = unix_mode
+        self.fd = fd
+        self.ssl = ssl or {}
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_defer_accept = tcp_defer_accept
+        self.tcp_fastopen = tcp_fastopen
+        self.keepalive = keepalive
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+        #: The :class:`socket.socket` for this listener, once it has been created.
+        self.sock = None  # type: socket.socket
+
+        #: The :class:`~.TLSManager` for this listener, once its TLS context has been created.
+        self.tls = None  # type: TLSManager
+
+    @classmethod
+    def from_config(cls, cfg: dict, defaults: dict = None) -> 'Listener':
+        """
+        Creates a new listener from a config dict.
+
+        :param cfg: The config for this listener. Any keys not in :attr:`.OPTIONS` are ignored.
+        :param defaults: The default config, which ``cfg`` overrides.
+        """
+        options = {key: value for key, value in (defaults or {}).items() if key in cls.OPTIONS}
+        options.update({key: value for key, value in cfg.items() if key in cls.OPTIONS})
+        return cls(**options)
+
+    @property
+    def shared(self) -> bool:
+        """
+        :return: If this listener must be created once and shared between worker processes.
+            Only TCP sockets can be bound by several workers with ``SO_REUSEPORT``.
+        """
+        return self.unix is not None or self.fd is not None
+
+    def __str__(self):
+        if self.unix is not None:
+            address = "unix:{}".format(self.unix)
+        elif self.fd is not None:
+            address = "fd:{}".format(self.fd)
+        else:
+            address = "{}:{}".format(self.ip, self.port)
+
+        if self.ssl.get("enabled") is True:
+            address += " (TLS)"
+
+        return address
+
+    def _get_fd(self) -> int:
+        if not isinstance(self.fd, str):
+            return int(self.fd)
+
+        name, _, index = self.fd.partition(":")
+        if name != "systemd":
+            return int(self.fd)
+
+        fds = get_systemd_fds()
+        index = int(index or 0)
+        if index >= len(fds):
+            raise RuntimeError("systemd did not pass socket #{} to this process".format(index))
+
+        return fds[index]
+
+    def create_socket(self, reuse_port: bool = False) -> socket.socket:
+        """
+        Creates the listening socket for this listener, and sets any socket options.
+
+        :param reuse_port: If ``SO_REUSEPORT`` should be set, if not overridden by \
+            :attr:`.reuse_port`.
+
+        :return: A new, listening, :class:`socket.socket`.
+        """
+        if self.fd is not None:
+            sock = socket.socket(fileno=self._get_fd())
+        elif self.unix is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Remove any stale socket left over from a previous run.
+            try:
+                if stat.S_ISSOCK(os.stat(self.unix).st_mode):
+                    os.unlink(self.unix)
+            except FileNotFoundError:
+                pass
+
+            sock.bind(self.unix)
+            if self.unix_mode is not None:
+                os.chmod(self.unix, self.unix_mode)
+        else:
+            family, type_, proto, _, address = socket.getaddrinfo(self.ip, self.port,
+                                                                  type=socket.SOCK_STREAM,
+                                                                  flags=socket.AI_PASSIVE)[0]
+            sock = socket.socket(family, type_, proto)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            if self.reuse_port if self.reuse_port is not None else reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            sock.bind(address)
+
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            self.set_tcp_options(sock)
+
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+
+        self.sock = sock
+        return sock
+
+    def set_tcp_options(self, sock: socket.socket):
+        """
+        Sets the TCP options of this listener on a socket.
+
+        These are set on the listening socket, and are inherited by every accepted connection.
+
+        :param sock: The socket to set the options on.
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(self.tcp_nodelay)))
+
+        if self.tcp_defer_accept is not None:
+            self._set_optional(sock, "TCP_DEFER_ACCEPT", self.tcp_defer_accept)
+
+        if self.tcp_fastopen is not None:
+            self._set_optional(sock, "TCP_FASTOPEN", self.tcp_fastopen)
+
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+            if isinstance(self.keepalive, dict):
+                for key, name in (("idle", "TCP_KEEPIDLE"), ("interval", "TCP_KEEPINTVL"),
+                                  ("count", "TCP_KEEPCNT")):
+                    if key in self.keepalive:
+                        self._set_optional(sock, name, self.keepalive[key])
+
+    def _set_optional(self, sock: socket.socket, name: str, value: int):
+        # Not every option is available on every platform.
+        option = getattr(socket, name, None)
+        if option is None:
+            warnings.warn("{} is not supported on this platform, ignoring.".format(name))
+            return
+
+        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+    def create_ssl_context(self, http2: bool = False) -> py_ssl.SSLContext:
+        """
+        Creates the TLS context for this listener.
+
+        .. versionchanged:: 2.2
+
+            The context is now created by a :class:`~.TLSManager`, stored on :attr:`.tls`.
+
+        :param http2: If HTTP/2 should be negotiated with ALPN and NPN.
+        :return: A new :class:`ssl.SSLContext`, or None if TLS is not enabled.
+        """
+        if self.ssl.get("enabled") is not True:
+            return None
+
+        self.tls = TLSManager(self.ssl, http2=http2)
+        return self.tls.context
@@ -1,9 +1,8 @@
 """
 Routes are wrapped function objects that are called upon a HTTP request.
 """
+import collections.abc
 import inspect
-
-import collections
 import types
 
 import typing
@@ -12,6 +11,10 @@ from werkzeug.exceptions import HTTPException, InternalServerError
 from werkzeug.routing import Rule
 from werkzeug.wrappers import Response
 
+from kyoukai.cache import ResponseCache
+from kyoukai.coalesce import Coalescer
+from kyoukai.compression import Compressor
+from kyoukai.executor import INLINE
 from kyoukai.util import wrap_response
 
 
@@ -24,7 +27,10 @@ class Route(object):
     def __init__(self, function, *,
                  reverse_hooks: bool = False,
                  should_invoke_hooks: bool = True, do_argument_checking: bool = True,
-                 endpoint: str = None):
+                 endpoint: str = None, timeout: float = None, shield: bool = False,
+                 executor: str = None, coalesce: typing.Union[bool, Coalescer] = False,
+                 cache: ResponseCache = None, etag: bool = None,
+                 compress: typing.Union[bool, Compressor] = None):
         """        
         :param function: The underlying callable.
             This can be a function, or any other callable.
@@ -38,6 +44,32 @@ class Route(object):
         :param do_argument_checking: If argument type and name checking is enabled for this route.
         
         :param endpoint: The custom endpoint for this route.
+
+        :param timeout: The maximum amount of time, in seconds, that this route can take to \
+            respond. If this is None, the ``request_timeout`` app config key is used instead.
+
+        :param shield: If this route should carry on running when the client disconnects. By \
+            default, routes are cancelled once nobody is left to receive the response.
+
+        :param executor: The executor to run this route in, if it is a synchronous function. \
+            This can be ``"thread"``, or ``"inline"`` to run it on the event loop. If this is \
+            None, the executor of the Blueprint is used. See :mod:`kyoukai.executor`.
+
+        :param coalesce: If identical concurrent requests to this route should share a single \
+            response. This can be True, or a :class:`~.Coalescer` to customize the key. See \
+            :mod:`kyoukai.coalesce`.
+
+        :param cache: The :class:`~.ResponseCache` to store the responses of this route in. If \
+            this is None, the cache of the Blueprint is used. If this is False, responses are \
+            never cached.
+
+        :param etag: If ETags should be added to the responses of this route, and conditional \
+            requests answered with a ``304``. If this is None, the Blueprint decides. See \
+            :mod:`kyoukai.conditional`.
+
+        :param compress: If the responses of this route should be compressed. This can be True, \
+            to use the default compressor of the app, or a :class:`~.Compressor`. If this is \
+            None, the Blueprint decides. See :mod:`kyoukai.compression`.
         """
         if not callable(function):
             raise TypeError("Route arg must be callable")
@@ -64,6 +96,29 @@ class Route(object):
         #: Our own specific hooks.
         self.hooks = {}
 
+        #: The maximum amount of time this route can take to respond, or None to use the default.
+        self.timeout = timeout
+
+        #: If this route carries on running when the client disconnects.
+        self.shield = shield
+
+        #: The executor this route runs in, or None to use the default.
+        self.executor = executor
+
+        #: The :class:`~.Coalescer` for this route, or None if requests are not coalesced.
+        self.coalescer = Coalescer() if coalesce is True else (coalesce or None)
+
+        #: The :class:`~.ResponseCache` for this route, None to use the cache of the Blueprint, or
+        #: False to disable caching.
+        self.cache = cache
+
+        #: If this route adds ETags to its responses, or None to use the Blueprint setting.
+        self.etag = etag
+
+        #: True, or the :class:`~.Compressor` for this route, False to disable compression, or
+        #: None to use the Blueprint setting.
+        self.compress = compress
+
     def get_rules(self) -> typing.List[Rule]:
         """
         :return: A list of :class:`werkzeug.routing.Rule` objects for this route.
@@ -103,6 +158,76 @@ class Route(object):
 
         return "{}.{}".format(prefix, self._callable.__name__)
 
+    def get_executor(self, app):
+        """
+        Gets the executor to run this route in.
+
+        This is the executor of this route, then the executor of its Blueprint, then the
+        ``sync_executor`` app config key. Coroutine functions are always run on the event loop.
+
+        .. versionadded:: 2.2.0
+
+        :param app: The :class:`~.Kyoukai` app the route is being run by.
+        :return: The :class:`~.Executor` to use, or None to call the route directly.
+        """
+        if inspect.iscoroutinefunction(self._callable):
+            return None
+
+        name = self.executor
+        if name is None and self.bp is not None:
+            name = self.bp.executor
+
+        if name is None:
+            name = app.config.get("sync_executor")
+
+        if name is None or name == INLINE:
+            return None
+
+        return app.get_executor(name)
+
+    def get_cache(self) -> typing.Union[ResponseCache, None]:
+        """
+        .. versionadded:: 2.2.0
+
+        :return: The :class:`~.ResponseCache` for this route, or the cache of its Blueprint, or \
+            None if responses are not cached.
+        """
+        if self.cache is False:
+            return None
+
+        if self.cache is not None:
+            return self.cache
+
+        return self.bp.cache if self.bp is not None else None
+
+    def get_etag(self) -> bool:
+        """
+        .. versionadded:: 2.2.0
+
+        :return: If ETags are enabled for this route, or for its Blueprint.
+        """
+        if self.etag is not None:
+            return self.etag
+
+        return bool(self.bp.etag) if self.bp is not None else False
+
+    def get_compressor(self, app) -> typing.Union[Compressor, None]:
+        """
+        .. versionadded:: 2.2.0
+
+        :param app: The :class:`~.Kyoukai` app the route is being run by.
+        :return: The :class:`~.Compressor` for this route or its Blueprint, or None if responses \
+            are not compressed.
+        """
+        compress = self.compress
+        if compress is None and self.bp is not None:
+            compress = self.bp.compress
+
+        if compress is True:
+            return app.compressor
+
+        return compress or None
+
     async def invoke_function(self, ctx, pre_hooks: list, post_hooks: list, params):
         """
         Invokes the underlying callable.
@@ -123,7 +248,13 @@ class Route(object):
                     if _ is not None:
                         ctx = _
 
-            if isinstance(params, collections.Mapping):
+            executor = self.get_executor(ctx.app)
+            if executor is not None:
+                if isinstance(params, collections.abc.Mapping):
+                    result = await executor.run(self._callable, ctx, **params)
+                else:
+                    result = await executor.run(self._callable, ctx, *params)
+            elif isinstance(params, collections.abc.Mapping):
                 result = self._callable(ctx, **params)
             else:
                 result = self._callable(ctx, *params)
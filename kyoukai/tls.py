@@ -0,0 +1,276 @@
+"""
+TLS contexts for the built-in HTTP server.
+
+A :class:`TLSManager` owns the TLS state of one listener. It can serve several certificates,
+picking one with SNI, and can reload its certificates without closing the listening socket.
+
+.. currentmodule:: kyoukai.tls
+"""
+import collections
+import logging
+import os
+import ssl
+import time
+import typing
+import warnings
+
+logger = logging.getLogger("Kyoukai")
+
+#: The ciphers that are enabled on every TLS context.
+CIPHERS = ("ECDH+CHACHA20:ECDH+CHACHA20:"  # CHACHA20 for newer openssl
+           "ECDH+AES128:RSA+AES128:"       # Standard AES
+           "ECDH+AES256:RSA+AES256:"       # Slower AES
+           "ECDH+3DES:RSA+3DES:"           # 3DES for older systems
+           "!aNULL:!eNULL:!MD5:!DSS:!RC4")  # Disable insecure ciphers
+
+# The value of OpenSSL's SSL_OP_NO_TICKET, for Pythons that don't expose it.
+SSL_OP_NO_TICKET = 0x4000
+
+
+class HandshakeMeter(object):
+    """
+    Counts TLS handshakes, and the rate they are happening at.
+
+    The rate is measured over a sliding window, with one bucket per second.
+    """
+
+    def __init__(self, window: int = 10, clock=time.monotonic):
+        """
+        :param window: The number of seconds to measure the rate over.
+        :param clock: The clock to read the time from.
+        """
+        self.window = window
+        self.clock = clock
+
+        #: The total number of handshakes.
+        self.total = 0
+
+        self._buckets = collections.deque(maxlen=window)
+
+    def record(self):
+        """
+        Records a new handshake.
+        """
+        self.total += 1
+        second = int(self.clock())
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += 1
+        else:
+            self._buckets.append([second, 1])
+
+    @property
+    def rate(self) -> float:
+        """
+        :return: The average number of handshakes per second, over the last :attr:`.window`
+            seconds.
+        """
+        oldest = int(self.clock()) - self.window
+        return sum(count for second, count in self._buckets if second > oldest) / self.window
+
+
+class TLSManager(object):
+    """
+    Creates, and keeps up to date, the TLS contexts of a listener.
+
+    The :attr:`.context` passed to the server never changes. Instead, each new connection is
+    switched to the context of the certificate it asked for during the handshake, so reloading
+    the certificates only affects new connections, and the listening socket stays open.
+
+    Sessions are resumed using the server context, which is never replaced, so clients can
+    resume their sessions across reloads.
+    """
+
+    def __init__(self, config: dict, http2: bool = False):
+        """
+        :param config: The TLS config. See :class:`~.Listener` for the keys.
+        :param http2: If HTTP/2 should be negotiated with ALPN and NPN.
+        """
+        self.config = config
+        self.http2 = http2
+
+        #: The :class:`~.HandshakeMeter` that counts the handshakes made with this listener.
+        self.handshakes = HandshakeMeter()
+
+        #: The default context, used when no certificate matches the server name.
+        self.default_context = None  # type: ssl.SSLContext
+
+        #: A mapping of hostnames to the context for that hostname.
+        #: Wildcard hostnames, such as ``*.example.com``, match one extra label.
+        self.contexts = {}  # type: typing.Dict[str, ssl.SSLContext]
+
+        self._mtimes = {}
+        self._watch_handle = None
+
+        self.load()
+
+        #: The context that is passed to the server.
+        self.context = self.create_context()
+        self.context.load_cert_chain(certfile=self.config["ssl_certfile"],
+                                     keyfile=self.config["ssl_keyfile"])
+        if hasattr(ssl.SSLContext, "sni_callback"):
+            self.context.sni_callback = self._select_context
+        else:  # pragma: no cover
+            # sni_callback is only available on Python 3.7 and above.
+            self.context.set_servername_callback(self._select_context)
+
+    @property
+    def certificates(self) -> typing.List[dict]:
+        """
+        :return: Every certificate in the config. The first certificate is the default.
+        """
+        default = {"ssl_certfile": self.config["ssl_certfile"],
+                   "ssl_keyfile": self.config["ssl_keyfile"]}
+        return [default] + list(self.config.get("certificates", []))
+
+    @property
+    def files(self) -> typing.List[str]:
+        """
+        :return: The path of every certificate and key file in the config.
+        """
+        return [path for cert in self.certificates
+                for path in (cert["ssl_certfile"], cert.get("ssl_keyfile")) if path]
+
+    def create_context(self) -> ssl.SSLContext:
+        """
+        Creates a new TLS context with the options in the config, but no certificate.
+
+        If ``session_tickets`` is False, session tickets are disabled, and sessions can only be
+        resumed with session IDs. ``num_tickets`` sets the number of tickets sent after a TLS
+        1.3 handshake.
+        """
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.set_ciphers(CIPHERS)
+
+        if self.config.get("session_tickets", True) is False:
+            # OP_NO_TICKET is only exposed on Python 3.6 and above.
+            context.options |= getattr(ssl, "OP_NO_TICKET", SSL_OP_NO_TICKET)
+        elif "num_tickets" in self.config and hasattr(context, "num_tickets"):
+            context.num_tickets = self.config["num_tickets"]
+
+        if self.http2 is True:
+            context.set_alpn_protocols(["h2"])
+
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", DeprecationWarning)
+                    context.set_npn_protocols(["h2"])
+            except (NotImplementedError, AttributeError):
+                # NPN protocol doesn't work here, so don't bother setting it
+                pass
+
+        return context
+
+    def load(self):
+        """
+        Loads every certificate in the config, replacing the current contexts.
+
+        If any certificate fails to load, the current contexts are kept, and the error is raised.
+        """
+        mtimes = {path: self._get_mtime(path) for path in self.files}
+
+        default = None
+        contexts = {}
+        for cert in self.certificates:
+            context = self.create_context()
+            context.load_cert_chain(certfile=cert["ssl_certfile"], keyfile=cert.get("ssl_keyfile"))
+            if default is None:
+                default = context
+
+            for hostname in cert.get("hostnames", []):
+                contexts[hostname.lower()] = context
+
+        self.default_context = default
+        self.contexts = contexts
+        self._mtimes = mtimes
+
+    def reload(self) -> bool:
+        """
+        Reloads the certificates, logging any errors.
+
+        :return: True if the certificates were reloaded.
+        """
+        try:
+            self.load()
+        except (OSError, ssl.SSLError) as e:
+            logger.error("Failed to reload TLS certificates, keeping the old ones: {}".format(e))
+            return False
+
+        logger.info("Reloaded {} TLS certificate(s).".format(len(self.certificates)))
+        return True
+
+    def changed(self) -> bool:
+        """
+        :return: If any of the certificate or key files have changed since they were loaded.
+        """
+        return any(self._get_mtime(path) != mtime for path, mtime in self._mtimes.items())
+
+    def watch(self, loop, interval: float = None):
+        """
+        Checks the certificate files for changes every ``interval`` seconds, and reloads them if
+        they have changed.
+
+        :param loop: The event loop to schedule the checks on.
+        :param interval: The number of seconds between each check. If this is not provided, the \
+            ``reload_interval`` config key is used. If neither are set, the files are not watched.
+        """
+        interval = interval or self.config.get("reload_interval")
+        if not interval:
+            return
+
+        def check():
+            if self.changed():
+                self.reload()
+
+            self._watch_handle = loop.call_later(interval, check)
+
+        self._watch_handle = loop.call_later(interval, check)
+
+    def stop(self):
+        """
+        Stops watching the certificate files.
+        """
+        if self._watch_handle is not None:
+            self._watch_handle.cancel()
+            self._watch_handle = None
+
+    def get_context(self, server_name: str = None) -> ssl.SSLContext:
+        """
+        Gets the context for a server name.
+
+        :param server_name: The server name sent by the client, or None if it did not send one.
+        :return: The context for the certificate matching this name, or the default context.
+        """
+        if server_name:
+            server_name = server_name.lower()
+            if server_name in self.contexts:
+                return self.contexts[server_name]
+
+            _, _, parent = server_name.partition(".")
+            wildcard = self.contexts.get("*." + parent)
+            if wildcard is not None:
+                return wildcard
+
+        return self.default_context
+
+    def stats(self) -> dict:
+        """
+        :return: The handshake rate, and the OpenSSL session statistics of the server context. \
+            ``hits`` is the number of resumed sessions, and ``misses`` is the number of sessions \
+            that could not be resumed.
+        """
+        stats = self.context.session_stats()
+        stats["handshakes"] = self.handshakes.total
+        stats["handshake_rate"] = self.handshakes.rate
+        return stats
+
+    def _select_context(self, ssl_object: ssl.SSLObject, server_name: str, _):
+        # Called by OpenSSL once the ClientHello has been received.
+        self.handshakes.record()
+        ssl_object.context = self.get_context(server_name)
+
+    @staticmethod
+    def _get_mtime(path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
@@ -1,9 +1,11 @@
 """
 Misc utilities for usage inside the framework.
 """
+import asyncio
 import json
 
 import typing
+from asphalt.core import resolve_reference
 from werkzeug.wrappers import Response
 
 
@@ -105,3 +107,50 @@ def wrap_response(args, response_class: Response = Response) -> Response:
 
     # Otherwise, wrap it in a response.
     return response_class(args)
+
+
+def set_loop_policy(policy) -> asyncio.AbstractEventLoopPolicy:
+    """
+    Installs a new event loop policy.
+
+    This must be called before the event loop is created, as any loop created by the previous
+    policy will not be replaced.
+
+    .. code-block:: python
+
+        set_loop_policy("uvloop")
+
+    .. versionadded:: 2.2.0
+
+    :param policy: The policy to install. This can be one of:
+
+        - ``"asyncio"``, for the default asyncio policy.
+        - ``"uvloop"``, for the `uvloop <https://github.com/MagicStack/uvloop>`_ policy.
+        - A ``module:varname`` reference, or dotted path, to an event loop policy.
+        - An event loop policy class, or instance.
+
+    :return: The installed :class:`asyncio.AbstractEventLoopPolicy`.
+    :raises ValueError: If the policy is a name other than ``"asyncio"`` or ``"uvloop"``.
+    :raises LookupError: If the policy is a reference that cannot be resolved.
+    """
+    if isinstance(policy, str):
+        if policy == "asyncio":
+            policy = asyncio.DefaultEventLoopPolicy
+        elif policy == "uvloop":
+            import uvloop
+            policy = uvloop.EventLoopPolicy
+        else:
+            if ":" not in policy:
+                module, _, name = policy.rpartition(".")
+                if not module:
+                    raise ValueError("Unknown event loop policy: {}".format(policy))
+
+                policy = "{}:{}".format(module, name)
+
+            policy = resolve_reference(policy)
+
+    if isinstance(policy, type):
+        policy = policy()
+
+    asyncio.set_event_loop_policy(policy)
+    return policy
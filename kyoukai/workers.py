@@ -0,0 +1,442 @@
+"""
+Multi-process worker support for the built-in HTTP server.
+
+A single Kyoukai server runs inside one event loop, and as such can only use one CPU core. The
+:class:`.WorkerSupervisor` forks several copies of the current process, each of which runs its
+own event loop.
+
+By default, each worker binds its own listening socket with ``SO_REUSEPORT``, so that the kernel
+balances incoming connections between the workers. In *preload* mode, the supervisor instead
+finalizes the app and binds the listening socket once, then forks workers that share both the
+socket and the (copy-on-write) memory of the app.
+
+.. code-block:: python
+
+    kyk = Kyoukai("my_app")
+    kyk.run("0.0.0.0", 4444, workers=4)
+
+.. currentmodule:: kyoukai.workers
+"""
+import asyncio
+import fcntl
+import gc
+import importlib
+import logging
+import os
+import select
+import signal
+import sys
+import time
+
+from asphalt.core import Context, resolve_reference
+
+from kyoukai.util import set_loop_policy
+
+logger = logging.getLogger("Kyoukai.Workers")
+
+
+def find_reference(app) -> str:
+    """
+    Finds a ``module:varname`` reference to an app, by looking for it in the globals of every
+    imported module.
+
+    This is used to reload apps that were passed to the component as an object, for example by
+    :meth:`.Kyoukai.run`.
+
+    :param app: The :class:`~.Kyoukai` app to look for.
+    :return: The reference, or None if the app is not a global of any module other than \
+        ``__main__``, which cannot be reloaded.
+    """
+    for name, module in list(sys.modules.items()):
+        if module is None or name == "__main__":
+            continue
+
+        for varname, value in list(vars(module).items()):
+            if value is app:
+                return "{}:{}".format(name, varname)
+
+    return None
+
+
+class WorkerSupervisor(object):
+    """
+    Forks and supervises a set of worker processes, each running the same Kyoukai component.
+
+    Workers that exit while the supervisor is still running are assumed to have crashed, and are
+    restarted. The supervisor responds to the following signals:
+
+        - ``SIGINT``, ``SIGTERM``: Terminate all of the workers, and exit. Workers drain their
+          in-flight requests before exiting.
+        - ``SIGHUP``: Reload the app, start a new generation of workers, and terminate the old
+          workers once every new worker is ready. See :meth:`.reload_app`.
+    """
+
+    def __init__(self, component, workers: int = 0, *, preload: bool = False,
+                 restart_delay: float = 1.0, ready_timeout: float = 30.0):
+        """
+        :param component: The :class:`~.KyoukaiComponent` to run inside each worker.
+        :param workers: The number of worker processes to run.
+            If this is 0, one worker is spawned per CPU core.
+
+        :param preload: If the app should be finalized, and the listening socket bound, inside \
+            the supervisor before forking any workers.
+
+        :param restart_delay: The minimum amount of time, in seconds, between two spawns of the \
+            same worker. This prevents a worker that crashes on startup from fork-bombing the host.
+
+        :param ready_timeout: The maximum amount of time, in seconds, to wait for a new \
+            generation of workers to start when reloading.
+        """
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Multi-process workers require os.fork()")
+
+        #: The component that each worker runs.
+        self.component = component
+
+        #: The number of workers to keep alive.
+        self.workers = workers or os.cpu_count() or 1
+
+        #: If the app is preloaded inside the supervisor.
+        self.preload = preload
+
+        #: The minimum delay between restarts of a worker.
+        self.restart_delay = restart_delay
+
+        #: The maximum amount of time to wait for new workers to become ready.
+        self.ready_timeout = ready_timeout
+
+        #: A dictionary of pid -> worker index for every live worker.
+        self.children = {}
+
+        #: The current generation of workers. This is incremented on every reload.
+        self.generation = 0
+
+        # If we are still running, i.e. dead workers should be restarted.
+        self._running = False
+
+        # PIDs of workers from previous generations, which should not be restarted.
+        self._retiring = set()
+
+        # The last time each worker index was spawned.
+        self._last_spawn = {}
+
+        # The time at which each crashed worker index should be restarted.
+        self._restarts = {}
+
+        # Signals received, which are handled in the main loop.
+        self._signals = []
+
+        # The self-pipe used to wake the main loop up when a signal arrives.
+        self._wakeup_r, self._wakeup_w = None, None
+
+    def preload_app(self):
+        """
+        Finalizes the app inside the supervisor, and freezes the garbage collector.
+
+        Freezing moves every object that exists at this point into a permanent generation that
+        the collector ignores, so that collections inside the workers do not touch (and copy) the
+        memory pages that the workers share with the supervisor.
+        """
+        self.component.app.finalize()
+
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+
+    def reload_app(self):
+        """
+        Reloads the app from its module.
+
+        The module is found from the reference the component was created with, or else by
+        looking for the app in every imported module with :func:`.find_reference`. Only the
+        module containing the app is reloaded; modules that it imports are not.
+        """
+        reference = self.component.app_reference or find_reference(self.component.app)
+        if reference is None:
+            logger.warning("The app was not found in any imported module, so the workers will be "
+                           "restarted with the code that is already loaded. Pass the app to the "
+                           "component as a \"module:varname\" reference to reload its code.")
+            return
+
+        module_name = reference.split(":", 1)[0]
+        importlib.reload(sys.modules[module_name])
+
+        app = resolve_reference(reference)
+        app.config.update(self.component.cfg)
+        self.component.app = app
+        self.component.app_reference = reference
+        logger.info("Reloaded app from {}.".format(reference))
+
+    def spawn_worker(self, index: int) -> int:
+        """
+        Forks a new worker process.
+
+        :param index: The index of the worker to spawn.
+        :return: A file descriptor that becomes readable once the worker has started.
+        """
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            # We're the supervisor.
+            os.close(ready_w)
+            self.children[pid] = index
+            self._last_spawn[index] = time.monotonic()
+            logger.info("Spawned worker {} (pid {}).".format(index, pid))
+            return ready_r
+
+        # We're the worker.
+        # Never return from this function, otherwise the worker would carry on running the
+        # supervisor loop.
+        os.close(ready_r)
+        code = 0
+        try:
+            self.run_worker(index, ready_w)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("Worker {} crashed!".format(index))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def run_worker(self, index: int, ready_fd: int):
+        """
+        Runs the component inside the current (worker) process.
+
+        This creates a brand new event loop, as the loop of the supervisor must not be shared
+        between processes.
+
+        :param index: The index of this worker.
+        :param ready_fd: The file descriptor to notify the supervisor on once started.
+        """
+        # Restore the default signal handlers, which raise KeyboardInterrupt.
+        signal.set_wakeup_fd(-1)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.default_int_handler)
+        for sig in (signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(sig, signal.SIG_DFL)
+
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.component.app.loop = loop
+        self.component.worker_index = index
+
+        context = Context()
+        loop.run_until_complete(self.component.start(context))
+
+        # Finish any in-flight requests before exiting.
+        loop.add_signal_handler(signal.SIGTERM,
+                                lambda: loop.create_task(self.component.shutdown()))
+
+        # Tell the supervisor that we're ready to serve.
+        # The supervisor only waits for this when reloading, so it may have closed its end.
+        try:
+            os.write(ready_fd, b"1")
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(ready_fd)
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(context.finished.dispatch(None, return_future=True))
+            loop.close()
+
+    def wait_ready(self, fds: list) -> bool:
+        """
+        Waits for newly spawned workers to become ready.
+
+        :param fds: The list of file descriptors returned from :meth:`.spawn_worker`.
+        :return: True if every worker became ready before the timeout, False otherwise.
+        """
+        deadline = time.monotonic() + self.ready_timeout
+        pending = list(fds)
+        ok = True
+
+        while pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                ok = False
+                break
+
+            readable, _, _ = select.select(pending, [], [], timeout)
+            for fd in readable:
+                pending.remove(fd)
+                # An empty read means the worker exited before becoming ready.
+                if not os.read(fd, 1):
+                    ok = False
+                os.close(fd)
+
+        for fd in pending:
+            os.close(fd)
+
+        return ok
+
+    def reload(self):
+        """
+        Performs a zero-downtime reload.
+
+        A new generation of workers is started, and the old workers are only terminated once
+        every new worker is ready. If the new workers fail to start, they are terminated instead,
+        and the old workers carry on serving.
+        """
+        logger.info("Reloading workers (generation {}).".format(self.generation + 1))
+        old = set(self.children)
+
+        try:
+            # New workers are forked from the supervisor, so the code must be reloaded here even
+            # if the app is not preloaded.
+            self.reload_app()
+            if self.preload:
+                self.preload_app()
+        except Exception:
+            logger.exception("Failed to reload the app, keeping the old workers.")
+            return
+
+        self.generation += 1
+        fds = [self.spawn_worker(index) for index in range(self.workers)]
+        new = set(self.children) - old
+
+        if self.wait_ready(fds):
+            retiring = old
+            # The new generation replaces any old workers that were waiting to be restarted.
+            self._restarts.clear()
+        else:
+            logger.error("New workers failed to start, keeping the old workers.")
+            self.generation -= 1
+            retiring = new
+
+        self._retiring.update(retiring)
+        for pid in retiring:
+            self._kill(pid, signal.SIGTERM)
+
+    def stop(self, graceful: bool = True):
+        """
+        Stops the supervisor, terminating every worker.
+
+        :param graceful: If False, the workers are killed instead of terminated.
+        """
+        self._running = False
+        self._restarts.clear()
+        sig = signal.SIGTERM if graceful else signal.SIGKILL
+
+        for pid in list(self.children):
+            self._kill(pid, sig)
+
+    def _kill(self, pid: int, sig: int):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _handle_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def reap_workers(self):
+        """
+        Reaps any dead workers, restarting them if required.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            index = self.children.pop(pid, None)
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+
+            if index is None or not self._running:
+                continue
+
+            logger.warning("Worker {} (pid {}) exited with status {}, restarting."
+                           .format(index, pid, status))
+
+            # Don't restart workers too quickly. The restart is scheduled rather than waited for,
+            # so that signals are still handled in the meantime.
+            self._restarts[index] = self._last_spawn[index] + self.restart_delay
+
+    def restart_workers(self):
+        """
+        Restarts any crashed workers whose restart delay has passed.
+        """
+        if not self._running:
+            self._restarts.clear()
+            return
+
+        now = time.monotonic()
+        for index, deadline in list(self._restarts.items()):
+            if deadline <= now:
+                del self._restarts[index]
+                os.close(self.spawn_worker(index))
+
+    def _get_timeout(self) -> float:
+        # Wake up in time for the next scheduled restart.
+        if not self._restarts:
+            return 1.0
+
+        return min(1.0, max(0.0, min(self._restarts.values()) - time.monotonic()))
+
+    def run(self):
+        """
+        Spawns the workers, and supervises them until the supervisor is stopped.
+
+        If the component config has a ``loop_policy`` key, the policy is installed before any
+        worker creates its event loop.
+        """
+        if self.component.cfg.get("loop_policy"):
+            set_loop_policy(self.component.cfg["loop_policy"])
+
+        if self.preload:
+            self.preload_app()
+
+        # Unix domain sockets and inherited file descriptors can't be bound by every worker, so
+        # they're always created here. TCP sockets are only created here when preloading.
+        self.component.bind(shared_only=not self.preload)
+
+        # Wake the main loop up with a self-pipe whenever a signal arrives.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self._wakeup_w)
+
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(sig, self._handle_signal)
+
+        self._running = True
+        for index in range(self.workers):
+            os.close(self.spawn_worker(index))
+
+        logger.info("Kyoukai supervising {} worker(s).".format(self.workers))
+
+        while self.children or (self._running and self._restarts):
+            select.select([self._wakeup_r], [], [], self._get_timeout())
+            try:
+                while os.read(self._wakeup_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGINT, signal.SIGTERM):
+                    # A second stop request kills the workers outright.
+                    self.stop(graceful=self._running)
+                elif signum == signal.SIGHUP and self._running:
+                    self.reload()
+
+            self.reap_workers()
+            self.restart_workers()
+
+        logger.info("All workers have exited.")
@@ -51,6 +51,7 @@ setup(
     ],
     extras_require={
         "gunicorn": ["aiohttp>=1.1.0", "gunicorn>=19.6.0"],
-        "uwsgi": ["greenlet>=0.4.0"]
+        "uwsgi": ["greenlet>=0.4.0"],
+        "uvloop": ["uvloop>=0.8.0"]
     }
 )
@@ -1,19 +1,144 @@
 """
 py.test test suite for kyoukai
 """
+import asyncio
+import gzip
+import http.client
+import multiprocessing.connection
+import os
+import signal
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.settings
 import pytest
+from asphalt.core import Context
 from werkzeug.wrappers import Response
 
 from kyoukai import __version__
-from kyoukai.asphalt import HTTPRequestContext
+from kyoukai.app import Kyoukai
+from kyoukai.asphalt import HTTPRequestContext, KyoukaiComponent
+from kyoukai.backends.http2 import H2KyoukaiComponent, H2KyoukaiProtocol, SendBuffer
+from kyoukai.backends.httptools_ import KyoukaiProtocol
+from kyoukai.backends.scheduler import PriorityScheduler
 from kyoukai.blueprint import Blueprint
+from kyoukai.cache import ResponseCache
+from kyoukai.coalesce import Coalescer
+from kyoukai.compression import Compressor
+from kyoukai.conditional import compute_etag
+from kyoukai.limiter import AdaptiveLimiter, ConcurrencyLimiter
+from kyoukai.listener import Listener
 from kyoukai.testing import TestKyoukai
-from kyoukai.util import wrap_response
+from kyoukai.util import set_loop_policy, wrap_response
+from kyoukai.workers import WorkerSupervisor
 from kyoukai.wsgi import to_wsgi_environment, get_formatted_response
 
 app = TestKyoukai("kyoukai_test")
 
 
+class FakeTransport(asyncio.Transport):
+    """
+    A transport that collects everything written to it, for in-process tests of the protocols.
+    """
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.writes = 0
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.data += data
+            self.writes += 1
+
+    def take(self) -> bytes:
+        data, self.data = bytes(self.data), bytearray()
+        return data
+
+    def get_extra_info(self, name, default=None):
+        return {"peername": ("127.0.0.1", 4444)}.get(name, default)
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+
+def h2_connect(window: int = 65535, component=None, **cfg):
+    """
+    Connects a h2 client to a HTTP/2 protocol for the test app, over a :class:`.FakeTransport`.
+
+    :param component: The component the protocol belongs to. A new one is created by default.
+    :return: A tuple of (protocol, transport, client).
+    """
+    app.loop = asyncio.get_event_loop()
+    app.finalize()
+    if component is None:
+        component = H2KyoukaiComponent(app, None, None, **cfg)
+
+    protocol = H2KyoukaiProtocol(component, Context())
+    transport = FakeTransport()
+    with pytest.warns(UserWarning):
+        protocol.connection_made(transport)
+
+    client = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True,
+                                                                  header_encoding="utf-8"))
+    client.initiate_connection()
+    client.update_settings({h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: window})
+    return protocol, transport, client
+
+
+def h11_connect(component, request: bytes = None):
+    """
+    Connects a HTTP/1.1 protocol to a :class:`.FakeTransport`, and sends it a request.
+
+    :return: A tuple of (protocol, transport).
+    """
+    protocol = KyoukaiProtocol(component, Context(), "127.0.0.1", 4444)
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    if request is not None:
+        protocol.data_received(request)
+
+    return protocol, transport
+
+
+async def h2_exchange(protocol, transport, client, streams: int, uploads: dict = None):
+    """
+    Passes data between a h2 client and a protocol until ``streams`` responses have finished.
+
+    :param uploads: A dict of stream ID -> request body to send, as flow control allows.
+    :return: A dict of stream ID -> response body.
+    """
+    bodies, finished = {}, set()
+    uploads = {stream_id: memoryview(body) for (stream_id, body) in (uploads or {}).items()}
+    while len(finished) < streams:
+        for stream_id, body in list(uploads.items()):
+            size = min(client.local_flow_control_window(stream_id), client.max_outbound_frame_size)
+            uploads[stream_id] = body[size:]
+            client.send_data(stream_id, body[:size].tobytes(), end_stream=len(body) <= size)
+            if len(body) <= size:
+                del uploads[stream_id]
+
+        protocol.data_received(client.data_to_send())
+        await asyncio.sleep(0)
+        for event in client.receive_data(transport.take()):
+            if isinstance(event, h2.events.DataReceived):
+                bodies.setdefault(event.stream_id, bytearray()).extend(event.data)
+                client.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, (h2.events.StreamEnded, h2.events.StreamReset)):
+                finished.add(event.stream_id)
+
+    return bodies
+
+
 # finalize
 app.finalize()
 
@@ -110,3 +235,1458 @@ async def test_get_formatted_response():
 
 
 
+
+
+def test_listener_options(tmpdir):
+    """
+    Tests creating listening sockets with socket options.
+    """
+    listener = Listener.from_config({"port": 0, "keepalive": True},
+                                    {"port": 4444, "tcp_nodelay": True, "workers": 4})
+    sock = listener.create_socket()
+    try:
+        assert sock.getsockname()[1] != 4444
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    finally:
+        sock.close()
+
+    path = str(tmpdir.join("kyoukai.sock"))
+    listener = Listener.from_config({"unix": path, "unix_mode": 0o600})
+    sock = listener.create_socket()
+    try:
+        assert listener.shared
+        assert sock.family == socket.AF_UNIX
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    finally:
+        sock.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def http_get(port: int, path: str = "/") -> bytes:
+    """
+    Makes a request to a server on a new connection, retrying until it has started.
+    """
+    for _ in range(100):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        try:
+            connection.request("GET", path, headers={"Connection": "close"})
+            return connection.getresponse().read()
+        except ConnectionError:
+            # The server hasn't started yet, or a worker was killed with the connection queued.
+            time.sleep(0.05)
+        finally:
+            connection.close()
+
+    raise ConnectionError(port)
+
+
+def wait_exited(pid: int, timeout: float = 10) -> int:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        waited, status = os.waitpid(pid, os.WNOHANG)
+        if waited:
+            return status
+
+        time.sleep(0.05)
+
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    raise TimeoutError(pid)
+
+
+def run_supervisor(supervisor: WorkerSupervisor) -> int:
+    """
+    Runs a supervisor in a forked process, so that its signal handlers don't replace ours.
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            supervisor.run()
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+
+    return pid
+
+
+def test_worker_supervisor():
+    port = free_port()
+    worker_app = Kyoukai("worker_test")
+
+    @worker_app.route("/")
+    async def index(ctx: HTTPRequestContext):
+        return Response(str(os.getpid()))
+
+    supervisor = WorkerSupervisor(KyoukaiComponent(worker_app, "127.0.0.1", port, workers=2), 2)
+    pid = run_supervisor(supervisor)
+    try:
+        # Each worker binds its own socket with SO_REUSEPORT, and both of them serve requests.
+        pids = set()
+        for _ in range(200):
+            pids.add(int(http_get(port)))
+            if len(pids) == 2:
+                break
+
+        assert len(pids) == 2 and pid not in pids
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        status = wait_exited(pid)
+
+    # Every worker exits cleanly, and the supervisor exits once they have all been reaped.
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    for worker in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(worker, 0)
+
+
+def test_worker_restart():
+    port = free_port()
+    worker_app = Kyoukai("worker_test")
+
+    @worker_app.route("/")
+    async def index(ctx: HTTPRequestContext):
+        return Response(str(os.getpid()))
+
+    component = KyoukaiComponent(worker_app, "127.0.0.1", port, workers=1)
+    pid = run_supervisor(WorkerSupervisor(component, 1, restart_delay=0.2))
+    try:
+        # Crashed workers are reaped and restarted.
+        worker = int(http_get(port))
+        os.kill(worker, signal.SIGKILL)
+        restarted = int(http_get(port))
+        assert restarted != worker
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        wait_exited(pid)
+
+    port = free_port()
+    component = KyoukaiComponent(worker_app, "127.0.0.1", port, workers=1)
+    pid = run_supervisor(WorkerSupervisor(component, 1, restart_delay=60))
+    worker = int(http_get(port))
+    os.kill(worker, signal.SIGKILL)
+    time.sleep(0.2)
+
+    # The supervisor still handles signals while it waits to restart the worker.
+    start = time.monotonic()
+    os.kill(pid, signal.SIGTERM)
+    status = wait_exited(pid)
+    assert time.monotonic() - start < 5
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+RELOAD_MODULE = """
+from werkzeug.wrappers import Response
+from kyoukai.app import Kyoukai
+
+app = Kyoukai({name!r})
+
+
+@app.route("/")
+async def index(ctx):
+    return Response(app.name)
+"""
+
+
+def test_worker_reload(tmpdir, monkeypatch, caplog):
+    module = tmpdir.join("kyoukai_reload_app.py")
+    module.write(RELOAD_MODULE.format(name="v1"))
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr("sys.dont_write_bytecode", True)
+
+    import kyoukai_reload_app
+    port = free_port()
+    # The app is passed as an object, like Kyoukai.run does, and is found in its module.
+    component = KyoukaiComponent(kyoukai_reload_app.app, "127.0.0.1", port, workers=2)
+    supervisor = WorkerSupervisor(component, 2)
+
+    pid = run_supervisor(supervisor)
+    try:
+        assert http_get(port) == b"v1"
+
+        # Workers are forked from the supervisor, so the code is reloaded without preloading.
+        module.write(RELOAD_MODULE.format(name="version-two"))
+        os.kill(pid, signal.SIGHUP)
+        for _ in range(100):
+            if http_get(port) == b"version-two":
+                break
+
+            time.sleep(0.05)
+        else:
+            pytest.fail("The app was not reloaded")
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        wait_exited(pid)
+
+    supervisor.reload_app()
+    assert component.app.name == "version-two"
+    assert component.app_reference == "kyoukai_reload_app:app"
+
+    # Apps that aren't in any module are left alone.
+    component = KyoukaiComponent(Kyoukai("main"), "127.0.0.1", port)
+    WorkerSupervisor(component, 2).reload_app()
+    assert component.app.name == "main"
+    assert "not found in any imported module" in caplog.text
+
+
+def test_set_loop_policy():
+    old = asyncio.get_event_loop_policy()
+    try:
+        assert type(set_loop_policy("asyncio")) is asyncio.DefaultEventLoopPolicy
+        assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+
+        # References can be given with a colon, or as a dotted path.
+        policy = set_loop_policy("asyncio:DefaultEventLoopPolicy")
+        assert isinstance(policy, asyncio.DefaultEventLoopPolicy)
+        assert set_loop_policy("asyncio.DefaultEventLoopPolicy") is not policy
+
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            assert isinstance(set_loop_policy("uvloop"), uvloop.EventLoopPolicy)
+
+        with pytest.raises(ValueError):
+            set_loop_policy("trio")
+
+        with pytest.raises(LookupError):
+            set_loop_policy("kyoukai_no_such_module.Policy")
+    finally:
+        asyncio.set_event_loop_policy(old)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(1, max_queue=1, queue_timeout=0.05)
+    assert limiter.try_acquire()
+
+    # The second request waits in the queue, and the third is shed immediately.
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.queued == 1
+    assert not await limiter.acquire()
+    assert limiter.shed == 1
+
+    # Releasing hands the slot over to the waiting request.
+    limiter.release()
+    assert await waiter
+    assert limiter.in_flight == 1 and limiter.queued == 0
+
+    # Requests that wait for too long are shed.
+    assert not await limiter.acquire()
+    assert limiter.shed == 2 and limiter.queued == 0
+
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_load_shedding():
+    """
+    Tests that the protocols shed requests over the limit with a pre-serialized 503.
+    """
+    with app.testing_bp() as bp:
+        release = asyncio.Event()
+
+        @bp.route("/slow")
+        async def slow(ctx: HTTPRequestContext):
+            await release.wait()
+            return Response("ok {}".format(ctx.request.args["a"]))
+
+        get = b"GET /slow?a=%s HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        app.loop = asyncio.get_event_loop()
+        app.finalize()
+        try:
+            component = KyoukaiComponent(app, run_server=False, max_in_flight=1, max_queue=1,
+                                         retry_after=3)
+            limiter = component.limiter
+
+            first, first_transport = h11_connect(component, get % b"0")
+            await asyncio.sleep(0.01)
+            assert limiter.in_flight == 1
+
+            # The first pipelined request waits in the queue, and the second waits behind it.
+            pipelined, pipelined_transport = h11_connect(component, get % b"1" + get % b"2")
+            await asyncio.sleep(0.01)
+            assert limiter.queued == 1 and limiter.shed == 0
+
+            # The queue is full, so other requests are shed straight away.
+            shed, shed_transport = h11_connect(component, get % b"3")
+            await asyncio.sleep(0.01)
+            response = shed_transport.take()
+            assert response.startswith(b"HTTP/1.1 503 SERVICE UNAVAILABLE\r\n")
+            assert b"Retry-After: 3\r\n" in response
+            assert limiter.shed == 1
+
+            protocol, transport, client = h2_connect(component=component)
+            client.send_headers(1, [(":method", "GET"), (":path", "/slow?a=4"),
+                                    (":authority", "localhost"), (":scheme", "http")],
+                                end_stream=True)
+            protocol.data_received(client.data_to_send())
+            await asyncio.sleep(0.01)
+            events = client.receive_data(transport.take())
+            headers = [dict(event.headers) for event in events
+                       if isinstance(event, h2.events.ResponseReceived)]
+            assert headers == [{":status": "503", "server": "Kyoukai", "retry-after": "3",
+                                "content-length": "0"}]
+            assert limiter.shed == 2
+
+            release.set()
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+
+            # The pipelined responses are written in the order the requests were sent.
+            data = bytes(pipelined_transport.data)
+            assert b"503" not in data and data.index(b"ok 1") < data.index(b"ok 2")
+            assert b"ok 0" in first_transport.data
+            assert limiter.in_flight == 0 and limiter.queued == 0
+        finally:
+            app.loop = None
+
+@pytest.mark.asyncio
+async def test_blueprint_limiter():
+    """
+    Tests limiting the routes of a Blueprint and its children.
+    """
+    limiter = ConcurrencyLimiter(1, retry_after=5)
+    release = asyncio.Event()
+
+    with app.testing_bp() as bp:
+        api = bp.add_child(Blueprint("api", prefix="/api", limiter=limiter))
+        v1 = api.add_child(Blueprint("v1", prefix="/v1"))
+
+        @v1.route("/slow")
+        async def slow(ctx: HTTPRequestContext):
+            await release.wait()
+            return Response("done")
+
+        @bp.route("/free")
+        async def free(ctx: HTTPRequestContext):
+            return Response("free")
+
+        assert v1.limiter is limiter and bp.limiter is None
+
+        app.loop = asyncio.get_event_loop()
+        try:
+            first = asyncio.ensure_future(app.inject_request({}, "/api/v1/slow"))
+            await asyncio.sleep(0.01)
+            assert limiter.in_flight == 1
+
+            # The child Blueprint inherits the limiter, so a second request is shed.
+            r = await app.inject_request({}, "/api/v1/slow")
+            assert r.status_code == 503 and r.headers["Retry-After"] == "5"
+            assert limiter.shed == 1
+
+            # Routes outside of the Blueprint are not limited.
+            r = await app.inject_request({}, "/free")
+            assert r.data == b"free"
+
+            # Shed requests go through the error handlers like any other 503.
+            @api.errorhandler(503)
+            async def busy(ctx: HTTPRequestContext, exc):
+                return Response("busy", status=503, headers={"Retry-After": exc.retry_after})
+
+            r = await app.inject_request({}, "/api/v1/slow")
+            assert r.data == b"busy" and r.headers["Retry-After"] == "5"
+
+            release.set()
+            r = await first
+            assert r.data == b"done" and limiter.in_flight == 0
+        finally:
+            app.loop = None
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(4, max_limit=500, window=20)
+
+    # A simulated handler, whose latency is flat up to 32 concurrent requests, then increases
+    # linearly with load.
+    def latency(concurrency: int) -> float:
+        return 0.01 * max(1, concurrency / 32)
+
+    limits = []
+    for _ in range(600):
+        # The offered load is unbounded, so admit as many requests as the limiter allows.
+        admitted = 0
+        while limiter.try_acquire():
+            admitted += 1
+
+        for _ in range(admitted):
+            limiter.release(latency(admitted))
+
+        limits.append(limiter.limit)
+
+    assert limiter.in_flight == 0
+
+    # The limit should settle between the point where latency starts to increase, and the point
+    # where it has doubled.
+    average = sum(limits[-300:]) / 300
+    assert 32 <= average <= 64
+
+
+@pytest.mark.asyncio
+async def test_route_timeout():
+    with app.testing_bp() as bp:
+        @bp.route("/slow", timeout=0.05)
+        async def slow(ctx: HTTPRequestContext):
+            await asyncio.sleep(1)
+            return Response("Too slow")
+
+        @bp.route("/deadline", timeout=10)
+        async def deadline(ctx: HTTPRequestContext):
+            return Response(str(ctx.deadline))
+
+        r = await app.inject_request({}, "/slow")
+        assert r.status_code == 504
+
+        r = await app.inject_request({}, "/deadline")
+        assert 0 < float(r.data) <= 10
+
+
+@pytest.mark.asyncio
+async def test_drain():
+    with app.testing_bp() as bp:
+        release = asyncio.Event()
+
+        @bp.route("/wait")
+        async def wait(ctx: HTTPRequestContext):
+            await release.wait()
+            return Response("done")
+
+        @bp.route("/forever")
+        async def forever(ctx: HTTPRequestContext):
+            await asyncio.sleep(60)
+
+        get = b"GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        headers = [(":method", "GET"), (":path", "/wait"), (":authority", "localhost"),
+                   (":scheme", "http")]
+        app.loop = asyncio.get_event_loop()
+        try:
+            # Finishing the context the component was started in drains the server.
+            context = Context()
+            component = KyoukaiComponent(app, run_server=False)
+            await component.start(context)
+
+            idle, idle_transport = h11_connect(component)
+            busy, busy_transport = h11_connect(component, get % b"wait")
+            protocol, transport, client = h2_connect(component=component)
+            client.send_headers(1, headers, end_stream=True)
+            protocol.data_received(client.data_to_send())
+            client.receive_data(transport.take())
+            await asyncio.sleep(0)
+            assert component.remaining == 2
+
+            finished = context.finished.dispatch(None, return_future=True)
+            await asyncio.sleep(0.01)
+            assert component.draining and idle_transport.closed
+            assert not busy_transport.closed
+
+            # HTTP/2 clients are told the last stream that will be processed.
+            events = client.receive_data(transport.take())
+            goaway = [event for event in events
+                      if isinstance(event, h2.events.ConnectionTerminated)]
+            assert goaway[0].last_stream_id == 1 and not transport.closed
+
+            # In-flight requests are finished before their connections are closed.
+            release.set()
+            await finished
+            assert b"Connection: close" in busy_transport.data and busy_transport.closed
+            assert b"done" in transport.data
+            assert transport.closed and component.remaining == 0
+
+            # Requests that don't finish in time are cancelled.
+            component = KyoukaiComponent(app, run_server=False)
+            busy, busy_transport = h11_connect(component, get % b"forever")
+            await asyncio.sleep(0)
+            assert await component.drain(timeout=0.05) == 1
+            assert busy.in_flight == 0 and busy_transport.closed
+            assert not busy_transport.data
+        finally:
+            app.loop = None
+
+
+@pytest.mark.asyncio
+async def test_disconnect_cancellation():
+    with app.testing_bp() as bp:
+        release = asyncio.Event()
+        cancelled, finished = [], []
+
+        @bp.route("/forever/<name>")
+        async def forever(ctx: HTTPRequestContext, name: str):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+
+        @bp.route("/echo/<name>")
+        async def echo(ctx: HTTPRequestContext, name: str):
+            return Response(name)
+
+        @bp.route("/shielded", shield=True)
+        async def shielded(ctx: HTTPRequestContext):
+            await release.wait()
+            finished.append("shielded")
+            return Response("done")
+
+        @bp.route("/disconnected", shield=True)
+        async def disconnected(ctx: HTTPRequestContext):
+            await ctx.disconnected()
+            finished.append("disconnected")
+            return Response("gone")
+
+        app.loop = asyncio.get_event_loop()
+        app.finalize()
+        get = b"GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        try:
+            # Pipelined requests are each processed with their own URL, and answered in order.
+            component = KyoukaiComponent(app)
+            protocol, transport = h11_connect(component, get % b"/echo/a" + get % b"/echo/b")
+            await asyncio.sleep(0.01)
+            data = transport.take()
+            assert data.index(b"\r\n\r\na") < data.index(b"\r\n\r\nb")
+
+            # Every pipelined request is cancelled when the connection is lost, not only the last.
+            protocol, transport = h11_connect(component, get % b"/forever/1" + get % b"/forever/2")
+            await asyncio.sleep(0.01)
+            assert len(protocol.waiters) == 2
+            protocol.connection_lost(None)
+            await asyncio.sleep(0.01)
+            # The second request is still waiting for the first, so it never reaches the route.
+            assert cancelled == ["1"] and protocol.in_flight == 0 and not protocol.waiters
+            del cancelled[:]
+
+            # Shielded routes carry on, and can wait for the client to go away.
+            protocol, transport = h11_connect(component, get % b"/disconnected")
+            await asyncio.sleep(0.01)
+            assert not finished
+            protocol.connection_lost(None)
+            await asyncio.sleep(0.01)
+            assert finished == ["disconnected"]
+
+            protocol, transport = h11_connect(component, get % b"/shielded")
+            await asyncio.sleep(0.01)
+            protocol.connection_lost(None)
+            release.set()
+            await asyncio.sleep(0.01)
+            assert finished == ["disconnected", "shielded"] and protocol.in_flight == 0
+
+            # HTTP/2 streams are cancelled when the client resets them.
+            del finished[:]
+            release.clear()
+            protocol, transport, client = h2_connect()
+            for stream_id, path in ((1, "/forever/1"), (3, "/shielded"), (5, "/disconnected"),
+                                    (7, "/forever/7")):
+                client.send_headers(stream_id, [(":method", "GET"), (":path", path),
+                                                (":authority", "localhost"), (":scheme", "http")],
+                                    end_stream=True)
+
+            protocol.data_received(client.data_to_send())
+            await asyncio.sleep(0.01)
+            client.reset_stream(1)
+            client.reset_stream(3)
+            protocol.data_received(client.data_to_send())
+            await asyncio.sleep(0.01)
+            assert cancelled == ["1"] and not finished
+
+            # The shielded stream finishes, even though nobody will get its response.
+            release.set()
+            await asyncio.sleep(0.01)
+            assert finished == ["shielded"] and 3 not in protocol.streams
+
+            # Losing the connection cancels the other streams, and wakes up ctx.disconnected().
+            protocol.connection_lost(None)
+            await asyncio.sleep(0.01)
+            assert cancelled == ["1", "7"]
+            assert finished == ["shielded", "disconnected"]
+            assert not protocol.streams
+        finally:
+            app.loop = None
+
+
+def test_priority_scheduler():
+    scheduler = PriorityScheduler()
+    scheduler.insert(1, weight=16)
+    scheduler.insert(3, weight=48)
+    # Stream 5 depends on stream 1, so only sends when stream 1 can't.
+    scheduler.insert(5, depends_on=1)
+
+    for stream_id in (1, 3, 5):
+        scheduler.unblock(stream_id)
+
+    picks = [scheduler.next() for _ in range(400)]
+    assert picks.count(1) == 100 and picks.count(3) == 300 and 5 not in picks
+
+    scheduler.block(1)
+    picks = [scheduler.next() for _ in range(400)]
+    assert picks.count(5) == 100 and picks.count(3) == 300
+
+    scheduler.remove(1)
+    scheduler.block(3)
+    assert scheduler.next() == 5
+    assert len(scheduler) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("window", [8000, 1 << 20])
+async def test_http2_flow_control(window: int):
+    with app.testing_bp() as bp:
+        @bp.route("/big/<int:size>")
+        def big(ctx: HTTPRequestContext, size: int):
+            # Chunks that don't line up with the frame or window sizes.
+            return Response(bytes([size % 251]) * 70001 for _ in range(size))
+
+        # Streams are blocked over and over again, by either their own window, or the (smaller)
+        # connection window.
+        protocol, transport, client = h2_connect(window=window)
+        try:
+            for stream_id, size in ((1, 40), (3, 25)):
+                client.send_headers(stream_id, [(":method", "GET"), (":path", "/big/%d" % size),
+                                                (":authority", "localhost"),
+                                                (":scheme", "http")], end_stream=True)
+
+            bodies = await h2_exchange(protocol, transport, client, streams=2)
+        finally:
+            app.loop = None
+
+        assert bodies[1] == bytes([40]) * 70001 * 40
+        assert bodies[3] == bytes([25]) * 70001 * 25
+        assert not protocol.streams and not len(protocol.scheduler)
+
+
+class AsyncBody(object):
+    """
+    An asynchronous response body, which counts the chunks that have been taken from it.
+    """
+    def __init__(self, chunk: bytes, count: int):
+        self.chunk = chunk
+        self.count = count
+        self.taken = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.taken == self.count:
+            raise StopAsyncIteration
+
+        self.taken += 1
+        await asyncio.sleep(0)
+        return self.chunk
+
+
+@pytest.mark.asyncio
+async def test_send_buffer():
+    buffer = SendBuffer(max_size=10)
+    buffer.write(b"abcdef")
+    await asyncio.wait_for(buffer.wait_for_space(), 1)
+
+    # Once the buffer is full, producers wait until enough has been read from it.
+    buffer.write(b"ghijkl")
+    waiter = asyncio.ensure_future(buffer.wait_for_space())
+    await asyncio.sleep(0)
+    assert not waiter.done() and buffer.size == 12
+
+    assert buffer.read(4) == b"abcd"
+    assert buffer.read(4) == b"efgh"
+    await asyncio.sleep(0)
+    assert waiter.done() and buffer.size == 4
+
+    # Synchronous iterators are only pulled from until the buffer is full.
+    buffer = SendBuffer(max_size=10)
+    pulled = []
+    buffer.iterator = iter(pulled.append(i) or b"xxxx" for i in range(5))
+    buffer.fill()
+    assert len(pulled) == 3 and not buffer.finished
+    buffer.read(12)
+    buffer.fill()
+    assert len(pulled) == 5 and buffer.finished and buffer.iterator is None
+
+
+@pytest.mark.asyncio
+async def test_http2_async_body():
+    with app.testing_bp() as bp:
+        bodies = {}
+
+        @bp.route("/stream/<int:count>")
+        async def stream(ctx: HTTPRequestContext, count: int):
+            bodies[count] = AsyncBody(b"0123456789" * 100, count)
+            return Response(bodies[count])
+
+        # The client doesn't let the server send anything yet.
+        protocol, transport, client = h2_connect(window=0, http2_buffer_size=4096)
+        try:
+            for stream_id, count in ((1, 5), (3, 1000)):
+                client.send_headers(stream_id, [(":method", "GET"),
+                                                (":path", "/stream/%d" % count),
+                                                (":authority", "localhost"),
+                                                (":scheme", "http")], end_stream=True)
+
+            protocol.data_received(client.data_to_send())
+            client.receive_data(transport.take())
+            for _ in range(50):
+                await asyncio.sleep(0)
+
+            # The producer of a large body stops once the send buffer is full.
+            assert bodies[5].taken == 5
+            assert 4 <= bodies[1000].taken <= 6
+
+            client.update_settings({h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: 65535})
+            received = await h2_exchange(protocol, transport, client, streams=2)
+        finally:
+            app.loop = None
+
+        assert received[1] == b"0123456789" * 100 * 5
+        assert received[3] == b"0123456789" * 100 * 1000
+        assert not protocol.streams
+
+
+@pytest.mark.asyncio
+async def test_http11_streamed_body():
+    """
+    Tests that streamed bodies are sent over HTTP/1.1 with a Content-Length.
+    """
+    with app.testing_bp() as bp:
+        @bp.route("/gen", compress=Compressor(min_size=0))
+        async def gen(ctx: HTTPRequestContext):
+            return Response(chunk for chunk in ("Hello, ", "world!"))
+
+        @bp.route("/agen")
+        async def agen(ctx: HTTPRequestContext):
+            return Response(AsyncBody(b"abc", 3))
+
+        app.loop = asyncio.get_event_loop()
+        app.finalize()
+        try:
+            component = KyoukaiComponent(app, run_server=False)
+
+            async def get(path: bytes, headers: bytes = b"") -> tuple:
+                protocol, transport = h11_connect(
+                    component, b"GET " + path + b" HTTP/1.1\r\nHost: localhost\r\n" + headers
+                    + b"\r\n"
+                )
+                await asyncio.sleep(0.01)
+                # The connection is kept alive, so the body must be delimited.
+                assert not transport.closed
+                head, body = transport.take().split(b"\r\n\r\n", 1)
+                assert b"\r\nContent-Length: %d\r\n" % len(body) in head + b"\r\n"
+                return head, body
+
+            assert (await get(b"/gen"))[1] == b"Hello, world!"
+            assert (await get(b"/agen"))[1] == b"abcabcabc"
+
+            # Compressed streams have their Content-Length removed, and it is added back.
+            head, body = await get(b"/gen", b"Accept-Encoding: gzip\r\n")
+            assert b"Content-Encoding: gzip" in head
+            assert gzip.decompress(body) == b"Hello, world!"
+        finally:
+            app.loop = None
+
+def test_http2_component_config():
+    """
+    Tests that the HTTP/2 component copies its config into the app, like KyoukaiComponent.
+    """
+    try:
+        H2KyoukaiComponent(app, None, None, request_timeout=5, etag_thread_threshold=1024)
+        assert app.config["request_timeout"] == 5
+        assert app.config["etag_thread_threshold"] == 1024
+    finally:
+        for key in ("request_timeout", "etag_thread_threshold"):
+            app.config.pop(key, None)
+
+@pytest.mark.asyncio
+async def test_http2_write_coalescing():
+    with app.testing_bp() as bp:
+        @bp.route("/")
+        async def index(ctx: HTTPRequestContext):
+            return Response("Hello, world!")
+
+        protocol, transport, client = h2_connect()
+        headers = [(":method", "GET"), (":path", "/"), (":authority", "localhost"),
+                   (":scheme", "http")]
+        try:
+            protocol.data_received(client.data_to_send())
+            await asyncio.sleep(0)
+            client.receive_data(transport.take())
+            transport.writes = 0
+
+            # Every stream is opened in the same iteration of the event loop.
+            for stream_id in range(1, 201, 2):
+                client.send_headers(stream_id, headers, end_stream=True)
+
+            protocol.data_received(client.data_to_send())
+            bodies = await h2_exchange(protocol, transport, client, streams=100)
+        finally:
+            app.loop = None
+
+        assert len(bodies) == 100 and all(body == b"Hello, world!" for body in bodies.values())
+
+        # The 200 HEADERS and DATA frames of the responses are gathered into a couple of writes,
+        # one for each iteration of the event loop that produced frames.
+        assert transport.writes <= 4
+
+
+@pytest.mark.asyncio
+async def test_http2_paused_transport():
+    """
+    Tests that a stream woken while the transport is paused is still sent.
+    """
+    body = b"0123456789" * 20000
+
+    with app.testing_bp() as bp:
+        @bp.route("/big")
+        async def big(ctx: HTTPRequestContext):
+            return Response(body)
+
+        protocol, transport, client = h2_connect()
+        write = transport.write
+
+        def pausing_write(data):
+            # The transport's buffer fills up once the first window of data has been written.
+            write(data)
+            if len(transport.data) > 65535:
+                protocol.pause_writing()
+
+        transport.write = pausing_write
+        try:
+            client.send_headers(1, [(":method", "GET"), (":path", "/big"),
+                                    (":authority", "localhost"), (":scheme", "http")],
+                                end_stream=True)
+            protocol.data_received(client.data_to_send())
+            for _ in range(10):
+                await asyncio.sleep(0)
+
+            # The first window has been sent, and the writer waits for the transport.
+            received = 0
+            for event in client.receive_data(transport.take()):
+                if isinstance(event, h2.events.DataReceived):
+                    received += len(event.data)
+                    client.acknowledge_received_data(event.flow_controlled_length, 1)
+            assert received == 65535
+
+            # The window update wakes the stream before the transport is resumed.
+            protocol.data_received(client.data_to_send())
+            transport.write = write
+            protocol.resume_writing()
+
+            bodies = await asyncio.wait_for(h2_exchange(protocol, transport, client, streams=1),
+                                            5)
+        finally:
+            app.loop = None
+
+        assert received + len(bodies[1]) == len(body)
+
+@pytest.mark.asyncio
+async def test_http2_upload():
+    with app.testing_bp() as bp:
+        @bp.route("/upload", methods=["POST"])
+        async def upload(ctx: HTTPRequestContext):
+            stream = ctx.request.environ["wsgi.input"]
+            # More than a window's worth, which only arrives as it is read.
+            head = await stream.readexactly(1 << 21)
+            body = head + await stream.read_async()
+            with pytest.raises(asyncio.IncompleteReadError):
+                await stream.readexactly(1)
+
+            return Response(str(len(body)))
+
+        protocol, transport, client = h2_connect(http2_initial_window_size=1 << 20,
+                                                 http2_max_frame_size=1 << 15)
+        try:
+            client.send_headers(1, [(":method", "POST"), (":path", "/upload"),
+                                    (":authority", "localhost"), (":scheme", "http")])
+            # The body is far bigger than the default window, so this only finishes if the
+            # server hands the window back as the body is read.
+            bodies = await h2_exchange(protocol, transport, client, streams=1,
+                                       uploads={1: bytes(3 << 20)})
+        finally:
+            app.loop = None
+
+        assert bodies[1] == str(3 << 20).encode()
+        assert client.max_outbound_frame_size == 1 << 15
+        assert client.local_flow_control_window(1) > 65535
+
+
+@pytest.mark.asyncio
+async def test_http2_stream_lifecycle():
+    with app.testing_bp() as bp:
+        release = asyncio.Event()
+
+        @bp.route("/wait", shield=True)
+        async def wait(ctx: HTTPRequestContext):
+            await release.wait()
+            return Response("done")
+
+        protocol, transport, client = h2_connect(http2_max_concurrent_streams=4)
+        headers = [(":method", "GET"), (":path", "/wait"), (":authority", "localhost"),
+                   (":scheme", "http")]
+        try:
+            # Exchange settings, so that the client knows the limit.
+            protocol.data_received(client.data_to_send())
+            client.receive_data(transport.take())
+
+            for stream_id in (1, 3, 5, 7):
+                client.send_headers(stream_id, headers, end_stream=True)
+
+            # The route for stream 1 carries on running after it is reset, so it still counts
+            # towards the limit, even though h2 considers it closed.
+            client.reset_stream(1)
+            client.send_headers(9, headers, end_stream=True)
+            protocol.data_received(client.data_to_send())
+            await asyncio.sleep(0)
+
+            refused = [event.stream_id for event in client.receive_data(transport.take())
+                       if isinstance(event, h2.events.StreamReset)]
+            assert refused == [9]
+            assert sorted(protocol.streams) == [1, 3, 5, 7]
+
+            release.set()
+            await h2_exchange(protocol, transport, client, streams=3)
+            assert not protocol.streams
+
+            # Finished streams are released too, so a long-lived connection only holds state for
+            # the streams that are open.
+            for stream_id in range(11, 411, 2):
+                client.send_headers(stream_id, headers, end_stream=True)
+                await h2_exchange(protocol, transport, client, streams=1)
+        finally:
+            app.loop = None
+
+        assert not protocol.streams and not len(protocol.scheduler)
+
+
+@pytest.mark.asyncio
+async def test_http2_push():
+    with app.testing_bp() as bp:
+        pushed = []
+
+        @bp.route("/")
+        async def index(ctx: HTTPRequestContext):
+            pushed.append(ctx.push("/style.css", headers=[("Accept", "text/css")]))
+            pushed.append(ctx.push("/script.js"))
+            return Response("index")
+
+        @bp.route("/style.css")
+        async def style(ctx: HTTPRequestContext):
+            return Response(ctx.request.headers["Accept"])
+
+        headers = [(":method", "GET"), (":path", "/"), (":authority", "localhost"),
+                   (":scheme", "http")]
+        try:
+            # Only one push is allowed per connection.
+            protocol, transport, client = h2_connect(http2_max_pushes=1)
+            client.send_headers(1, headers, end_stream=True)
+            bodies = await h2_exchange(protocol, transport, client, streams=2)
+            assert pushed == [True, False]
+            assert bodies == {1: b"index", 2: b"text/css"}
+
+            # Clients can turn pushes off.
+            protocol, transport, client = h2_connect()
+            client.update_settings({h2.settings.SettingCodes.ENABLE_PUSH: 0})
+            client.send_headers(1, headers, end_stream=True)
+            await h2_exchange(protocol, transport, client, streams=1)
+            assert pushed[2:] == [False, False]
+        finally:
+            app.loop = None
+
+        # Pushes are only possible over HTTP/2.
+        await app.inject_request({}, "/")
+        assert pushed[4:] == [False, False]
+
+
+@pytest.mark.asyncio
+async def test_http2_prior_knowledge():
+    with app.testing_bp() as bp:
+        @bp.route("/")
+        async def index(ctx: HTTPRequestContext):
+            return Response(ctx.request.environ["SERVER_PROTOCOL"])
+
+        app.loop = asyncio.get_event_loop()
+        app.finalize()
+        component = KyoukaiComponent(app, http2=True)
+        try:
+            # Plain HTTP/1.1 still works on the same listener.
+            protocol = KyoukaiProtocol(component, Context(), "127.0.0.1", 4444)
+            transport = FakeTransport()
+            protocol.connection_made(transport)
+            protocol.data_received(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            for _ in range(10):
+                await asyncio.sleep(0)
+
+            assert transport.take().endswith(b"HTTP/1.1")
+
+            # HTTP/2 with prior knowledge is detected, even if the preface is split up.
+            protocol = KyoukaiProtocol(component, Context(), "127.0.0.1", 4444)
+            transport = FakeTransport()
+            protocol.connection_made(transport)
+
+            client = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True))
+            client.initiate_connection()
+            client.send_headers(1, [(":method", "GET"), (":path", "/"),
+                                    (":authority", "localhost"), (":scheme", "http")],
+                                end_stream=True)
+            data = client.data_to_send()
+            protocol.data_received(data[:5])
+            with pytest.warns(UserWarning):
+                protocol.data_received(data[5:])
+
+            assert isinstance(protocol, H2KyoukaiProtocol)
+            bodies = await h2_exchange(protocol, transport, client, streams=1)
+            assert bodies[1] == b"HTTP/2"
+        finally:
+            app.loop = None
+
+
+def make_certificate(tmpdir, name: str):
+    """
+    Creates a self-signed certificate for a hostname with the ``openssl`` command.
+    """
+    cert, key = str(tmpdir.join(name + ".crt")), str(tmpdir.join(name + ".key"))
+    if os.system("openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN={} "
+                 "-keyout {} -out {} 2>/dev/null".format(name, key, cert)) != 0:
+        pytest.skip("openssl is not available")
+
+    return cert, key
+
+
+def tls_handshake(context, server_name: str) -> str:
+    """
+    Makes a TLS handshake in memory, and returns the common name of the server certificate.
+    """
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    client_in, client_out, server_in, server_out = (ssl.MemoryBIO() for _ in range(4))
+    client = client_context.wrap_bio(client_in, client_out, server_hostname=server_name)
+    server = context.wrap_bio(server_in, server_out, server_side=True)
+
+    for _ in range(10):
+        for side in (client, server):
+            try:
+                side.do_handshake()
+            except ssl.SSLWantReadError:
+                pass
+
+        server_in.write(client_out.read())
+        client_in.write(server_out.read())
+
+    der = client.getpeercert(binary_form=True)
+    return ssl.DER_cert_to_PEM_cert(der)
+
+
+def test_tls_sni_and_reload(tmpdir):
+    """
+    Tests picking certificates with SNI, and reloading them.
+    """
+    default_cert, default_key = make_certificate(tmpdir, "default.test")
+    other_cert, other_key = make_certificate(tmpdir, "other.test")
+    with open(default_cert) as f:
+        default_pem = f.read()
+    with open(other_cert) as f:
+        other_pem = f.read()
+
+    listener = Listener.from_config({"ssl": {
+        "enabled": True, "ssl_certfile": default_cert, "ssl_keyfile": default_key,
+        "certificates": [{"hostnames": ["*.other.test"], "ssl_certfile": other_cert,
+                          "ssl_keyfile": other_key}]}})
+    context = listener.create_ssl_context(http2=True)
+
+    assert tls_handshake(context, "default.test") == default_pem
+    assert tls_handshake(context, "www.other.test") == other_pem
+    assert listener.tls.handshakes.total == 2
+    assert listener.tls.stats()["handshake_rate"] > 0
+
+    # Replacing the certificate file is picked up, on the same server context.
+    assert not listener.tls.changed()
+    new_cert, new_key = make_certificate(tmpdir, "new.test")
+    os.replace(new_cert, default_cert)
+    os.replace(new_key, default_key)
+    assert listener.tls.changed()
+    assert listener.tls.reload()
+    assert tls_handshake(context, "default.test") == open(default_cert).read()
+
+    # A broken certificate keeps the old ones.
+    with open(default_cert, "w") as f:
+        f.write("not a certificate")
+    assert not listener.tls.reload()
+    assert tls_handshake(context, "www.other.test") == other_pem
+
+
+@pytest.mark.asyncio
+async def test_thread_executor():
+    """
+    Tests running synchronous routes in a thread pool.
+    """
+    with app.testing_bp() as bp:
+        @bp.before_request
+        async def before(ctx: HTTPRequestContext):
+            ctx.hooked = threading.current_thread().name
+            return ctx
+
+        @bp.route("/thread", executor="thread")
+        def thread(ctx: HTTPRequestContext):
+            return "{} {}".format(ctx.hooked, threading.current_thread().name)
+
+        @bp.route("/inline")
+        def inline(ctx: HTTPRequestContext):
+            return threading.current_thread().name
+
+        r = await app.inject_request({}, "/thread")
+        hooked, name = r.data.decode().split()
+        assert hooked == threading.main_thread().name
+        assert name.startswith("kyoukai-route")
+
+        r = await app.inject_request({}, "/inline")
+        assert r.data.decode() == threading.main_thread().name
+
+        # The app config sets the executor of any other synchronous route.
+        app.config["sync_executor"] = "thread"
+        try:
+            r = await app.inject_request({}, "/inline")
+            assert r.data.decode().startswith("kyoukai-route")
+        finally:
+            del app.config["sync_executor"]
+            app.shutdown_executors()
+
+
+def process_route(request, number: str):
+    return "{} {} {}".format(os.getpid(), request.args["power"], int(number) ** 2), 201
+
+
+def process_stuck(request):
+    time.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_process_executor():
+    """
+    Tests running CPU-bound routes in a process pool.
+    """
+    app.config.update(process_pool_size=1, process_timeout=1, process_max_tasks=2)
+    try:
+        with app.testing_bp() as bp:
+            bp.add_route(bp.wrap_route(process_route, executor="process"), "/square/<number>")
+            bp.add_route(bp.wrap_route(process_stuck, executor="process"), "/stuck")
+
+            pids = set()
+            for _ in range(3):
+                r = await app.inject_request({}, "/square/12?power=2")
+                assert r.status_code == 201
+                pid, power, square = r.data.decode().split()
+                assert (power, square) == ("2", "144")
+                pids.add(pid)
+
+            # The worker is replaced after two requests.
+            assert len(pids) == 2 and str(os.getpid()) not in pids
+
+            r = await app.inject_request({}, "/stuck")
+            assert r.status_code == 504
+
+            r = await app.inject_request({}, "/square/3?power=2")
+            assert r.data.decode().endswith("9")
+    finally:
+        app.shutdown_executors()
+        for key in ("process_pool_size", "process_timeout", "process_max_tasks"):
+            del app.config[key]
+
+
+@pytest.mark.asyncio
+async def test_process_executor_shutdown(caplog):
+    """
+    Tests that shutting down terminates workers stuck on a route.
+    """
+    app.config.update(process_pool_size=1, process_max_tasks=1, process_shutdown_timeout=0.2)
+    try:
+        with app.testing_bp() as bp:
+            bp.add_route(bp.wrap_route(process_stuck, executor="process"), "/stuck")
+            bp.add_route(bp.wrap_route(process_route, executor="process"), "/square/<number>")
+            executor = app.get_executor("process")
+
+            task = asyncio.ensure_future(app.inject_request({}, "/stuck"))
+            while not executor.pending:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)
+            sentinels = [process.sentinel for process in executor.pool._processes.values()]
+
+            # The stuck pool is replaced, but still has a route running in it.
+            r = await app.inject_request({}, "/square/3?power=2")
+            assert r.status_code == 201
+            sentinels += [process.sentinel for process in executor.pool._processes.values()]
+
+            start = time.monotonic()
+            app.shutdown_executors()
+            assert time.monotonic() - start < 5
+            # Every sentinel is ready once its process has exited.
+            assert len(multiprocessing.connection.wait(sentinels, 0)) == len(sentinels)
+
+            # The route fails as its worker was terminated, not because its pool is gone.
+            r = await task
+            assert r.status_code == 500
+            assert "KeyError" not in caplog.text
+    finally:
+        for key in ("process_pool_size", "process_max_tasks", "process_shutdown_timeout"):
+            del app.config[key]
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    """
+    Tests sharing one response between identical concurrent requests.
+    """
+    calls = []
+    coalescer = Coalescer(max_followers=2)
+
+    with app.testing_bp() as bp:
+        @bp.route("/popular", coalesce=coalescer)
+        async def popular(ctx: HTTPRequestContext):
+            calls.append(ctx.request.args.get("page"))
+            await asyncio.sleep(0.05)
+            return "page {}".format(ctx.request.args.get("page"))
+
+        responses = await asyncio.gather(*[app.inject_request({}, "/popular?page=1")
+                                           for _ in range(4)],
+                                         app.inject_request({}, "/popular?page=2"))
+
+        assert [r.data for r in responses] == [b"page 1"] * 4 + [b"page 2"]
+        # The fourth request was over the follower limit.
+        assert calls == ["1", "1", "2"]
+        assert coalescer.coalesced == 2 and coalescer.in_flight == 0
+
+    with app.testing_bp() as bp:
+        @bp.route("/versioned", coalesce=True, etag=True)
+        async def versioned(ctx: HTTPRequestContext):
+            calls.append("versioned")
+            await asyncio.sleep(0.05)
+            ctx.check_etag("v1")
+            return "version 1"
+
+        # A 304 for the leader depends on its own If-None-Match, so it isn't shared.
+        calls.clear()
+        leader, follower = await asyncio.gather(
+            app.inject_request({"If-None-Match": '"v1"'}, "/versioned"),
+            app.inject_request({}, "/versioned"))
+        assert leader.status_code == 304
+        assert follower.status_code == 200 and follower.data == b"version 1"
+        assert calls == ["versioned", "versioned"]
+
+
+@pytest.mark.asyncio
+async def test_response_cache():
+    """
+    Tests caching responses, with Vary, Cache-Control, expiry and eviction.
+    """
+    now = [0]
+    cache = ResponseCache(max_bytes=1024, clock=lambda: now[0])
+    calls = []
+
+    with app.testing_bp() as bp:
+        @bp.before_request
+        async def before(ctx: HTTPRequestContext):
+            calls.append("hook")
+            return ctx
+
+        @bp.route("/cached/<name>", cache=cache)
+        async def cached(ctx: HTTPRequestContext, name: str):
+            calls.append(name)
+            language = ctx.request.headers.get("Accept-Language", "en")
+            cache_control = "no-store" if name == "secret" else "max-age=10"
+            return Response("{} {}".format(name, language) + " " * 300,
+                            headers={"Cache-Control": cache_control, "Vary": "Accept-Language"})
+
+        async def get(name: str, language: str = "en"):
+            r = await app.inject_request({"Accept-Language": language}, "/cached/" + name)
+            return r.data.decode().strip()
+
+        assert await get("a") == "a en"
+        assert await get("a") == "a en"
+        assert await get("a", "fr") == "a fr"
+        assert await get("a", "fr") == "a fr"
+        assert calls == ["hook", "a", "hook", "a"]
+        assert cache.hits == 2 and cache.misses == 2 and cache.hit_ratio == 0.5
+
+        # no-store is honoured.
+        await get("secret")
+        await get("secret")
+        assert calls.count("secret") == 2
+
+        # Responses expire.
+        now[0] = 11
+        await get("a")
+        assert calls.count("a") == 3
+
+        # The cache stays within its size, evicting the least recently used response.
+        await get("a", "fr")
+        await get("b")
+        await get("c")
+        assert cache.bytes <= 1024
+        calls.clear()
+        await get("a", "fr")
+        await get("c")
+        assert calls == ["hook", "a"]
+
+
+@pytest.mark.asyncio
+async def test_response_cache_credentials():
+    """
+    Tests that responses for a single user are not cached.
+    """
+    cache = ResponseCache()
+    calls = []
+
+    with app.testing_bp() as bp:
+        @bp.route("/user/<name>", cache=cache)
+        async def user(ctx: HTTPRequestContext, name: str):
+            calls.append(name)
+            headers = {"Cache-Control": "public, max-age=10" if name == "public" else "max-age=10"}
+            if name == "cookie":
+                headers["Set-Cookie"] = "session=1"
+            return Response(name, headers=headers)
+
+        async def get(name: str, headers: dict = None):
+            r = await app.inject_request(headers or {}, "/user/" + name)
+            return r.data.decode()
+
+        # Responses that set a cookie are never stored.
+        await get("cookie")
+        await get("cookie")
+        assert calls.count("cookie") == 2
+
+        # Requests with credentials are not stored...
+        for headers in ({"Authorization": "Bearer x"}, {"Cookie": "session=1"}):
+            calls.clear()
+            await get("private", headers)
+            await get("private", headers)
+            assert calls == ["private", "private"]
+
+        # ...nor answered from a response stored for another user.
+        calls.clear()
+        await get("private")
+        await get("private")
+        await get("private", {"Authorization": "Bearer x"})
+        assert calls == ["private", "private"]
+
+        # Unless the response is explicitly public.
+        calls.clear()
+        await get("public", {"Authorization": "Bearer x"})
+        await get("public", {"Cookie": "session=2"})
+        await get("public")
+        assert calls == ["public"]
+
+
+@pytest.mark.asyncio
+async def test_etag():
+    """
+    Tests generating ETags, and answering conditional requests with a 304.
+    """
+    built = []
+    app.config["etag_thread_threshold"] = 1024
+
+    with app.testing_bp() as bp:
+        @bp.route("/hashed", etag=True)
+        async def hashed(ctx: HTTPRequestContext):
+            return "x" * int(ctx.request.args.get("size", 10))
+
+        @bp.route("/checked", etag=True)
+        async def checked(ctx: HTTPRequestContext):
+            ctx.check_etag("v1")
+            built.append(True)
+            return "expensive"
+
+        try:
+            r = await app.inject_request({}, "/hashed")
+            etag = r.headers["ETag"]
+            assert r.status_code == 200 and etag.startswith('"')
+
+            r = await app.inject_request({"If-None-Match": etag}, "/hashed")
+            assert r.status_code == 304 and r.data == b"" and r.headers["ETag"] == etag
+
+            r = await app.inject_request({"If-None-Match": etag}, "/hashed?size=11")
+            assert r.status_code == 200
+
+            # Large bodies are hashed in a thread, to the same result.
+            r = await app.inject_request({}, "/hashed?size=4096")
+            assert r.headers["ETag"] == compute_etag(b"x" * 4096)
+
+            r = await app.inject_request({"If-None-Match": 'W/"v1"'}, "/checked")
+            assert r.status_code == 304 and r.headers["ETag"] == '"v1"' and not built
+
+            r = await app.inject_request({"If-None-Match": '"v0"'}, "/checked")
+            assert r.status_code == 200 and r.headers["ETag"] == '"v1"' and built
+        finally:
+            del app.config["etag_thread_threshold"]
+            app.shutdown_executors()
+
+
+@pytest.mark.asyncio
+async def test_compression():
+    """
+    Tests compressing whole and streamed responses.
+    """
+    body = "".join('{{"id": {}, "name": "item"}}'.format(i) for i in range(500))
+    compressor = Compressor(thread_threshold=4096)
+
+    with app.testing_bp() as bp:
+        @bp.route("/json", compress=compressor, etag=True)
+        async def json_route(ctx: HTTPRequestContext):
+            size = int(ctx.request.args.get("size", len(body)))
+            return Response(body[:size], content_type=ctx.request.args.get("type", "text/plain"))
+
+        @bp.route("/stream", compress=compressor)
+        async def stream(ctx: HTTPRequestContext):
+            return Response(iter([body[:2000], body[2000:]]))
+
+        @bp.route("/astream", compress=compressor)
+        async def astream(ctx: HTTPRequestContext):
+            return Response(AsyncBody(body[:2000].encode(), 3))
+
+        try:
+            r = await app.inject_request({"Accept-Encoding": "gzip, deflate"}, "/json")
+            assert r.headers["Content-Encoding"] == "gzip"
+            assert gzip.decompress(r.data).decode() == body
+            assert r.headers["ETag"].startswith('W/"')
+            assert compressor.ratio < 0.2
+
+            # A weak ETag still matches, so the response can be revalidated.
+            r = await app.inject_request({"Accept-Encoding": "gzip",
+                                          "If-None-Match": r.headers["ETag"]}, "/json")
+            assert r.status_code == 304
+
+            r = await app.inject_request({"Accept-Encoding": "deflate"}, "/json?size=2000")
+            assert zlib.decompress(r.data).decode() == body[:2000]
+
+            r = await app.inject_request({}, "/json")
+            assert "Content-Encoding" not in r.headers and r.data.decode() == body
+            assert "Accept-Encoding" in r.headers["Vary"]
+
+            for query in ("size=100", "type=image/png"):
+                r = await app.inject_request({"Accept-Encoding": "gzip"}, "/json?" + query)
+                assert "Content-Encoding" not in r.headers
+
+            r = await app.inject_request({"Accept-Encoding": "gzip"}, "/stream")
+            assert gzip.decompress(b"".join(r.response)).decode() == body
+
+            # Asynchronous bodies are compressed as they are iterated over.
+            r = await app.inject_request({"Accept-Encoding": "gzip"}, "/astream")
+            chunks = []
+            async for chunk in r.response:
+                chunks.append(chunk)
+            assert len(chunks) == 4
+            assert gzip.decompress(b"".join(chunks)).decode() == body[:2000] * 3
+        finally:
+            app.shutdown_executors()
+
+    # An adaptive level drops while the loop is lagging, and comes back once it catches up.
+    compressor = Compressor(level=6, adaptive=True, max_lag=0.05)
+    compressor._lag_changed(0.1)
+    compressor._lag_changed(0.1)
+    assert compressor.current_level == 4
+    compressor._lag_changed(0.0)
+    assert compressor.current_level == 5